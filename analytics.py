@@ -0,0 +1,291 @@
+"""Answering report queries with NumPy instead of the database
+
+Pokemon id, expiry time and coordinates of every sighting are kept in
+memory-mapped files in ANALYTICS_DIR, one file per column, and reports are
+computed from them with bincount and friends. Files are only appended to -
+run `python manage.py update-analytics` (e.g. from cron) to add sightings
+gathered since the previous run. Web server picks them up on its own.
+
+Sightings expiring before REPORT_SINCE aren't stored at all, so reports
+never have to filter (and copy) columns. Files are made from scratch by
+the next update after REPORT_SINCE changes.
+"""
+from datetime import datetime
+import functools
+import json
+import os
+import threading
+
+import numpy as np
+
+import config
+import db
+
+
+COLUMNS = (
+    ('pokemon_id', np.int16),
+    ('expire_timestamp', np.int64),
+    ('lat', np.float64),
+    ('lon', np.float64),
+)
+META_FILE = 'meta.json'
+
+
+def to_local_time(timestamps):
+    """Adds UTC offset valid at every timestamp (like time.localtime)"""
+    if not len(timestamps):
+        return timestamps
+    changes = db.get_utc_offset_changes(timestamps.min(), timestamps.max())
+    starts = np.array([timestamp for timestamp, _ in changes])
+    offsets = np.array([offset for _, offset in changes])
+    indexes = np.searchsorted(starts, timestamps, side='right') - 1
+    return timestamps + offsets[np.maximum(indexes, 0)]
+
+
+def remember(func):
+    """Keeps results of Analytics method until new sightings are mapped"""
+    @functools.wraps(func)
+    def wrapper(self, *args):
+        key = (func.__name__,) + args
+        if key not in self.cache:
+            self.cache[key] = func(self, *args)
+        return self.cache[key]
+    return wrapper
+
+
+class Analytics(object):
+    """Columns of all sightings, with methods named after those in db
+
+    They take the same arguments (apart from session) and return the same
+    results, so it can be used in place of DatabaseReports.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or getattr(
+            config, 'ANALYTICS_DIR', 'analytics'
+        )
+        self.meta_path = os.path.join(self.directory, META_FILE)
+        self.lock = threading.Lock()
+        self.columns = {}
+        self.last_id = 0
+        self.size = 0
+        self.cache = {}
+        self.refresh()
+
+    def get_path(self, name):
+        return os.path.join(self.directory, name + '.bin')
+
+    def read_meta(self):
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except IOError:
+            return {'last_id': 0, 'size': 0, 'since': 0}
+
+    def refresh(self):
+        """Maps files again if sightings were added since the last time"""
+        meta = self.read_meta()
+        with self.lock:
+            unchanged = (
+                meta['size'] == self.size and
+                meta['last_id'] == self.last_id
+            )
+            if unchanged and self.columns:
+                return
+            columns = {}
+            for name, dtype in COLUMNS:
+                if meta['size']:
+                    columns[name] = np.memmap(
+                        self.get_path(name),
+                        dtype=dtype,
+                        mode='r',
+                        shape=(meta['size'],),
+                    )
+                else:
+                    columns[name] = np.zeros(0, dtype=dtype)
+            self.columns = columns
+            self.last_id = meta['last_id']
+            self.size = meta['size']
+            self.cache = {}
+
+    def update(self, session, batch_size=1000000):
+        """Appends sightings added since the previous update
+
+        Archived sightings are read too, so nothing is missed if they were
+        archived in the meantime. Files are appended to first and meta file
+        saying how many rows they have is replaced after that, so readers
+        never see half-written rows. Returns number of added sightings.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        since = int(db.get_since()) if config.REPORT_SINCE else 0
+        meta = self.read_meta()
+        if meta.get('since', 0) != since:
+            # Files were made for another REPORT_SINCE. They're removed
+            # rather than truncated, as readers may still have them mapped.
+            for name, _ in COLUMNS:
+                if os.path.exists(self.get_path(name)):
+                    os.remove(self.get_path(name))
+            meta = {'last_id': 0, 'size': 0, 'since': since}
+        # Anything after the last complete update is thrown away
+        for name, dtype in COLUMNS:
+            path = self.get_path(name)
+            if os.path.exists(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(meta['size'] * np.dtype(dtype).itemsize)
+        added = 0
+        while True:
+            rows = db.get_sighting_columns(
+                session, meta['last_id'], batch_size
+            )
+            if not rows:
+                break
+            ids, pokemon_ids, expire_timestamps, lats, lons = zip(*rows)
+            values = (pokemon_ids, expire_timestamps, lats, lons)
+            keep = np.array(expire_timestamps, dtype=np.int64) > since
+            kept = int(keep.sum())
+            for (name, dtype), column in zip(COLUMNS, values):
+                with open(self.get_path(name), 'ab') as f:
+                    f.write(np.array(column).astype(dtype)[keep].tobytes())
+            meta = {
+                'last_id': ids[-1],
+                'size': meta['size'] + kept,
+                'since': since,
+            }
+            temp_path = self.meta_path + '.tmp'
+            with open(temp_path, 'w') as f:
+                json.dump(meta, f)
+            os.rename(temp_path, self.meta_path)
+            added += kept
+            if len(rows) < batch_size:
+                break
+        self.refresh()
+        return added
+
+    def get_column(self, name):
+        """Returns values of a column for sightings after REPORT_SINCE
+
+        Others aren't stored, so it's the whole mapped file.
+        """
+        return self.columns[name]
+
+    @remember
+    def get_pokemon_counts(self):
+        """Returns array with number of sightings of every Pokemon id"""
+        return np.bincount(self.get_column('pokemon_id'), minlength=152)
+
+    def get_session_stats(self):
+        timestamps = self.get_column('expire_timestamp')
+        start = int(timestamps.min())
+        end = int(timestamps.max())
+        length_hours = (end - start) // 3600
+        if length_hours == 0:
+            length_hours = 1
+        count = len(timestamps)
+        return {
+            'start': datetime.fromtimestamp(start),
+            'end': datetime.fromtimestamp(end),
+            'count': count,
+            'length_hours': length_hours,
+            'per_hour': count / length_hours,
+        }
+
+    def get_punch_card(self):
+        buckets = self.get_column('expire_timestamp') // 300
+        counts = np.bincount(buckets - buckets.min())
+        # Last bucket isn't complete yet
+        return list(enumerate(counts[:-1].tolist()))
+
+    def get_top_pokemon(self, count=30, order='DESC'):
+        counts = self.get_pokemon_counts()
+        pokemon_ids = np.flatnonzero(counts)
+        if order == 'DESC':
+            ordered = np.argsort(-counts[pokemon_ids], kind='mergesort')
+        else:
+            ordered = np.argsort(counts[pokemon_ids], kind='mergesort')
+        pokemon_ids = pokemon_ids[ordered[:count]]
+        return list(zip(pokemon_ids.tolist(), counts[pokemon_ids].tolist()))
+
+    def get_stage2_pokemon(self):
+        if not hasattr(config, 'STAGE2'):
+            return []
+        counts = self.get_pokemon_counts()
+        return [
+            (pokemon_id, int(counts[pokemon_id]))
+            for pokemon_id in config.STAGE2
+            if pokemon_id < len(counts) and counts[pokemon_id]
+        ]
+
+    def get_nonexistent_pokemon(self):
+        counts = self.get_pokemon_counts()
+        return [p for p in range(1, 152) if not counts[p]]
+
+    def get_spawns_per_hour(self, pokemon_id):
+        timestamps = self.get_column('expire_timestamp')[
+            self.get_column('pokemon_id') == pokemon_id
+        ]
+        hours = np.bincount(
+            to_local_time(timestamps) // 3600 % 24, minlength=24
+        )
+        return [
+            (
+                {
+                    'v': [hour, 30, 0],
+                    'f': '{}:00 - {}:00'.format(hour, hour + 1),
+                },
+                int(hours[hour])
+            )
+            for hour in np.flatnonzero(hours).tolist()
+        ]
+
+    def get_total_spawns_count(self, pokemon_id):
+        counts = self.get_pokemon_counts()
+        return int(counts[pokemon_id]) if pokemon_id < len(counts) else 0
+
+    def iter_heatmap(self, pokemon_id=None, resolution=None, by_minute=False):
+        """Yields the same rows as db.iter_heatmap"""
+        lat = self.get_column('lat')
+        lon = self.get_column('lon')
+        timestamps = self.get_column('expire_timestamp')
+        if pokemon_id:
+            mask = self.get_column('pokemon_id') == pokemon_id
+            lat, lon, timestamps = lat[mask], lon[mask], timestamps[mask]
+        if resolution:
+            lat = np.round(lat / resolution) * resolution
+            lon = np.round(lon / resolution) * resolution
+        if by_minute:
+            # Pokemon spawn 15 minutes before they expire
+            minutes = to_local_time(timestamps - 900) % 86400 // 60
+        else:
+            minutes = np.zeros(len(lat), dtype=np.int64)
+        if not len(lat):
+            return
+        order = np.lexsort((lon, lat, minutes))
+        minutes, lat, lon = minutes[order], lat[order], lon[order]
+        starts = np.flatnonzero(np.concatenate((
+            [True],
+            (minutes[1:] != minutes[:-1]) |
+            (lat[1:] != lat[:-1]) |
+            (lon[1:] != lon[:-1]),
+        )))
+        counts = np.diff(np.append(starts, len(lat)))
+        rows = zip(
+            minutes[starts].tolist(),
+            lat[starts].tolist(),
+            lon[starts].tolist(),
+            counts.tolist(),
+        )
+        for minute, row_lat, row_lon, count in rows:
+            if by_minute:
+                yield minute, row_lat, row_lon, count
+            else:
+                yield row_lat, row_lon, count
+
+
+class DatabaseReports(object):
+    """Report functions of db bound to a session, to be used like Analytics
+    """
+    def __init__(self, session):
+        self.session = session
+
+    def __getattr__(self, name):
+        return functools.partial(getattr(db, name), self.session)
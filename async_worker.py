@@ -0,0 +1,208 @@
+"""Engine running all workers as coroutines on a single event loop
+
+Workers spend most of their life waiting - either for the server or for
+the next scan - so there's no need to give each of them an OS thread.
+Blocking API calls are run in a bounded thread pool instead.
+
+Python 3.5+ only; selected with `worker.py --engine asyncio`.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import logging
+import random
+
+from pgoapi import exceptions as pgoapi_exceptions
+
+import config
+import utils
+import worker
+
+
+logger = logging.getLogger()
+
+
+class AsyncSlave(worker.BaseSlave):
+    """Single worker walking on the map, run as a coroutine
+
+    Instead of spawning a new object on restart, it starts over with a new
+    API object, so its coroutine runs for as long as the loop does.
+    """
+    def __init__(self, worker_no, points, executor):
+        self.executor = executor
+        super(AsyncSlave, self).__init__(worker_no, points)
+
+    async def call(self, func, *args, **kwargs):
+        """Runs blocking function in the executor"""
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def run(self):
+        if self.worker_no in config.DISABLE_WORKERS:
+            self.disable()
+            return
+        while True:
+            sleep_min, sleep_max = await self.run_cycles()
+            await asyncio.sleep(random.randint(sleep_min, sleep_max))
+            logger.info('Worker %d restarting', self.worker_no)
+            self.api = self.create_api()
+            self.running = True
+            self.step = 0
+
+    async def run_cycles(self):
+        """Logs in and runs a few cycles
+
+        Returns range of seconds to sleep before starting over.
+        """
+        self.cycle = 1
+        self.error_code = None
+
+        username, password, service = utils.get_worker_account(self.worker_no)
+        while True:
+            try:
+                loginsuccess = await self.call(
+                    self.api.login,
+                    username=username,
+                    password=password,
+                    provider=service,
+                )
+                if not loginsuccess:
+                    self.error_code = 'LOGIN FAIL'
+                    return 5, 20
+            except pgoapi_exceptions.AuthException:
+                logger.warning('Login failed!')
+                self.error_code = 'LOGIN FAIL'
+                return 5, 20
+            except pgoapi_exceptions.NotLoggedInException:
+                logger.error('Invalid credentials')
+                self.error_code = 'BAD LOGIN'
+                return 5, 20
+            except pgoapi_exceptions.ServerBusyOrOfflineException:
+                logger.info('Server too busy - restarting')
+                self.error_code = 'RETRYING'
+                return 5, 20
+            except pgoapi_exceptions.ServerSideRequestThrottlingException:
+                logger.info('Server throttling - sleeping for a bit')
+                await asyncio.sleep(random.uniform(1, 5))
+                continue
+            except asyncio.CancelledError:
+                # It's an Exception before Python 3.8
+                raise
+            except Exception:
+                logger.exception('A wild exception appeared!')
+                self.error_code = 'EXCEPTION'
+                return 5, 20
+            break
+        while self.cycle <= config.CYCLES_PER_WORKER:
+            if not self.running:
+                return 5, 20
+            try:
+                await self.main()
+            except worker.MalformedResponse:
+                logger.warning('Malformed response received!')
+                self.error_code = 'RESTART'
+                return 5, 20
+            except worker.BannedAccount:
+                self.error_code = 'BANNED?'
+                return 30, 90
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('A wild exception appeared!')
+                self.error_code = 'EXCEPTION'
+                return 5, 20
+            if not self.running:
+                return 5, 20
+            self.cycle += 1
+            if self.cycle <= config.CYCLES_PER_WORKER:
+                logger.info('Going to sleep for a bit')
+                self.error_code = 'SLEEP'
+                self.running = False
+                await asyncio.sleep(random.randint(30, 60))
+                logger.info('AWAKEN MY MASTERS')
+                self.running = True
+                self.error_code = None
+        self.error_code = 'RESTART'
+        return 5, 20
+
+    async def main(self):
+        """Heart of the worker - goes over each point and reports sightings"""
+        self.seen_per_cycle = 0
+        self.step = 0
+        for i, point in enumerate(self.get_points()):
+            if not self.running:
+                return
+            logger.info(
+                'Worker %d visiting point %d (%s %s)',
+                self.worker_no, i, point[0], point[1],
+            )
+            response_dict = await self.call(
+                self.api.get_map_objects, point, worker.cell_ids.get(point)
+            )
+            await self.process_response(response_dict)
+            await asyncio.sleep(self.get_scan_delay())
+        if self.seen_per_cycle == 0:
+            self.error_code = 'NO POKEMON'
+
+    async def process_response(self, response_dict):
+        """Hands everything seen in the response over to the writer
+
+        Blocking on a full queue would stop the whole loop, so items are
+        queued without blocking and retried after a short sleep.
+        """
+        pokemons, forts = self.read_response(response_dict)
+        items = [('sighting', raw_pokemon) for raw_pokemon in pokemons]
+        items.extend(('fort', raw_fort) for raw_fort in forts)
+        for item in items:
+            if worker.db_writer.put_nowait(item):
+                continue
+            worker.db_writer.backpressure += 1
+            while not worker.db_writer.put_nowait(item):
+                await asyncio.sleep(0.1)
+        self.point_processed(pokemons, forts)
+
+
+async def supervise(supervisor):
+    while True:
+        supervisor.tick()
+        await asyncio.sleep(0.5)
+
+
+def main(status_bar=True):
+    points = worker.prepare_workers()
+    count = config.GRID[0] * config.GRID[1]
+    executor = ThreadPoolExecutor(
+        max_workers=getattr(config, 'ASYNC_EXECUTOR_THREADS', 20)
+    )
+    workers = worker.workers
+    for worker_no in range(count):
+        workers[worker_no] = AsyncSlave(
+            worker_no, points[worker_no], executor
+        )
+    supervisor = worker.Supervisor(
+        workers, count, worker.get_points_stats(points), status_bar
+    )
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    tasks = [
+        asyncio.ensure_future(slave.run()) for slave in workers.values()
+    ]
+    tasks.append(asyncio.ensure_future(supervise(supervisor)))
+    everything = asyncio.gather(*tasks)
+    try:
+        loop.run_until_complete(everything)
+    except KeyboardInterrupt:
+        logger.info('Writing what is left in the queue and exiting')
+        for task in tasks:
+            task.cancel()
+        # Cancellations are delivered only once the loop runs again, and
+        # API calls still running in the executor have to finish before
+        # the writer stops taking their results
+        loop.run_until_complete(
+            asyncio.gather(everything, return_exceptions=True)
+        )
+        executor.shutdown(wait=True)
+        worker.db_writer.stop()
+        loop.close()
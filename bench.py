@@ -0,0 +1,769 @@
+# -*- coding: utf-8 -*-
+"""Measures performance of workers, database functions and web views
+
+Workers are run against transport.FakeTransport, so no accounts nor
+connection to the real server are needed:
+
+    python bench.py workers --workers 50 --points 40 --duration 60
+
+Database functions and web views are timed against a database filled with
+synthetic data, and results can be compared between runs:
+
+    python bench.py generate --db sqlite:///bench.sqlite --sightings 1000000
+    python bench.py suite --db sqlite:///bench.sqlite --output before.json
+    python bench.py suite --db sqlite:///bench.sqlite --output after.json
+    python bench.py compare before.json after.json
+"""
+import argparse
+from datetime import datetime
+import functools
+import json
+import logging
+import platform
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+
+import numpy as np
+
+import config
+import db
+import rollups
+import scheduler
+import spawnpoints
+import transport
+import utils
+import worker
+import workqueue
+
+
+def add_workers_args(parser):
+    parser.add_argument(
+        '--workers', type=int, default=20, help='Number of workers'
+    )
+    parser.add_argument(
+        '--points', type=int, default=30, help='Points per worker'
+    )
+    parser.add_argument(
+        '--duration', type=float, default=30, help='Seconds to run for'
+    )
+    parser.add_argument(
+        '--engine',
+        choices=['threads', 'asyncio'],
+        default='threads',
+    )
+    parser.add_argument(
+        '--db',
+        default='sqlite:///bench.sqlite',
+        help='Database to write to (created if needed)',
+    )
+    parser.add_argument(
+        '--scan-delay',
+        type=float,
+        default=0,
+        help='Seconds between visits (instead of SCAN_DELAY)',
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0,
+        help='Seconds fake server takes to respond',
+    )
+    parser.add_argument(
+        '--spawn-density',
+        type=float,
+        default=300,
+        help='Spawn points per square kilometre',
+    )
+    parser.add_argument(
+        '--fort-density',
+        type=float,
+        default=10,
+        help='Gyms per square kilometre',
+    )
+    parser.add_argument(
+        '--spawn-scheduler',
+        action='store_true',
+        help='Order visits with scheduler.SpawnScheduler',
+    )
+    parser.add_argument(
+        '--work-stealing',
+        action='store_true',
+        help='Share points between workers with workqueue.PointQueue',
+    )
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        default=None,
+        help='Override DB_WRITER_BATCH_SIZE (1 means row by row)',
+    )
+    parser.add_argument('--output', help='Save results as JSON there')
+    parser.set_defaults(func=run_workers)
+
+
+def get_points(workers, points_per_worker):
+    """Returns points for every worker, laid out in rows around map center
+
+    Points are 100 metres apart, so that neighbouring visits overlap a bit,
+    like in the real grid.
+    """
+    center = utils.get_map_center()
+    step = 100 / 111320.0
+    columns = int(points_per_worker ** 0.5) or 1
+    points = []
+    for worker_no in range(workers):
+        start = (
+            center[0] + (worker_no // 10) * step * columns,
+            center[1] + (worker_no % 10) * step * columns,
+        )
+        points.append([
+            (
+                start[0] + (i // columns) * step,
+                start[1] + (i % columns) * step,
+            )
+            for i in range(points_per_worker)
+        ])
+    return points
+
+
+def run_threads(slaves, duration):
+    def drive(slave):
+        while slave.running:
+            slave.main()
+    threads = [
+        threading.Thread(target=drive, args=(slave,)) for slave in slaves
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    for slave in slaves:
+        slave.running = False
+    for thread in threads:
+        thread.join()
+
+
+def run_asyncio(slaves, duration):
+    import asyncio
+
+    async def drive(slave):
+        while slave.running:
+            await slave.main()
+
+    def stop():
+        for slave in slaves:
+            slave.running = False
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.call_later(duration, stop)
+    loop.run_until_complete(
+        asyncio.gather(*[drive(slave) for slave in slaves])
+    )
+    loop.close()
+
+
+def run_workers(args):
+    engine = db.get_engine(args.db)
+    db.Base.metadata.create_all(engine)
+    db.Session.configure(bind=engine)
+    worker.BaseSlave.get_scan_delay = lambda slave: args.scan_delay
+    if args.batch_size:
+        worker.db_writer.batch_size = args.batch_size
+    worker.BaseSlave.transport_factory = functools.partial(
+        transport.FakeTransport,
+        spawn_density=args.spawn_density,
+        fort_density=args.fort_density,
+        latency=args.latency,
+    )
+    points = get_points(args.workers, args.points)
+    if args.spawn_scheduler:
+        # Nothing known upfront - it's learned while scanning
+        worker.schedulers.update(
+            enumerate(scheduler.get_schedulers(points, []))
+        )
+    if args.work_stealing:
+        worker.work_queue = workqueue.PointQueue(
+            points, getattr(config, 'MAX_POINT_AGE', 15 * 60)
+        )
+    if args.engine == 'asyncio':
+        from concurrent.futures import ThreadPoolExecutor
+        import async_worker
+        executor = ThreadPoolExecutor(
+            max_workers=getattr(config, 'ASYNC_EXECUTOR_THREADS', 20)
+        )
+        slaves = [
+            async_worker.AsyncSlave(worker_no, worker_points, executor)
+            for worker_no, worker_points in enumerate(points)
+        ]
+    else:
+        slaves = [
+            worker.Slave(
+                name='worker-%d' % worker_no,
+                worker_no=worker_no,
+                points=worker_points,
+            )
+            for worker_no, worker_points in enumerate(points)
+        ]
+    worker.db_writer.start()
+    started = time.time()
+    if args.engine == 'asyncio':
+        run_asyncio(slaves, args.duration)
+    else:
+        run_threads(slaves, args.duration)
+    scanned_for = time.time() - started
+    worker.db_writer.stop()
+    written_in = time.time() - started
+    sightings = sum(slave.total_seen for slave in slaves)
+    results = {
+        'engine': args.engine,
+        'workers': len(slaves),
+        'points_per_second': transport.FakeTransport.requests / scanned_for,
+        'sightings_per_second': sightings / scanned_for,
+        'rows_per_second': worker.db_writer.rows_written / written_in,
+        'rows': worker.db_writer.rows_written,
+        'seconds_after_scanning': written_in - scanned_for,
+        'rows_per_request': (
+            worker.db_writer.rows_written /
+            float(transport.FakeTransport.requests or 1)
+        ),
+        'writer_waits': worker.db_writer.backpressure,
+    }
+    print('engine: {engine}, workers: {workers}'.format(**results))
+    print('points/s: {points_per_second:.1f}'.format(**results))
+    print('sightings/s: {sightings_per_second:.1f}'.format(**results))
+    print(
+        'db rows/s: {rows_per_second:.1f} ({rows} rows, '
+        '{seconds_after_scanning:.1f}s spent after scanning)'
+        .format(**results)
+    )
+    print('db rows per request: {rows_per_request:.2f}'.format(**results))
+    print('db writer waits: {writer_waits}'.format(**results))
+    save_results(args.output, 'workers', results)
+
+
+def save_results(path, kind, results):
+    """Writes results as JSON, together with what they were measured on"""
+    if not path:
+        return
+    with open(path, 'w') as f:
+        json.dump({
+            'kind': kind,
+            'date': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def add_generate_args(parser):
+    parser.add_argument(
+        '--db',
+        default='sqlite:///bench.sqlite',
+        help='Database to fill (created if needed)',
+    )
+    parser.add_argument('--sightings', type=int, default=1000000)
+    parser.add_argument(
+        '--spawn-points',
+        type=int,
+        help='Number of spawn points (by default every one of them is seen '
+             'in about half of hours)',
+    )
+    parser.add_argument('--forts', type=int, default=500)
+    parser.add_argument('--fort-sightings', type=int, default=50000)
+    parser.add_argument(
+        '--days',
+        type=float,
+        default=30,
+        help='Sightings are spread over that many days before now',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.set_defaults(func=generate)
+
+
+def get_pokemon_weights(random):
+    """Returns probability of seeing every Pokemon id
+
+    Few species are very common and most of them are rare, like in the
+    game. Legendaries and some others are never seen.
+    """
+    weights = np.zeros(152)
+    seen = np.array([
+        i for i in range(1, 152)
+        if i not in (83, 115, 122, 128, 132, 144, 145, 146, 150, 151)
+    ])
+    ranks = random.permutation(len(seen)) + 1
+    weights[seen] = 1.0 / ranks ** 1.2
+    return weights / weights.sum()
+
+
+def get_coords(random, count):
+    lat = random.uniform(config.MAP_START[0], config.MAP_END[0], count)
+    lon = random.uniform(config.MAP_START[1], config.MAP_END[1], count)
+    return lat, lon
+
+
+# Rows are generated and inserted in parts of that size, so that memory
+# used doesn't depend on how many of them are generated
+GENERATE_CHUNK_SIZE = 100000
+
+
+def insert_rows(engine, table, columns):
+    """Inserts rows made of dict of column name -> array"""
+    names = list(columns)
+    values = [columns[n].tolist() for n in names]
+    engine.execute(
+        table.insert(), [dict(zip(names, row)) for row in zip(*values)]
+    )
+
+
+def get_chunks(count):
+    """Yields (start, end) of parts of range(count)"""
+    for start in range(0, count, GENERATE_CHUNK_SIZE):
+        yield start, min(start + GENERATE_CHUNK_SIZE, count)
+
+
+def generate(args):
+    """Fills database with synthetic sightings, forts and fort sightings
+
+    Rows are added in (almost) chronological order, like workers do, and
+    then report tables are brought up to date. Every chunk of sightings
+    covers its own part of the time span.
+    """
+    random = np.random.RandomState(args.seed)
+    engine = db.get_engine(args.db)
+    db.Base.metadata.create_all(engine)
+    db.Session.configure(bind=engine)
+    now = int(time.time())
+    first_hour = (now - int(args.days * 86400)) // 3600 * 3600
+    hours = max((now - first_hour) // 3600, 1)
+    timings = {}
+
+    started = timeit.default_timer()
+    spawn_count = args.spawn_points or max(args.sightings * 2 // hours, 1)
+    spawn_ids = np.array([
+        '{:011x}'.format(i) for i in random.randint(0, 2 ** 40, spawn_count)
+    ])
+    spawn_lat, spawn_lon = get_coords(random, spawn_count)
+    spawn_offsets = random.randint(0, 3600, spawn_count)
+    pokemon_weights = get_pokemon_weights(random)
+    # Encounter ids follow ids of sightings, so none of them is a duplicate
+    session = db.Session()
+    first_encounter_id = db.get_max_ids(session)[0] + 1
+    session.close()
+    for start, end in get_chunks(args.sightings):
+        size = end - start
+        spawns = random.randint(0, spawn_count, size)
+        first_chunk_hour = hours * start // args.sightings
+        chunk_hours = random.randint(
+            first_chunk_hour,
+            max(hours * end // args.sightings, first_chunk_hour + 1),
+            size,
+        )
+        expire_timestamps = (
+            first_hour + chunk_hours * 3600 +
+            spawn_offsets[spawns] + scheduler.SPAWN_DURATION
+        )
+        order = np.argsort(expire_timestamps, kind='mergesort')
+        spawns = spawns[order]
+        expire_timestamps = expire_timestamps[order]
+        insert_rows(engine, db.Sighting.__table__, {
+            'pokemon_id': random.choice(152, size, p=pokemon_weights),
+            'spawn_id': spawn_ids[spawns],
+            'expire_timestamp': expire_timestamps,
+            'encounter_id': (
+                np.arange(start, end) + first_encounter_id
+            ).astype(str),
+            'normalized_timestamp': expire_timestamps // 120 * 120,
+            'lat': np.round(spawn_lat[spawns], 6),
+            'lon': np.round(spawn_lon[spawns], 6),
+        })
+    timings['sightings'] = timeit.default_timer() - started
+
+    started = timeit.default_timer()
+    for start, end in get_chunks(args.forts):
+        fort_lat, fort_lon = get_coords(random, end - start)
+        insert_rows(engine, db.Fort.__table__, {
+            'external_id': np.array([
+                'bench{:08x}.16'.format(i)
+                for i in random.randint(0, 2 ** 31, end - start)
+            ]),
+            'lat': np.round(fort_lat, 6),
+            'lon': np.round(fort_lon, 6),
+        })
+    fort_ids = np.array([
+        row[0] for row in engine.execute(
+            db.Fort.__table__.select().order_by(db.Fort.id.desc())
+            .limit(args.forts)
+        )
+    ])[::-1]
+    if len(fort_ids) and args.fort_sightings:
+        # Every fort changes every now and then, at different times
+        changes = -(-args.fort_sightings // len(fort_ids))
+        step = max((now - first_hour) // changes, 1)
+        for start, end in get_chunks(args.fort_sightings):
+            size = end - start
+            numbers = np.arange(start, end)
+            insert_rows(engine, db.FortSighting.__table__, {
+                'fort_id': fort_ids[numbers % len(fort_ids)],
+                'last_modified': (
+                    first_hour + numbers // len(fort_ids) * step +
+                    random.randint(0, step, size)
+                ),
+                'team': random.randint(0, 4, size),
+                'prestige': random.randint(0, 50000, size),
+                'guard_pokemon_id': random.randint(1, 152, size),
+            })
+    session = db.Session()
+    db.rebuild_fort_state(session)
+    session.close()
+    timings['forts'] = timeit.default_timer() - started
+
+    started = timeit.default_timer()
+    rollups.RollupJob(batch_size=100000).update()
+    timings['rollups'] = timeit.default_timer() - started
+    started = timeit.default_timer()
+    spawnpoints.update_all()
+    timings['spawnpoints'] = timeit.default_timer() - started
+
+    print('Added {} sightings of {} spawn points, {} forts and {} fort '
+          'sightings'.format(
+              args.sightings, spawn_count, args.forts, args.fort_sightings
+          ))
+    for name, seconds in sorted(timings.items()):
+        print('{}: {:.1f}s'.format(name, seconds))
+
+
+# Ingest goes last, as it adds rows to the database
+SUITE_GROUPS = ['db', 'utils', 'web', 'ingest']
+
+
+def add_suite_args(parser):
+    parser.add_argument(
+        '--db',
+        default='sqlite:///bench.sqlite',
+        help='Database made by `bench.py generate`',
+    )
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        default=5,
+        help='How many times every case is run',
+    )
+    parser.add_argument(
+        '--groups',
+        nargs='+',
+        choices=SUITE_GROUPS,
+        default=SUITE_GROUPS,
+        help='Groups of cases to run (all by default)',
+    )
+    parser.add_argument(
+        '--ingest-rows',
+        type=int,
+        default=200,
+        help='Rows added one by one by every ingest case',
+    )
+    parser.add_argument(
+        '--warm-caches',
+        action='store_true',
+        help="Don't clear web caches before every request",
+    )
+    parser.add_argument('--output', help='Save results as JSON there')
+    parser.set_defaults(func=run_suite)
+
+
+def measure(func, repeat, before=None):
+    """Returns timings (in seconds) of calling func repeat times"""
+    timings = []
+    for _ in range(repeat):
+        if before:
+            before()
+        started = timeit.default_timer()
+        func()
+        timings.append(timeit.default_timer() - started)
+    return timings
+
+
+def with_session(func, *args, **kwargs):
+    """Returns function calling func with a new session and given args
+
+    Generators are consumed, so that all rows are read.
+    """
+    def call():
+        session = db.Session()
+        try:
+            result = func(session, *args, **kwargs)
+            if hasattr(result, 'all'):
+                result.all()
+            elif hasattr(result, '__next__') or hasattr(result, 'next'):
+                list(result)
+        finally:
+            session.close()
+    return call
+
+
+def get_db_cases():
+    session = db.Session()
+    max_ids = db.get_max_ids(session)
+    bottom_pokemon = [r[0] for r in db.get_top_pokemon(session, order='ASC')]
+    top_pokemon_id = (db.get_top_pokemon(session, count=1) or [(1, 0)])[0][0]
+    session.close()
+    now = time.time()
+    return [
+        ('get_sightings', with_session(db.get_sightings)),
+        ('get_max_ids', with_session(db.get_max_ids)),
+        ('get_sightings_since', with_session(
+            db.get_sightings_since, 0, max_ids[0]
+        )),
+        ('get_expired_sighting_ids', with_session(
+            db.get_expired_sighting_ids, now - 900, now, max_ids[0]
+        )),
+        ('get_forts', with_session(db.get_forts)),
+        ('get_forts_since', with_session(db.get_forts_since, 0, max_ids[1])),
+        ('get_spawn_times', with_session(
+            db.get_spawn_times, since=now - 7 * 86400
+        )),
+        ('get_rollup_watermark', with_session(db.get_rollup_watermark)),
+        ('get_session_stats', with_session(db.get_session_stats)),
+        ('get_punch_card', with_session(db.get_punch_card)),
+        ('get_pokemon_counts', with_session(
+            lambda session: db.get_pokemon_counts(session)[0]
+        )),
+        ('get_top_pokemon', with_session(db.get_top_pokemon)),
+        ('get_stage2_pokemon', with_session(db.get_stage2_pokemon)),
+        ('get_nonexistent_pokemon', with_session(db.get_nonexistent_pokemon)),
+        ('get_sighting_locations', with_session(
+            db.get_sighting_locations, bottom_pokemon
+        )),
+        ('get_spawns_per_hour', with_session(
+            db.get_spawns_per_hour, top_pokemon_id
+        )),
+        ('get_total_spawns_count', with_session(
+            db.get_total_spawns_count, top_pokemon_id
+        )),
+        ('get_archive_names', with_session(db.get_archive_names)),
+        ('iter_heatmap', with_session(db.iter_heatmap)),
+        ('iter_heatmap by minute', with_session(
+            db.iter_heatmap, pokemon_id=top_pokemon_id, by_minute=True
+        )),
+    ]
+
+
+def get_ingest_cases(rows):
+    """Returns cases adding rows one by one, like workers without batching
+
+    Every run adds new Pokemon and new states of forts, expiring in the
+    future, so that none of them is skipped as a duplicate.
+    """
+    counter = [int(time.time() * 1000)]
+    center = utils.get_map_center()
+
+    def add_sightings():
+        session = db.Session()
+        for _ in range(rows):
+            counter[0] += 1
+            db.add_sighting(session, {
+                'pokemon_id': counter[0] % 151 + 1,
+                'spawn_id': '{:011x}'.format(counter[0] % 2 ** 40),
+                'encounter_id': 'bench{}'.format(counter[0]),
+                'expire_timestamp': time.time() + 600,
+                'lat': center[0],
+                'lon': center[1],
+            })
+            session.commit()
+        session.close()
+
+    def add_fort_sightings():
+        session = db.Session()
+        for _ in range(rows):
+            counter[0] += 1
+            db.add_fort_sighting(session, {
+                'external_id': 'bench{}.16'.format(counter[0] % 100),
+                'lat': center[0],
+                'lon': center[1],
+                'team': counter[0] % 4,
+                'prestige': counter[0] % 50000,
+                'guard_pokemon_id': counter[0] % 151 + 1,
+                'last_modified': counter[0],
+            })
+        session.close()
+    return [
+        ('add_sighting', add_sightings),
+        ('add_fort_sighting', add_fort_sightings),
+    ]
+
+
+def get_utils_cases():
+    return [
+        ('get_points_per_worker', utils.get_points_per_worker),
+    ]
+
+
+def get_web_cases(warm_caches):
+    """Returns cases requesting every view of web and gyms apps
+
+    Tiles are rendered to a temporary directory, removed afterwards.
+    """
+    import gyms
+    import tiles
+    import web
+
+    directory = tempfile.mkdtemp()
+    web.tile_renderer.directory = directory
+    center = utils.get_map_center()
+    zoom = 15
+    tile_x, tile_y = [
+        r[0] for r in tiles.get_tile_range(zoom, center, center)
+    ]
+    session = db.Session()
+    pokemon_id = (db.get_top_pokemon(session, count=1) or [(1, 0)])[0][0]
+    session.close()
+    bounds = '{},{},{},{}'.format(
+        config.MAP_START[0], config.MAP_START[1],
+        config.MAP_END[0], config.MAP_END[1],
+    )
+    clients = {
+        'web': web.create_app().test_client(),
+        'gyms': gyms.create_app().test_client(),
+    }
+
+    def clear_caches():
+        if not warm_caches:
+            web.report_cache.clear()
+            gyms.stats_cache.clear()
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def get(app, url):
+        def request():
+            response = clients[app].get(
+                url, headers={'Accept-Encoding': 'gzip'}
+            )
+            if response.status_code != 200:
+                raise ValueError('{} returned {}'.format(
+                    url, response.status_code
+                ))
+            # Streamed responses are generated while being read
+            response.get_data()
+        return app + ' ' + url, request
+
+    cases = [
+        get('web', '/'),
+        get('web', '/data'),
+        get('web', '/data?format=compact&bounds={}&zoom=15'.format(bounds)),
+        get('web', '/workers_data'),
+        get('web', '/workers_data?format=compact'),
+        get('web', '/report'),
+        get('web', '/report/{}'.format(pokemon_id)),
+        get('web', '/report/heatmap?format=binary'),
+        get('web', '/report/heatmap/time_based?id={}'.format(pokemon_id)),
+        get('web', '/tiles/all/{}/{}/{}.png'.format(zoom, tile_x, tile_y)),
+        get('gyms', '/'),
+    ]
+    return cases, clear_caches, lambda: shutil.rmtree(directory, True)
+
+
+def run_suite(args):
+    """Times every case of chosen groups and prints (or saves) the results"""
+    engine = db.get_engine(args.db)
+    db.Session.configure(bind=engine)
+    results = []
+    cleanup = None
+    for group in SUITE_GROUPS:
+        if group not in args.groups:
+            continue
+        before = None
+        if group == 'db':
+            cases = get_db_cases()
+        elif group == 'utils':
+            cases = get_utils_cases()
+        elif group == 'web':
+            cases, before, cleanup = get_web_cases(args.warm_caches)
+        else:
+            cases = get_ingest_cases(args.ingest_rows)
+        for name, func in cases:
+            timings = measure(func, args.repeat, before)
+            result = {
+                'group': group,
+                'name': name,
+                'repeat': args.repeat,
+                'min': min(timings),
+                'median': float(np.median(timings)),
+                'mean': float(np.mean(timings)),
+            }
+            if group == 'ingest':
+                result['rows_per_second'] = args.ingest_rows / result['median']
+            results.append(result)
+            print('{group:<7} {name:<60} {median:9.4f}s (min {min:.4f}s)'
+                  .format(**result))
+    if cleanup:
+        cleanup()
+    session = db.Session()
+    max_ids = db.get_max_ids(session)
+    session.close()
+    save_results(args.output, 'suite', {
+        'db': repr(engine.url),
+        'max_sighting_id': max_ids[0],
+        'max_fort_sighting_id': max_ids[1],
+        'cases': results,
+    })
+
+
+def add_compare_args(parser):
+    parser.add_argument('before', help='Results saved by suite --output')
+    parser.add_argument('after')
+    parser.set_defaults(func=compare)
+
+
+def compare(args):
+    """Prints medians of cases in both results, and how they changed"""
+    cases = []
+    for path in (args.before, args.after):
+        with open(path) as f:
+            cases.append({
+                (c['group'], c['name']): c['median']
+                for c in json.load(f)['results']['cases']
+            })
+    before, after = cases
+    for key in sorted(set(before) & set(after)):
+        ratio = after[key] / before[key] if before[key] else float('inf')
+        print('{:<7} {:<60} {:9.4f}s {:9.4f}s {:6.2f}x'.format(
+            key[0], key[1], before[key], after[key], ratio
+        ))
+    for key in sorted(set(before) ^ set(after)):
+        print('{:<7} {:<60} only in {}'.format(
+            key[0], key[1], 'before' if key in before else 'after'
+        ))
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    add_workers_args(subparsers.add_parser(
+        'workers',
+        help='Run workers against fake server and measure throughput',
+    ))
+    add_generate_args(subparsers.add_parser(
+        'generate',
+        help='Fill database with synthetic sightings and forts',
+    ))
+    add_suite_args(subparsers.add_parser(
+        'suite',
+        help='Time database functions, ingest and web views',
+    ))
+    add_compare_args(subparsers.add_parser(
+        'compare',
+        help='Compare results of two suite runs',
+    ))
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.WARNING)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Caching responses that are expensive to compute
+
+Reports, heatmaps and gym stats take a while to compute and change slowly,
+so they're computed once and served from memory for some time. When many
+requests ask for the same expired value at once, only one of them computes
+it and the rest wait for the result.
+"""
+from collections import OrderedDict
+import functools
+import threading
+import time
+
+
+class ResponseCache(object):
+    """Thread-safe cache with TTL and LRU eviction
+
+    If version_func is given, entries computed for a different version are
+    treated as expired. It's called at most every version_interval seconds,
+    so it's fine for it to ask the database e.g. about max sighting id.
+    """
+    def __init__(
+        self,
+        ttl=15 * 60,
+        max_size=128,
+        version_func=None,
+        version_interval=5,
+    ):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.version_func = version_func
+        self.version_interval = version_interval
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.pending = {}
+        self.version = None
+        self.version_checked_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def get_version(self):
+        if not self.version_func:
+            return None
+        now = time.time()
+        if now - self.version_checked_at >= self.version_interval:
+            self.version = self.version_func()
+            self.version_checked_at = now
+        return self.version
+
+    def get(self, key, compute):
+        """Returns cached value, calling compute() if there's none"""
+        version = self.get_version()
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if entry and self._is_valid(entry, version):
+                    # Most recently used ones are kept at the end
+                    del self.entries[key]
+                    self.entries[key] = entry
+                    self.hits += 1
+                    return entry[2]
+                event = self.pending.get(key)
+                if event is None:
+                    event = self.pending[key] = threading.Event()
+                    self.misses += 1
+                    break
+                self.waits += 1
+            # Someone else is computing it already. If they fail, next
+            # iteration will try again.
+            event.wait()
+        try:
+            value = compute()
+            with self.lock:
+                self.entries.pop(key, None)
+                self.entries[key] = (time.time(), version, value)
+                while len(self.entries) > self.max_size:
+                    self.entries.popitem(last=False)
+        finally:
+            with self.lock:
+                del self.pending[key]
+            event.set()
+        return value
+
+    def _is_valid(self, entry, version):
+        created_at, entry_version, value = entry
+        return (
+            created_at > time.time() - self.ttl and
+            entry_version == version
+        )
+
+    def cached(self, key=None):
+        """Decorator caching results of a function
+
+        Key is computed by calling key with the same arguments as the
+        function; by default it's made of function name and arguments.
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if key:
+                    cache_key = key(*args, **kwargs)
+                else:
+                    cache_key = (
+                        func.__name__, args, tuple(sorted(kwargs.items()))
+                    )
+                return self.get(
+                    cache_key, functools.partial(func, *args, **kwargs)
+                )
+            return wrapper
+        return decorator
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    @property
+    def status(self):
+        """Returns status message, e.g. for logging"""
+        with self.lock:
+            size = len(self.entries)
+        return (
+            '{size} entries, {hits} hits, {misses} misses, {waits} waits'
+        ).format(
+            size=size, hits=self.hits, misses=self.misses, waits=self.waits
+        )
@@ -1,19 +1,25 @@
+import calendar
 from datetime import datetime
 import enum
+import re
+import struct
+import sys
+import threading
 import time
 
-from sqlalchemy import create_engine
-from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy import create_engine, event, inspect, select
+from sqlalchemy import Column, Float, Integer, String, Table, Text
+from sqlalchemy import ForeignKey, UniqueConstraint
+from sqlalchemy.exc import DBAPIError, IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import scoped_session, sessionmaker, relationship
 from sqlalchemy.sql.expression import func   
 
 try:
     import config
-    DB_ENGINE = config.DB_ENGINE
-except (ImportError, AttributeError):
-    DB_ENGINE = 'sqlite:///db.sqlite'
+except ImportError:
+    config = None
+DB_ENGINE = getattr(config, 'DB_ENGINE', 'sqlite:///db.sqlite')
 
 
 class Team(enum.Enum):
@@ -23,8 +29,67 @@ class Team(enum.Enum):
     instict = 3
 
 
-def get_engine():
-    return create_engine(DB_ENGINE)
+def get_engine(url=None):
+    """Creates engine configured with DB_* (or SQLITE_*) settings"""
+    url = url or DB_ENGINE
+    if url.startswith('sqlite'):
+        # Connections aren't pooled (apart from in-memory database), they
+        # only have to wait for each other instead of failing right away
+        engine = create_engine(url, connect_args={
+            'timeout': getattr(config, 'SQLITE_BUSY_TIMEOUT', 30),
+        })
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+        return engine
+    engine = create_engine(
+        url,
+        pool_size=getattr(config, 'DB_POOL_SIZE', 5),
+        max_overflow=getattr(config, 'DB_MAX_OVERFLOW', 10),
+        # MySQL closes connections idle for 8 hours by default
+        pool_recycle=getattr(config, 'DB_POOL_RECYCLE', 3600),
+    )
+    if getattr(config, 'DB_POOL_PRE_PING', True):
+        event.listen(engine, 'engine_connect', ping_connection)
+    return engine
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Lets web interface read while workers write
+
+    In WAL mode readers don't block the writer and the other way round,
+    and with synchronous=NORMAL commits don't wait for fsync.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode={}'.format(
+        getattr(config, 'SQLITE_JOURNAL_MODE', 'WAL')
+    ))
+    cursor.execute('PRAGMA synchronous={}'.format(
+        getattr(config, 'SQLITE_SYNCHRONOUS', 'NORMAL')
+    ))
+    cursor.execute('PRAGMA busy_timeout={}'.format(
+        int(getattr(config, 'SQLITE_BUSY_TIMEOUT', 30) * 1000)
+    ))
+    cursor.close()
+
+
+def ping_connection(connection, branch):
+    """Checks if pooled connection is still alive before it's used
+
+    Dead connection is replaced with a new one, instead of failing the
+    first query made with it.
+    """
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except DBAPIError as e:
+        if not e.connection_invalidated:
+            raise
+        # Whole pool got invalidated, so this one will reconnect
+        connection.scalar(select([1]))
+    finally:
+        connection.should_close_with_result = should_close_with_result
 
 
 def get_engine_name(session):
@@ -35,44 +100,103 @@ Base = declarative_base()
 
 
 class SightingCache(object):
-    """Simple cache for storing actual sightings
+    """Thread-safe cache for storing actual sightings
 
     It's used in order not to make as many queries to the database.
-    It's also capable of purging old entries.
+    Entries are kept in buckets, one for every 120 seconds slot returned by
+    normalize_timestamp, so purging old entries means dropping whole
+    buckets instead of going over every single entry.
     """
     def __init__(self):
-        self.store = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
 
     @staticmethod
     def _make_key(sighting):
-        return (
+        """Packs everything identifying a sighting into 18 bytes
+
+        Spawn ids are hex-encoded S2 cell ids, so they fit in 64 bits.
+        """
+        try:
+            spawn_id = int(sighting['spawn_id'], 16) & 0xFFFFFFFFFFFFFFFF
+        except (TypeError, ValueError):
+            spawn_id = hash(sighting['spawn_id']) & 0xFFFFFFFFFFFFFFFF
+        return struct.pack(
+            '<HQii',
             sighting['pokemon_id'],
-            sighting['spawn_id'],
-            normalize_timestamp(sighting['expire_timestamp']),
-            sighting['lat'],
-            sighting['lon'],
+            spawn_id,
+            int(round(float(sighting['lat']) * 1e6)),
+            int(round(float(sighting['lon']) * 1e6)),
         )
 
     def add(self, sighting):
-        self.store[self._make_key(sighting)] = sighting['expire_timestamp']
+        slot = normalize_timestamp(sighting['expire_timestamp'])
+        key = self._make_key(sighting)
+        with self.lock:
+            bucket = self.buckets.setdefault(slot, {})
+            bucket[key] = sighting['expire_timestamp']
 
     def __contains__(self, raw_sighting):
-        expire_timestamp = self.store.get(self._make_key(raw_sighting))
-        if not expire_timestamp:
-            return False
-        timestamp_in_range = (
-            expire_timestamp > raw_sighting['expire_timestamp'] - 5 and
-            expire_timestamp < raw_sighting['expire_timestamp'] + 5
-        )
+        slot = normalize_timestamp(raw_sighting['expire_timestamp'])
+        key = self._make_key(raw_sighting)
+        with self.lock:
+            bucket = self.buckets.get(slot)
+            expire_timestamp = bucket.get(key) if bucket else None
+            timestamp_in_range = expire_timestamp is not None and (
+                expire_timestamp > raw_sighting['expire_timestamp'] - 5 and
+                expire_timestamp < raw_sighting['expire_timestamp'] + 5
+            )
+            if timestamp_in_range:
+                self.hits += 1
+            else:
+                self.misses += 1
         return timestamp_in_range
 
+    def __len__(self):
+        with self.lock:
+            return sum(len(bucket) for bucket in self.buckets.values())
+
     def clean_expired(self):
-        to_remove = []
-        for key, timestamp in self.store.items():
-            if timestamp < time.time() - 120:
-                to_remove.append(key)
-        for key in to_remove:
-            del self.store[key]
+        """Drops buckets which expired more than 120 seconds ago"""
+        # Slot covers timestamps up to 120 seconds after its start
+        threshold = time.time() - 240
+        with self.lock:
+            expired = [slot for slot in self.buckets if slot < threshold]
+            for slot in expired:
+                del self.buckets[slot]
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups else 0.0
+
+    def get_memory_usage(self):
+        """Returns approximate size of stored entries in bytes
+
+        All keys and values have the same size, so there's no need to
+        measure every one of them.
+        """
+        entry_size = sys.getsizeof(b'\0' * 18) + sys.getsizeof(0.0)
+        with self.lock:
+            total = sys.getsizeof(self.buckets)
+            for bucket in self.buckets.values():
+                total += sys.getsizeof(bucket) + len(bucket) * entry_size
+        return total
+
+    @property
+    def status(self):
+        """Returns status message to be displayed in status screen"""
+        return (
+            'Sighting cache: {count} entries in {buckets} buckets, '
+            '~{size:.1f} MB, {ratio:.0%} hit ratio'
+        ).format(
+            count=len(self),
+            buckets=len(self.buckets),
+            size=self.get_memory_usage() / 1024.0 / 1024.0,
+            ratio=self.hit_ratio,
+        )
 
 
 class FortCache(object):
@@ -118,6 +242,14 @@ class Sighting(Base):
     lat = Column(String(20), index=True)
     lon = Column(String(20), index=True)
 
+    __table_args__ = (
+        UniqueConstraint(
+            'encounter_id',
+            'normalized_timestamp',
+            name='timestamp_encounter_id_unique'
+        ),
+    )
+
 
 class Fort(Base):
     __tablename__ = 'forts'
@@ -153,7 +285,89 @@ class FortSighting(Base):
     )
 
 
+class FortState(Base):
+    """Latest known state of every fort
+
+    Same as the newest of fort's sightings, kept up to date when adding
+    them, so that current map of gyms doesn't have to be dug out of the
+    whole history.
+    """
+    __tablename__ = 'fort_state'
+
+    fort_id = Column(Integer, ForeignKey('forts.id'), primary_key=True)
+    fort_sighting_id = Column(Integer)
+    last_modified = Column(Integer)
+    team = Column(Integer)
+    prestige = Column(Integer)
+    guard_pokemon_id = Column(Integer)
+    lat = Column(String(20))
+    lon = Column(String(20))
+
+
+class RollupState(Base):
+    """Id of the last sighting already counted in rollup tables"""
+    __tablename__ = 'rollup_state'
+
+    name = Column(String(32), primary_key=True)
+    last_id = Column(Integer)
+
+
+class PokemonHourly(Base):
+    """Number of sightings of every Pokemon expiring in every hour"""
+    __tablename__ = 'pokemon_hourly'
+
+    pokemon_id = Column(Integer, primary_key=True)
+    timestamp = Column(Integer, primary_key=True)  # start of hour
+    how_many = Column(Integer)
+
+
+class SightingBucket(Base):
+    """Number of all sightings expiring in every 5 minutes"""
+    __tablename__ = 'sighting_buckets'
+
+    timestamp = Column(Integer, primary_key=True)  # start of 5 minutes
+    how_many = Column(Integer)
+    min_timestamp = Column(Integer)
+    max_timestamp = Column(Integer)
+
+
+class PokemonLocation(Base):
+    """Every place given Pokemon was seen at"""
+    __tablename__ = 'pokemon_locations'
+
+    pokemon_id = Column(Integer, primary_key=True)
+    lat = Column(String(20), primary_key=True)
+    lon = Column(String(20), primary_key=True)
+    how_many = Column(Integer)
+    first_seen = Column(Integer)
+    last_seen = Column(Integer, index=True)
+
+
+class SpawnPoint(Base):
+    """Everything known about a spawn point, computed by spawnpoints.py"""
+    __tablename__ = 'spawnpoints'
+
+    spawn_id = Column(String(32), primary_key=True)
+    # Single precision would round coordinates to about a meter and sums
+    # of many offsets even worse; FLOAT(53) is DOUBLE in MySQL
+    lat = Column(Float(precision=53))
+    lon = Column(Float(precision=53))
+    # Second of hour Pokemon spawn at
+    spawn_offset = Column(Integer)
+    # Sums of sines and cosines of offsets of all observations, which allow
+    # updating their circular mean without going over them again
+    offset_sin = Column(Float(precision=53))
+    offset_cos = Column(Float(precision=53))
+    observations = Column(Integer)
+    first_seen = Column(Integer)
+    last_seen = Column(Integer, index=True)
+    # JSON object with number of observations of every Pokemon id
+    species = Column(Text)
+
+
 Session = sessionmaker(bind=get_engine())
+# Web interface uses one session per request (thread), removed after it
+ScopedSession = scoped_session(Session)
 
 
 def normalize_timestamp(timestamp):
@@ -165,41 +379,106 @@ def get_since():
     return time.mktime(config.REPORT_SINCE.timetuple())
 
 
-def get_since_query_part(where=True):
-    """Returns WHERE part of query filtering records before set date"""
+def filter_report_since(query, column, period=0):
+    """Filters out rollup rows covering only time before REPORT_SINCE
+
+    Rows cover period seconds starting at timestamp in the given column.
+    """
     if config.REPORT_SINCE:
-        return '{noun} expire_timestamp > {since}'.format(
-            noun='WHERE' if where else 'AND',
-            since=get_since(),
-        )
-    return ''
+        query = query.filter(column > get_since() - period)
+    return query
+
+
+def chunks(items, size=500):
+    """Splits list into parts small enough to be used in IN clauses"""
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def insert_ignore(session, table, rows):
+    """Inserts rows, silently skipping those violating unique keys
+
+    Returns number of inserted rows.
+    """
+    if not rows:
+        return 0
+    engine_name = get_engine_name(session)
+    if engine_name in ('sqlite', 'mysql'):
+        prefix = 'OR IGNORE' if engine_name == 'sqlite' else 'IGNORE'
+        result = session.execute(table.insert().prefix_with(prefix), rows)
+        return result.rowcount if result.rowcount >= 0 else len(rows)
+    # Other databases don't have anything as simple as that
+    inserted = 0
+    for row in rows:
+        try:
+            with session.begin_nested():
+                session.execute(table.insert(), row)
+        except IntegrityError:
+            continue
+        inserted += 1
+    return inserted
+
+
+def get_rows_after(session, source, columns, after_id, limit):
+    """Returns given columns of up to limit rows following given id
+
+    Only the next rows of primary key are read, so a big table can be gone
+    through in batches without sorting it or keeping a cursor open.
+    """
+    return session.execute('''
+        SELECT {columns} FROM {source}
+        WHERE id > {after_id}
+        ORDER BY id
+        LIMIT {limit}
+    '''.format(
+        columns=', '.join(columns),
+        source=source,
+        after_id=int(after_id),
+        limit=int(limit),
+    )).fetchall()
 
 
 def add_sighting(session, pokemon):
-    # Check if there isn't the same entry already
-    if pokemon in SIGHTING_CACHE:
-        return
-    existing = session.query(Sighting) \
-        .filter(Sighting.pokemon_id == pokemon['pokemon_id']) \
-        .filter(Sighting.spawn_id == pokemon['spawn_id']) \
-        .filter(Sighting.expire_timestamp > pokemon['expire_timestamp'] - 10) \
-        .filter(Sighting.expire_timestamp < pokemon['expire_timestamp'] + 10) \
-        .filter(Sighting.lat == pokemon['lat']) \
-        .filter(Sighting.lon == pokemon['lon']) \
-        .first()
-    if existing:
-        return
-    obj = Sighting(
-        pokemon_id=pokemon['pokemon_id'],
-        spawn_id=pokemon['spawn_id'],
-        encounter_id=str(pokemon['encounter_id']),
-        expire_timestamp=pokemon['expire_timestamp'],
-        normalized_timestamp=normalize_timestamp(pokemon['expire_timestamp']),
-        lat=pokemon['lat'],
-        lon=pokemon['lon'],
-    )
-    session.add(obj)
-    SIGHTING_CACHE.add(pokemon)
+    add_sightings(session, [pokemon])
+
+
+def add_sightings(session, pokemons):
+    """Adds many sightings at once, skipping those already in the database
+
+    Duplicates are rejected by sightings' unique key, so there's no need to
+    ask the database whether they exist first. Returns number of inserted
+    rows. Commit is left to the caller, and so is calling cache_sightings
+    once it succeeds.
+    """
+    rows = []
+    in_batch = set()
+    for pokemon in pokemons:
+        if pokemon in SIGHTING_CACHE:
+            continue
+        row = {
+            'pokemon_id': pokemon['pokemon_id'],
+            'spawn_id': pokemon['spawn_id'],
+            'encounter_id': str(pokemon['encounter_id']),
+            'expire_timestamp': pokemon['expire_timestamp'],
+            'normalized_timestamp': normalize_timestamp(
+                pokemon['expire_timestamp']
+            ),
+            'lat': pokemon['lat'],
+            'lon': pokemon['lon'],
+        }
+        # Same Pokemon may be reported by more than one worker in a batch
+        batch_key = (row['encounter_id'], row['normalized_timestamp'])
+        if batch_key in in_batch:
+            continue
+        in_batch.add(batch_key)
+        rows.append(row)
+    return insert_ignore(session, Sighting.__table__, rows)
+
+
+def cache_sightings(pokemons):
+    """Remembers sightings as saved, call it only after commit"""
+    for pokemon in pokemons:
+        SIGHTING_CACHE.add(pokemon)
 
 
 def add_fort_sighting(session, raw_fort):
@@ -239,6 +518,8 @@ def add_fort_sighting(session, raw_fort):
     )
     session.add(obj)
     try:
+        session.flush()
+        update_fort_states(session, [obj])
         session.commit()
     except IntegrityError:  # skip adding fort this time
         session.rollback()
@@ -246,13 +527,93 @@ def add_fort_sighting(session, raw_fort):
         FORT_CACHE.add(raw_fort)
 
 
-def get_sightings(session):
-    return session.query(Sighting) \
-        .filter(Sighting.expire_timestamp > time.time()) \
-        .all()
+def add_fort_sightings(session, raw_forts):
+    """Adds many fort sightings at once, creating missing forts on the way
 
+    Returns number of inserted fort sightings. Commit is left to the caller,
+    and so is calling cache_fort_sightings once it succeeds.
+    """
+    # Only the latest state of every fort matters
+    latest = {}
+    for raw_fort in raw_forts:
+        if raw_fort not in FORT_CACHE:
+            latest[raw_fort['external_id']] = raw_fort
+    if not latest:
+        return 0
+    forts = {
+        fort.external_id: fort for fort in session.query(Fort)
+        .filter(Fort.external_id.in_(latest.keys()))
+    }
+    for external_id, raw_fort in latest.items():
+        if external_id not in forts:
+            fort = Fort(
+                external_id=external_id,
+                lat=raw_fort['lat'],
+                lon=raw_fort['lon'],
+            )
+            session.add(fort)
+            forts[external_id] = fort
+    session.flush()  # new forts need their ids
+    rows = []
+    for external_id, raw_fort in latest.items():
+        rows.append({
+            'fort_id': forts[external_id].id,
+            'team': raw_fort['team'],
+            'prestige': raw_fort['prestige'],
+            'guard_pokemon_id': raw_fort['guard_pokemon_id'],
+            'last_modified': int(raw_fort['last_modified']),
+        })
+    # Already known states are rejected by (fort_id, last_modified) key
+    inserted = insert_ignore(session, FortSighting.__table__, rows)
+    added = session.query(FortSighting) \
+        .filter(FortSighting.fort_id.in_([row['fort_id'] for row in rows])) \
+        .filter(FortSighting.last_modified.in_(
+            set(row['last_modified'] for row in rows)
+        ))
+    update_fort_states(session, added)
+    return inserted
 
-def get_forts(session):
+
+def update_fort_states(session, fort_sightings):
+    """Makes fort_state reflect given fort sightings, unless it knows newer
+
+    Nothing is committed, so that states change together with sightings.
+    """
+    latest = {}
+    for fort_sighting in fort_sightings:
+        current = latest.get(fort_sighting.fort_id)
+        if not current or fort_sighting.last_modified > current.last_modified:
+            latest[fort_sighting.fort_id] = fort_sighting
+    if not latest:
+        return
+    states = {
+        state.fort_id: state for state in session.query(FortState)
+        .filter(FortState.fort_id.in_(latest.keys()))
+    }
+    for fort_id, fort_sighting in latest.items():
+        state = states.get(fort_id)
+        if state is None:
+            state = FortState(
+                fort_id=fort_id,
+                lat=fort_sighting.fort.lat,
+                lon=fort_sighting.fort.lon,
+            )
+            session.add(state)
+        elif state.last_modified > fort_sighting.last_modified:
+            continue
+        state.fort_sighting_id = fort_sighting.id
+        state.last_modified = fort_sighting.last_modified
+        state.team = fort_sighting.team
+        state.prestige = fort_sighting.prestige
+        state.guard_pokemon_id = fort_sighting.guard_pokemon_id
+
+
+def rebuild_fort_state(session):
+    """Fills fort_state from scratch using fort sightings
+
+    Needed only for databases created before fort_state was introduced.
+    Returns number of forts.
+    """
     if get_engine_name(session) == 'sqlite':
         # SQLite version is slooooooooooooow when compared to MySQL
         where = '''
@@ -270,227 +631,634 @@ def get_forts(session):
                 GROUP BY fort_id
             )
         '''
-    query = session.execute('''
+    session.query(FortState).delete()
+    session.execute('''
+        INSERT INTO fort_state (
+            fort_id,
+            fort_sighting_id,
+            last_modified,
+            team,
+            prestige,
+            guard_pokemon_id,
+            lat,
+            lon
+        )
         SELECT
             fs.fort_id,
             fs.id,
+            fs.last_modified,
             fs.team,
             fs.prestige,
             fs.guard_pokemon_id,
-            fs.last_modified,
             f.lat,
             f.lon
         FROM fort_sightings fs
         JOIN forts f ON f.id=fs.fort_id
         {where}
     '''.format(where=where))
-    return query.fetchall()
+    session.commit()
+    return session.query(FortState).count()
 
 
-def get_session_stats(session):
-    query = '''
+def cache_fort_sightings(raw_forts):
+    """Remembers fort sightings as saved, call it only after commit"""
+    for raw_fort in raw_forts:
+        FORT_CACHE.add(raw_fort)
+
+
+def warm_caches(session):
+    """Fills sighting and fort caches with what's already in the database
+
+    Without it, first cycle after a restart would have to ask the database
+    about every single Pokemon and fort on the map. Returns number of
+    cached sightings and forts.
+    """
+    active = session.query(
+        Sighting.pokemon_id,
+        Sighting.spawn_id,
+        Sighting.expire_timestamp,
+        Sighting.lat,
+        Sighting.lon,
+    ) \
+        .filter(Sighting.expire_timestamp > time.time()) \
+        .yield_per(10000)
+    sightings_count = 0
+    for row in active:
+        SIGHTING_CACHE.add({
+            'pokemon_id': row[0],
+            'spawn_id': row[1],
+            'expire_timestamp': row[2],
+            'lat': row[3],
+            'lon': row[4],
+        })
+        sightings_count += 1
+    forts = get_forts(session)
+    for fort in forts:
+        FORT_CACHE.add({
+            'external_id': fort['external_id'],
+            'team': fort['team'],
+            'prestige': fort['prestige'],
+            'guard_pokemon_id': fort['guard_pokemon_id'],
+        })
+    return sightings_count, len(forts)
+
+
+def get_spawn_times(session, since=None):
+    """Returns spawn id, coordinates and latest expiry of every spawn point"""
+    query = session.query(
+        Sighting.spawn_id,
+        func.min(Sighting.lat),
+        func.min(Sighting.lon),
+        func.max(Sighting.expire_timestamp),
+    ) \
+        .filter(Sighting.spawn_id.isnot(None))
+    if since:
+        query = query.filter(Sighting.expire_timestamp > since)
+    return query.group_by(Sighting.spawn_id).all()
+
+
+def get_sightings(session):
+    return session.query(Sighting) \
+        .filter(Sighting.expire_timestamp > time.time()) \
+        .all()
+
+
+def get_max_ids(session):
+    """Returns ids of the latest sighting and fort sighting"""
+    return (
+        session.query(func.max(Sighting.id)).scalar() or 0,
+        session.query(func.max(FortSighting.id)).scalar() or 0,
+    )
+
+
+def get_sightings_since(session, after_id, max_id):
+    """Returns active sightings added after sighting with given id"""
+    return session.query(Sighting) \
+        .filter(Sighting.id > after_id) \
+        .filter(Sighting.id <= max_id) \
+        .filter(Sighting.expire_timestamp > time.time()) \
+        .all()
+
+
+def get_expired_sighting_ids(session, since, until, max_id):
+    """Returns ids of sightings which expired between given timestamps"""
+    query = session.query(Sighting.id) \
+        .filter(Sighting.expire_timestamp > since) \
+        .filter(Sighting.expire_timestamp <= until) \
+        .filter(Sighting.id <= max_id)
+    return [row[0] for row in query]
+
+
+def get_forts_since(session, after_id, max_id):
+    """Returns latest state of forts that changed since given fort sighting
+
+    Rows look the same as the ones returned by get_forts.
+    """
+    query = session.execute('''
         SELECT
-            MIN(expire_timestamp) ts_min,
-            MAX(expire_timestamp) ts_max,
-            COUNT(*)
-        FROM `sightings`
-        {report_since}
-    '''
-    min_max_query = session.execute(query.format(
-        report_since=get_since_query_part()
+            fs.fort_id,
+            fs.id,
+            fs.team,
+            fs.prestige,
+            fs.guard_pokemon_id,
+            fs.last_modified,
+            f.lat,
+            f.lon,
+            f.external_id
+        FROM fort_sightings fs
+        JOIN forts f ON f.id=fs.fort_id
+        WHERE fs.id > {after_id} AND fs.id <= {max_id}
+        ORDER BY fs.last_modified
+    '''.format(after_id=int(after_id), max_id=int(max_id)))
+    latest = {}
+    for row in query.fetchall():
+        latest[row['fort_id']] = row
+    return list(latest.values())
+
+
+def get_forts(session):
+    query = session.execute('''
+        SELECT
+            fs.fort_id,
+            fs.fort_sighting_id AS id,
+            fs.team,
+            fs.prestige,
+            fs.guard_pokemon_id,
+            fs.last_modified,
+            fs.lat,
+            fs.lon,
+            f.external_id
+        FROM fort_state fs
+        JOIN forts f ON f.id=fs.fort_id
+    ''')
+    return query.fetchall()
+
+
+def update_rollups(session, batch_size=10000):
+    """Counts sightings added since the last run in rollup tables
+
+    At most batch_size sightings are processed, in order of their ids, and
+    the id of the last one is stored together with the counts, so it's safe
+    to stop at any time. Returns number of processed sightings.
+
+    State row is locked until commit, so that runs in different processes
+    (e.g. worker and `manage.py update-rollups`) never count the same
+    sightings twice.
+    """
+    state = session.query(RollupState).with_for_update().get('sightings')
+    if not state:
+        state = RollupState(name='sightings', last_id=0)
+        session.add(state)
+    rows = session.query(
+        Sighting.id,
+        Sighting.pokemon_id,
+        Sighting.expire_timestamp,
+        Sighting.lat,
+        Sighting.lon,
+    ) \
+        .filter(Sighting.id > state.last_id) \
+        .order_by(Sighting.id) \
+        .limit(batch_size) \
+        .all()
+    if not rows:
+        session.rollback()
+        return 0
+    hourly = {}
+    buckets = {}
+    locations = {}
+    for sighting_id, pokemon_id, expire_timestamp, lat, lon in rows:
+        key = (pokemon_id, expire_timestamp // 3600 * 3600)
+        hourly[key] = hourly.get(key, 0) + 1
+        for counts, key in (
+            (buckets, expire_timestamp // 300 * 300),
+            (locations, (pokemon_id, lat, lon)),
+        ):
+            current = counts.get(key)
+            if current:
+                current[0] += 1
+                current[1] = min(current[1], expire_timestamp)
+                current[2] = max(current[2], expire_timestamp)
+            else:
+                counts[key] = [1, expire_timestamp, expire_timestamp]
+
+    existing = {
+        (row.pokemon_id, row.timestamp): row
+        for row in session.query(PokemonHourly)
+        .filter(PokemonHourly.timestamp.in_(set(k[1] for k in hourly)))
+    }
+    for key, how_many in hourly.items():
+        if key in existing:
+            existing[key].how_many += how_many
+        else:
+            session.add(PokemonHourly(
+                pokemon_id=key[0], timestamp=key[1], how_many=how_many
+            ))
+
+    existing = {
+        row.timestamp: row for row in session.query(SightingBucket)
+        .filter(SightingBucket.timestamp.in_(buckets.keys()))
+    }
+    for timestamp, (how_many, min_timestamp, max_timestamp) in \
+            buckets.items():
+        bucket = existing.get(timestamp)
+        if bucket:
+            bucket.how_many += how_many
+            bucket.min_timestamp = min(bucket.min_timestamp, min_timestamp)
+            bucket.max_timestamp = max(bucket.max_timestamp, max_timestamp)
+        else:
+            session.add(SightingBucket(
+                timestamp=timestamp,
+                how_many=how_many,
+                min_timestamp=min_timestamp,
+                max_timestamp=max_timestamp,
+            ))
+
+    existing = {}
+    for keys in chunks(list(locations.keys())):
+        query = session.query(PokemonLocation) \
+            .filter(PokemonLocation.pokemon_id.in_(set(k[0] for k in keys))) \
+            .filter(PokemonLocation.lat.in_(set(k[1] for k in keys)))
+        for row in query:
+            existing[(row.pokemon_id, row.lat, row.lon)] = row
+    for key, (how_many, first_seen, last_seen) in locations.items():
+        location = existing.get(key)
+        if location:
+            location.how_many += how_many
+            location.first_seen = min(location.first_seen, first_seen)
+            location.last_seen = max(location.last_seen, last_seen)
+        else:
+            session.add(PokemonLocation(
+                pokemon_id=key[0],
+                lat=key[1],
+                lon=key[2],
+                how_many=how_many,
+                first_seen=first_seen,
+                last_seen=last_seen,
+            ))
+
+    state.last_id = rows[-1][0]
+    session.commit()
+    return len(rows)
+
+
+def get_rollup_watermark(session):
+    """Returns id of the last sighting counted in rollup tables"""
+    return session.query(RollupState.last_id) \
+        .filter(RollupState.name == 'sightings') \
+        .scalar() or 0
+
+
+ARCHIVE_NAME = re.compile(r'^sightings_\d{6}$')
+_archive_tables = {}
+_archive_lock = threading.Lock()
+
+
+def get_archive_table(name):
+    """Returns table with sightings of one month, e.g. sightings_201607
+
+    Archives have the same columns as sightings, but only expiry time is
+    indexed there.
+    """
+    with _archive_lock:
+        if name not in _archive_tables:
+            _archive_tables[name] = Table(name, Base.metadata, *[
+                Column(
+                    column.name,
+                    column.type,
+                    primary_key=column.primary_key,
+                    index=column.name == 'expire_timestamp',
+                )
+                for column in Sighting.__table__.columns
+            ])
+        return _archive_tables[name]
+
+
+def get_archive_names(session):
+    """Returns names of existing archive tables, oldest first"""
+    names = inspect(session.connection()).get_table_names()
+    return sorted(n for n in names if ARCHIVE_NAME.match(n))
+
+
+def get_sightings_source(session, with_archives=None):
+    """Returns what to select sightings FROM in raw queries
+
+    With archives, it's a subquery joining sightings with all archive
+    tables, still named sightings. By default REPORT_INCLUDE_ARCHIVES
+    decides about it - heatmaps are the only reports reading raw sightings,
+    rollup tables count archived ones anyway.
+    """
+    if with_archives is None:
+        with_archives = getattr(config, 'REPORT_INCLUDE_ARCHIVES', False)
+    names = get_archive_names(session) if with_archives else []
+    if not names:
+        return 'sightings'
+    columns = ', '.join(c.name for c in Sighting.__table__.columns)
+    return '({}) AS sightings'.format(' UNION ALL '.join(
+        'SELECT {} FROM {}'.format(columns, name)
+        for name in ['sightings'] + names
     ))
-    min_max_result = min_max_query.first()
+
+
+def get_sightings_after(session, columns, after_id, limit, names=None):
+    """Returns up to limit sightings following given id, archived ones too
+
+    Every table is read on its own and results are merged, as sorting
+    their union would sort all the sightings every time. Columns have to
+    include id. Names of archive tables can be given, so that they aren't
+    looked up on every call.
+    """
+    if names is None:
+        names = get_archive_names(session)
+    rows = []
+    for name in ['sightings'] + names:
+        rows.extend(get_rows_after(session, name, columns, after_id, limit))
+    rows.sort(key=lambda row: row.id)
+    return rows[:limit]
+
+
+def get_sighting_columns(session, after_id, batch_size):
+    """Returns id, pokemon_id, expire_timestamp, lat and lon of sightings
+    following given id, including archived ones
+    """
+    return get_sightings_after(
+        session,
+        ('id', 'pokemon_id', 'expire_timestamp', 'lat', 'lon'),
+        after_id,
+        batch_size,
+    )
+
+
+def archive_sightings(session, before, batch_size=10000):
+    """Moves sightings which expired before given timestamp to archives
+
+    Every sighting goes to the table of month (UTC) it expired in. Only
+    sightings already counted by rollups - all of them, including
+    spawnpoints - are moved, as they'd never be counted otherwise. At most
+    batch_size sightings are moved in one transaction. Returns number of
+    moved sightings.
+
+    The sighting with the highest id always stays, as SQLite (and MySQL
+    after restart) would give new sightings ids of moved ones otherwise.
+    """
+    counted_id = session.query(func.min(RollupState.last_id)).scalar() or 0
+    last_id = session.query(func.max(Sighting.id)).scalar() or 0
+    table = Sighting.__table__
+    rows = session.execute(
+        table.select()
+        .where(table.c.expire_timestamp < before)
+        .where(table.c.id <= counted_id)
+        .where(table.c.id < last_id)
+        .order_by(table.c.id)
+        .limit(batch_size)
+    ).fetchall()
+    if not rows:
+        session.rollback()
+        return 0
+    months = {}
+    for row in rows:
+        month = datetime.utcfromtimestamp(row.expire_timestamp) \
+            .strftime('sightings_%Y%m')
+        months.setdefault(month, []).append(dict(row))
+    for name, month_rows in sorted(months.items()):
+        archive = get_archive_table(name)
+        archive.create(bind=session.connection(), checkfirst=True)
+        # If another process moved some of them in the meantime, it fails
+        # and the whole batch is rolled back
+        session.execute(archive.insert(), month_rows)
+    for ids in chunks([row.id for row in rows]):
+        session.execute(table.delete().where(table.c.id.in_(ids)))
+    session.commit()
+    return len(rows)
+
+
+def get_session_stats(session):
+    query = session.query(
+        func.min(SightingBucket.min_timestamp),
+        func.max(SightingBucket.max_timestamp),
+        func.sum(SightingBucket.how_many),
+    )
+    query = filter_report_since(query, SightingBucket.timestamp, 300)
+    min_max_result = query.first()
     length_hours = (min_max_result[1] - min_max_result[0]) // 3600
     if length_hours == 0:
         length_hours = 1
+    count = int(min_max_result[2])
     # Convert to datetime
     return {
         'start': datetime.fromtimestamp(min_max_result[0]),
         'end': datetime.fromtimestamp(min_max_result[1]),
-        'count': min_max_result[2],
+        'count': count,
         'length_hours': length_hours,
-        'per_hour': min_max_result[2] / length_hours,
+        'per_hour': count / length_hours,
     }
 
 
 def get_punch_card(session):
-    if get_engine_name(session) == 'sqlite':
-        bigint = 'BIGINT'
-    else:
-        bigint = 'UNSIGNED'
-    query = session.execute('''
-        SELECT
-            CAST((expire_timestamp / 300) AS {bigint}) ts_date,
-            COUNT(*) how_many
-        FROM `sightings`
-        {report_since}
-        GROUP BY ts_date
-        ORDER BY ts_date
-    '''.format(bigint=bigint, report_since=get_since_query_part()))
-    results = query.fetchall()
-    results_dict = {r[0]: r[1] for r in results}
+    query = session.query(SightingBucket.timestamp, SightingBucket.how_many)
+    query = filter_report_since(query, SightingBucket.timestamp, 300)
+    results = query.order_by(SightingBucket.timestamp).all()
+    results_dict = {r[0] // 300: r[1] for r in results}
     filled = []
-    for row_no, i in enumerate(range(int(results[0][0]), int(results[-1][0]))):
+    for row_no, i in enumerate(
+        range(results[0][0] // 300, results[-1][0] // 300)
+    ):
         item = results_dict.get(i)
         filled.append((row_no, item if item else 0))
     return filled
 
 
+def get_pokemon_counts(session, pokemon_ids=None):
+    """Returns query for number of sightings of every Pokemon"""
+    how_many = func.sum(PokemonHourly.how_many).label('how_many')
+    query = session.query(PokemonHourly.pokemon_id, how_many)
+    if pokemon_ids is not None:
+        query = query.filter(PokemonHourly.pokemon_id.in_(pokemon_ids))
+    query = filter_report_since(query, PokemonHourly.timestamp, 3600)
+    return query.group_by(PokemonHourly.pokemon_id), how_many
+
+
 def get_top_pokemon(session, count=30, order='DESC'):
-    query = session.execute('''
-        SELECT
-            pokemon_id,
-            COUNT(*) how_many
-        FROM sightings
-        {report_since}
-        GROUP BY pokemon_id
-        ORDER BY how_many {order}
-        LIMIT {count}
-    '''.format(order=order, count=count, report_since=get_since_query_part()))
-    return query.fetchall()
+    query, how_many = get_pokemon_counts(session)
+    if order == 'DESC':
+        query = query.order_by(how_many.desc())
+    else:
+        query = query.order_by(how_many.asc())
+    return [(r[0], int(r[1])) for r in query.limit(count)]
 
 
 def get_stage2_pokemon(session):
-    result = []
     if not hasattr(config, 'STAGE2'):
         return []
-    for pokemon_id in config.STAGE2:
-        query = session.query(Sighting) \
-            .filter(Sighting.pokemon_id == pokemon_id)
-        if config.REPORT_SINCE:
-            query = query.filter(Sighting.expire_timestamp > get_since())
-        count = query.count()
-        if count > 0:
-            result.append((pokemon_id, count))
-    return result
+    query, how_many = get_pokemon_counts(session, config.STAGE2)
+    counts = dict(query.all())
+    return [
+        (pokemon_id, int(counts[pokemon_id]))
+        for pokemon_id in config.STAGE2
+        if counts.get(pokemon_id)
+    ]
 
 
 def get_nonexistent_pokemon(session):
     result = []
-    query = session.execute('''
-        SELECT DISTINCT pokemon_id FROM sightings
-        {report_since}
-    '''.format(report_since=get_since_query_part()))
-    db_ids = [r[0] for r in query.fetchall()]
+    query, how_many = get_pokemon_counts(session)
+    db_ids = [r[0] for r in query]
     for pokemon_id in range(1, 152):
         if pokemon_id not in db_ids:
             result.append(pokemon_id)
     return result
 
 
-def get_all_sightings(session, pokemon_ids):
-    # TODO: rename this and get_sightings
-    query = session.query(Sighting) \
-        .filter(Sighting.pokemon_id.in_(pokemon_ids))
-    if config.REPORT_SINCE:
-        query = query.filter(Sighting.expire_timestamp > get_since())
-    return query.all()
+def get_sighting_locations(session, pokemon_ids):
+    """Returns pokemon_id, lat, lon and count of every place given Pokemon
+    were seen at
+
+    Every place is returned once, no matter how many times Pokemon was seen
+    there.
+    """
+    query = session.query(
+        PokemonLocation.pokemon_id,
+        PokemonLocation.lat,
+        PokemonLocation.lon,
+        PokemonLocation.how_many,
+    ) \
+        .filter(PokemonLocation.pokemon_id.in_(pokemon_ids))
+    return filter_report_since(query, PokemonLocation.last_seen).all()
 
 
 def get_spawns_per_hour(session, pokemon_id):
-    if get_engine_name(session) == 'sqlite':
-        ts_hour = 'STRFTIME("%H", expire_timestamp)'
-    else:
-        ts_hour = 'HOUR(FROM_UNIXTIME(expire_timestamp))'
-    query = session.execute('''
-        SELECT
-            {ts_hour} AS ts_hour,
-            COUNT(*) AS how_many
-        FROM sightings
-        WHERE pokemon_id = {pokemon_id}
-        {report_since}
-        GROUP BY ts_hour
-        ORDER BY ts_hour
-    '''.format(
-        pokemon_id=pokemon_id,
-        ts_hour=ts_hour,
-        report_since=get_since_query_part(where=False)
-    ))
+    query = session.query(PokemonHourly.timestamp, PokemonHourly.how_many) \
+        .filter(PokemonHourly.pokemon_id == pokemon_id)
+    query = filter_report_since(query, PokemonHourly.timestamp, 3600)
+    hours = {}
+    for timestamp, how_many in query:
+        hour = time.localtime(timestamp).tm_hour
+        hours[hour] = hours.get(hour, 0) + how_many
     results = []
-    for result in query.fetchall():
+    for hour in sorted(hours):
         results.append((
             {
-                'v': [int(result[0]), 30, 0],
-                'f': '{}:00 - {}:00'.format(
-                    int(result[0]), int(result[0]) + 1
-                ),
+                'v': [hour, 30, 0],
+                'f': '{}:00 - {}:00'.format(hour, hour + 1),
             },
-            result[1]
+            hours[hour]
         ))
     return results
 
 
-def get_spawns_per_minute(session, pokemon_id=None):
-    # -90000 is 15 min, so the spawn time
-    if get_engine_name(session) == 'sqlite':
-        ts_hour = 'STRFTIME("%H", expire_timestamp)'
-        ts_minute= 'STRFTIME("%M", expire_timestamp-90000)'
-    else:
-        ts_hour = 'HOUR(FROM_UNIXTIME(expire_timestamp-90000))'
-        ts_minute = 'MINUTE(FROM_UNIXTIME(expire_timestamp-90000))'
+def get_total_spawns_count(session, pokemon_id):
+    query, how_many = get_pokemon_counts(session, [pokemon_id])
+    result = query.first()
+    return int(result[1]) if result else 0
 
-    if pokemon_id:
-        filter_for_pokemon = 'WHERE pokemon_id = ' + pokemon_id
-    else:
-        filter_for_pokemon = ''
 
-    query = session.execute('''
-        SELECT
-            lat,
-            lon,
-            {ts_hour} AS ts_hour,
-            {ts_minute} AS ts_minute,
-            COUNT(*) AS how_many
-        FROM sightings
-        {filter_for_pokemon}
-        GROUP BY
-            lat,
-            lon,
-            ts_hour,
-            ts_minute
-        ORDER BY
-            lat,
-            lon,
-            ts_hour,
-            ts_minute
-    '''.format(
-        filter_for_pokemon=filter_for_pokemon,
-        ts_hour=ts_hour,
-        ts_minute=ts_minute,
-        report_since=get_since_query_part(where=False)
-    ))
-    results = [[] for x in range(0,60*24)]
-    for elem in query.fetchall():
-        if elem['ts_hour'] and elem['ts_minute']:
-            hour = elem['ts_hour']
-            minute = elem['ts_minute']
-            results[hour*60+minute].append({
-                'lat': float(elem['lat']),
-                'lng': float(elem['lon']),
-                'weight': int(elem['how_many'])
-            })
-    return results
+def get_utc_offset(timestamp=None):
+    """Returns seconds to add to UTC timestamp to get local time at it
 
+    Current time is used by default.
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    timestamp = int(timestamp)
+    return calendar.timegm(time.localtime(timestamp)) - timestamp
 
-def get_total_spawns_count(session, pokemon_id):
-    query = session.execute('''
-        SELECT COUNT(id)
-        FROM sightings
-        WHERE pokemon_id = {pokemon_id}
-        {report_since}
-    '''.format(
-        pokemon_id=pokemon_id,
-        report_since=get_since_query_part(where=False)
-    ))
-    result = query.first()
-    return result[0]
 
+def get_utc_offset_changes(start, end):
+    """Returns (timestamp, offset) of every change of UTC offset (DST)
+    between two timestamps
 
-def get_all_spawn_coords(session, pokemon_id=None):
-    points = session.query(Sighting.lat, Sighting.lon, func.count())
+    The first one is offset at start. Offsets are checked at every full
+    hour, which is when they change.
+    """
+    hour = int(start) // 3600 * 3600
+    changes = [(hour, get_utc_offset(hour))]
+    while hour < end:
+        hour += 3600
+        offset = get_utc_offset(hour)
+        if offset != changes[-1][1]:
+            changes.append((hour, offset))
+    return changes
+
+
+def get_local_time_sql(expression, changes):
+    """Returns SQL adding UTC offset valid at every timestamp to it"""
+    if len(changes) == 1:
+        return '({} + {})'.format(expression, changes[0][1])
+    cases = ' '.join(
+        'WHEN {} < {} THEN {} + {}'.format(
+            expression, timestamp, expression, previous[1]
+        )
+        for previous, (timestamp, _) in zip(changes, changes[1:])
+    )
+    return '(CASE {} ELSE {} + {} END)'.format(
+        cases, expression, changes[-1][1]
+    )
+
+
+def iter_heatmap(session, pokemon_id=None, resolution=None, by_minute=False,
+                 with_archives=None):
+    """Yields (lat, lon, weight) of every place Pokemon were seen at
+
+    Rows are read from server-side cursor where database supports it, so
+    they never have to be all in memory. With resolution (in degrees),
+    coordinates are rounded to it and counted together. With by_minute,
+    rows start with minute of day Pokemon spawned at, and are ordered by it.
+    See get_sightings_source for with_archives.
+    """
+    columns = {'lat': 'lat', 'lon': 'lon'}
+    if resolution:
+        for name in columns:
+            columns[name] = 'ROUND({name} / {resolution!r}) * {resolution!r}' \
+                .format(name=name, resolution=float(resolution))
+    conditions = []
     if pokemon_id:
-        points = points.filter(Sighting.pokemon_id == int(pokemon_id))
+        conditions.append('pokemon_id = {}'.format(int(pokemon_id)))
     if config.REPORT_SINCE:
-        points = points.filter(Sighting.expire_timestamp > get_since())
-    points = points.group_by(Sighting.lat, Sighting.lon)
-    return points.all()
+        conditions.append('expire_timestamp > {}'.format(get_since()))
+    where = 'WHERE ' + ' AND '.join(conditions) if conditions else ''
+    source = get_sightings_source(session, with_archives)
+    if by_minute:
+        # Pokemon spawn 15 minutes before they expire, and local time
+        # depends on DST in effect back then
+        start, end = session.execute(
+            'SELECT MIN(expire_timestamp), MAX(expire_timestamp) '
+            'FROM {} {}'.format(source, where)
+        ).first()
+        if start is None:
+            start = end = time.time()
+        local_time = get_local_time_sql(
+            '(expire_timestamp - 900)',
+            get_utc_offset_changes(start - 900, end - 900),
+        )
+        divide = '/' if get_engine_name(session) == 'sqlite' else 'DIV'
+        minute = '({local_time} % 86400) {divide} 60'.format(
+            local_time=local_time, divide=divide
+        )
+    else:
+        minute = '0'
+    connection = session.connection().execution_options(stream_results=True)
+    result = connection.execute('''
+        SELECT
+            {minute} AS minute_of_day,
+            {lat} AS heat_lat,
+            {lon} AS heat_lon,
+            COUNT(*) AS how_many
+        FROM {source}
+        {where}
+        GROUP BY minute_of_day, heat_lat, heat_lon
+        {order_by}
+    '''.format(
+        minute=minute,
+        source=source,
+        lat=columns['lat'],
+        lon=columns['lon'],
+        where=where,
+        order_by='ORDER BY minute_of_day' if by_minute else '',
+    ))
+    try:
+        for row in result:
+            point = (float(row[1]), float(row[2]), int(row[3]))
+            if by_minute:
+                point = (int(row[0]),) + point
+            yield point
+    finally:
+        result.close()
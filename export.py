@@ -0,0 +1,212 @@
+"""Exporting gathered data for offline analysis
+
+Tables are read from the database in batches, in order of ids, and saved as
+compressed NumPy files (.npz), one array per column. Sightings and fort
+sightings are split into directories named after the UTC day they're
+from, forts are saved as they are:
+
+    exports/sightings/2016-07-30/1-52341.npz
+    exports/fort_sightings/2016-07-30/1-3921.npz
+    exports/forts/1-812.npz
+
+Files are named after the first and the last id they contain. Id of the
+last exported row of every table is kept in state.json, so that next
+export only adds files with rows added in the meantime. Sightings moved
+to archive tables are read from there, so archiving doesn't have to wait
+for the export. Run it with
+`python manage.py export`, preferably against a replica of the database.
+"""
+from datetime import datetime
+import json
+import os
+
+import numpy as np
+
+import db
+
+
+# Table -> column used to split rows into days, and columns with their types.
+# Missing values are saved as 0 (numbers) or empty strings.
+TABLES = {
+    'sightings': ('expire_timestamp', (
+        ('id', np.int64),
+        ('pokemon_id', np.int16),
+        ('spawn_id', str),
+        ('expire_timestamp', np.int64),
+        ('encounter_id', str),
+        ('normalized_timestamp', np.int64),
+        ('lat', np.float64),
+        ('lon', np.float64),
+    )),
+    'forts': (None, (
+        ('id', np.int64),
+        ('external_id', str),
+        ('lat', np.float64),
+        ('lon', np.float64),
+    )),
+    'fort_sightings': ('last_modified', (
+        ('id', np.int64),
+        ('fort_id', np.int64),
+        ('last_modified', np.int64),
+        ('team', np.int8),
+        ('prestige', np.int32),
+        ('guard_pokemon_id', np.int16),
+    )),
+}
+# Rows are read from the database in batches of that size
+FETCH_SIZE = 10000
+STATE_FILE = 'state.json'
+
+
+def to_arrays(rows, columns):
+    """Returns dict of column name -> array made of given rows"""
+    arrays = {}
+    for (name, dtype), values in zip(columns, zip(*rows)):
+        if dtype is str:
+            arrays[name] = np.array(
+                ['' if v is None else str(v) for v in values]
+            )
+        else:
+            values = [0 if v is None else v for v in values]
+            arrays[name] = np.array(values).astype(dtype)
+    return arrays
+
+
+def get_day(timestamp):
+    return datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+class Exporter(object):
+    """Writes new rows of tables to chunk files in given directory
+
+    At most chunk_size rows are kept in memory at once. When there's that
+    many, all of them are written and state is saved.
+    """
+    def __init__(self, directory, chunk_size=1000000):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.state_path = os.path.join(directory, STATE_FILE)
+        self.state = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+
+    def save_state(self):
+        temp_path = self.state_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.rename(temp_path, self.state_path)
+
+    def remove_unfinished(self, table):
+        """Removes files written after state was saved for the last time
+
+        They'd be written again, possibly with different ranges of ids.
+        """
+        last_id = self.state.get(table, 0)
+        table_directory = os.path.join(self.directory, table)
+        for root, _, files in os.walk(table_directory):
+            for name in files:
+                first_id = name.split('-')[0]
+                if not first_id.isdigit() or int(first_id) > last_id:
+                    os.remove(os.path.join(root, name))
+
+    def write(self, table, group, arrays):
+        ids = arrays['id']
+        parts = [self.directory, table]
+        if group:
+            parts.append(group)
+        directory = os.path.join(*parts)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        name = '{}-{}.npz'.format(ids[0], ids[-1])
+        # Written under temporary name, so nobody reads half of the file
+        temp_path = os.path.join(directory, 'tmp-' + name)
+        np.savez_compressed(temp_path, **arrays)
+        os.rename(temp_path, os.path.join(directory, name))
+
+    def flush(self, table, buffers):
+        """Writes buffered rows of every day to files"""
+        for group, parts in sorted(buffers.items()):
+            arrays = {
+                name: np.concatenate([p[name] for p in parts])
+                for name in parts[0]
+            }
+            self.write(table, group, arrays)
+        buffers.clear()
+
+    def export(self, session, table):
+        """Writes rows added since the last export of given table
+
+        Returns number of exported rows.
+        """
+        day_column, columns = TABLES[table]
+        self.remove_unfinished(table)
+        names = [name for name, _ in columns]
+        if table == 'sightings':
+            archives = db.get_archive_names(session)
+        last_id = int(self.state.get(table, 0))
+        buffers = {}
+        buffered = 0
+        exported = 0
+        while True:
+            if table == 'sightings':
+                rows = db.get_sightings_after(
+                    session, names, last_id, FETCH_SIZE, archives
+                )
+            else:
+                rows = db.get_rows_after(
+                    session, table, names, last_id, FETCH_SIZE
+                )
+            if not rows:
+                break
+            arrays = to_arrays(rows, columns)
+            if day_column:
+                days = arrays[day_column] // 86400
+                for day in np.unique(days):
+                    mask = days == day
+                    group = get_day(int(day) * 86400)
+                    buffers.setdefault(group, []).append({
+                        name: values[mask]
+                        for name, values in arrays.items()
+                    })
+            else:
+                buffers.setdefault(None, []).append(arrays)
+            last_id = int(arrays['id'][-1])
+            buffered += len(rows)
+            exported += len(rows)
+            if buffered >= self.chunk_size:
+                self.flush(table, buffers)
+                self.state[table] = last_id
+                self.save_state()
+                buffered = 0
+        if buffers:
+            self.flush(table, buffers)
+            self.state[table] = last_id
+            self.save_state()
+        return exported
+
+    def export_all(self, session, tables=None):
+        """Exports given tables (all by default)
+
+        Returns dict of table -> number of exported rows.
+        """
+        return {
+            table: self.export(session, table)
+            for table in tables or sorted(TABLES)
+        }
+
+
+def iter_chunks(directory, table):
+    """Yields dicts of column -> array of every exported file of a table
+
+    Files are read in order of ids.
+    """
+    paths = []
+    for root, _, files in os.walk(os.path.join(directory, table)):
+        for name in files:
+            first_id = name.split('-')[0]
+            if name.endswith('.npz') and first_id.isdigit():
+                paths.append((int(first_id), os.path.join(root, name)))
+    for _, path in sorted(paths):
+        with np.load(path) as data:
+            yield {name: data[name] for name in data.files}
@@ -1,34 +1,43 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
 
-from flask import Flask, render_template
+from flask import Blueprint, Flask, render_template
 
 from names import POKEMON_NAMES
-from web import get_args  # pretty handy function, actually
+from web import get_args, remove_session  # pretty handy, actually
+import cache
 import config
 import db
 import utils
 
 
-app = Flask(__name__, template_folder='templates')
+blueprint = Blueprint('gyms', __name__)
 
 
-CACHE = {
-    'data': None,
-    'generated_at': None,
-}
+def create_app():
+    """Returns the application, see web.create_app"""
+    app = Flask(__name__, template_folder='templates')
+    app.register_blueprint(blueprint)
+    app.teardown_appcontext(remove_session)
+    return app
 
 
+def get_fort_sighting_id():
+    return db.get_max_ids(db.ScopedSession())[1]
+
+
+# Recomputed when gyms change, but not more often than once a minute
+stats_cache = cache.ResponseCache(
+    ttl=15 * 60,
+    max_size=1,
+    version_func=get_fort_sighting_id,
+    version_interval=60,
+)
+
+
+@stats_cache.cached()
 def get_stats():
-    cache_valid = (
-        CACHE['data'] and
-        CACHE['generated_at'] > datetime.now() - timedelta(minutes=15)
-    )
-    if cache_valid:
-        return CACHE['data']
-    session = db.Session()
-    forts = db.get_forts(session)
-    session.close()
+    forts = db.get_forts(db.ScopedSession())
     count = {t.value: 0 for t in db.Team}
     strongest = {t.value: None for t in db.Team}
     guardians = {t.value: {} for t in db.Team}
@@ -79,8 +88,7 @@ def get_stats():
                 reverse=True
             )[0]
             top_guardians[team.value] = POKEMON_NAMES[pokemon_id]
-    CACHE['generated_at'] = datetime.now()
-    CACHE['data'] = {
+    return {
         'order': sorted(count, key=count.__getitem__, reverse=True),
         'count': count,
         'total_count': len(forts),
@@ -90,12 +98,11 @@ def get_stats():
         'percentages': percentages,
         'last_date': last_date,
         'top_guardians': top_guardians,
-        'generated_at': CACHE['generated_at'],
+        'generated_at': datetime.now(),
     }
-    return CACHE['data']
 
 
-@app.route('/')
+@blueprint.route('/')
 def index():
     stats = get_stats()
     team_names = {k.value: k.name.title() for k in db.Team}
@@ -114,4 +121,4 @@ def index():
 
 if __name__ == '__main__':
     args = get_args()
-    app.run(debug=True, host=args.host, port=args.port)
+    create_app().run(debug=args.debug, host=args.host, port=args.port)
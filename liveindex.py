@@ -0,0 +1,187 @@
+"""In-memory copy of what's currently on the map
+
+Web server keeps active sightings and current state of forts in memory,
+refreshed in the background with only the changes since the last refresh,
+so that /data requests don't have to touch the database at all.
+"""
+from collections import deque
+import logging
+import math
+import threading
+import time
+
+import db
+
+
+logger = logging.getLogger(__name__)
+
+
+class LiveIndex(object):
+    """Markers bucketed in a grid, so that viewport queries are cheap
+
+    Every entry remembers id of the row it was made of (sighting id for
+    Pokemon, fort sighting id for forts), which allows answering "what
+    changed since cursor" with the same cursors /data uses without it.
+    """
+    CELL_SIZE = 0.01  # degrees, roughly 1 km
+    # Expired Pokemon are remembered for a while, so that clients can be
+    # told to remove them
+    KEEP_EXPIRED = 15 * 60
+
+    def __init__(self, pokemon_to_marker, fort_to_marker, interval=5):
+        self.pokemon_to_marker = pokemon_to_marker
+        self.fort_to_marker = fort_to_marker
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.cells = {}
+        self.locations = {}
+        # Expiry slot -> ids of Pokemon markers expiring in that slot
+        self.expiry = {}
+        self.expired = deque()
+        self.sighting_id = 0
+        self.fort_sighting_id = 0
+        self.refreshed_at = 0
+        self.thread = None
+
+    def start(self):
+        """Starts refreshing in the background, if it's not done already"""
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(
+                target=self.run, name='live-index'
+            )
+            self.thread.daemon = True
+        # First refresh is done right away, so that nobody gets empty map
+        self.refresh()
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception('Failed to refresh live index')
+
+    def _cell(self, lat, lon):
+        return (
+            int(math.floor(lat / self.CELL_SIZE)),
+            int(math.floor(lon / self.CELL_SIZE)),
+        )
+
+    def refresh(self):
+        session = db.Session()
+        sighting_id, fort_sighting_id = db.get_max_ids(session)
+        pokemons = db.get_sightings_since(
+            session, self.sighting_id, sighting_id
+        )
+        forts = db.get_forts_since(
+            session, self.fort_sighting_id, fort_sighting_id
+        )
+        session.close()
+        with self.lock:
+            for pokemon in pokemons:
+                marker = self.pokemon_to_marker(pokemon)
+                self._put(marker, pokemon.id)
+                slot = db.normalize_timestamp(pokemon.expire_timestamp)
+                self.expiry.setdefault(slot, []).append(marker['id'])
+            for fort in forts:
+                self._put(self.fort_to_marker(fort), fort['id'])
+            self._drop_expired()
+            self.sighting_id = sighting_id
+            self.fort_sighting_id = fort_sighting_id
+            self.refreshed_at = int(time.time())
+
+    def _put(self, marker, row_id):
+        lat = float(marker['lat'])
+        lon = float(marker['lon'])
+        cell = self._cell(lat, lon)
+        previous = self.locations.get(marker['id'])
+        if previous and previous != cell:
+            del self.cells[previous][marker['id']]
+        self.cells.setdefault(cell, {})[marker['id']] = (
+            row_id, lat, lon, marker
+        )
+        self.locations[marker['id']] = cell
+
+    def _drop_expired(self):
+        now = time.time()
+        for slot in [s for s in self.expiry if s < now]:
+            still_active = []
+            for marker_id in self.expiry[slot]:
+                cell = self.locations[marker_id]
+                row_id, lat, lon, marker = self.cells[cell][marker_id]
+                if marker['expires_at'] > now:
+                    still_active.append(marker_id)
+                    continue
+                del self.cells[cell][marker_id]
+                del self.locations[marker_id]
+                self.expired.append(
+                    (marker['expires_at'], row_id, lat, lon, marker_id)
+                )
+            if still_active:
+                self.expiry[slot] = still_active
+            else:
+                del self.expiry[slot]
+        while self.expired and self.expired[0][0] < now - self.KEEP_EXPIRED:
+            self.expired.popleft()
+
+    def _get_cells(self, bounds):
+        if not bounds:
+            return list(self.cells.values())
+        south, west = self._cell(bounds[0], bounds[1])
+        north, east = self._cell(bounds[2], bounds[3])
+        if (north - south + 1) * (east - west + 1) > len(self.cells):
+            return [
+                cell for key, cell in self.cells.items()
+                if south <= key[0] <= north and west <= key[1] <= east
+            ]
+        return [
+            self.cells[(i, j)]
+            for i in range(south, north + 1)
+            for j in range(west, east + 1)
+            if (i, j) in self.cells
+        ]
+
+    def query(self, bounds=None, since=None, with_pokemon=True):
+        """Returns markers within bounds, expired ids and a new cursor
+
+        Bounds are (south, west, north, east). With since - a tuple of
+        sighting id, fort sighting id and timestamp - only markers changed
+        after it, and Pokemon that expired after it, are returned.
+        """
+        def in_bounds(lat, lon):
+            return not bounds or (
+                bounds[0] <= lat <= bounds[2] and
+                bounds[1] <= lon <= bounds[3]
+            )
+        markers = []
+        expired = []
+        with self.lock:
+            for cell in self._get_cells(bounds):
+                for row_id, lat, lon, marker in cell.values():
+                    is_pokemon = marker['type'] == 'pokemon'
+                    if is_pokemon and not with_pokemon:
+                        continue
+                    if not in_bounds(lat, lon):
+                        continue
+                    if since and row_id <= since[0 if is_pokemon else 1]:
+                        continue
+                    markers.append(marker)
+            if since:
+                for expires_at, row_id, lat, lon, marker_id in self.expired:
+                    is_known = expires_at > since[2] and row_id <= since[0]
+                    if is_known and in_bounds(lat, lon):
+                        expired.append(marker_id)
+            # Other processes may be ahead, cursor must never go back
+            cursor = '{}-{}-{}'.format(
+                max(self.sighting_id, since[0] if since else 0),
+                max(self.fort_sighting_id, since[1] if since else 0),
+                self.refreshed_at,
+            )
+        return markers, expired, cursor
+
+    def __len__(self):
+        with self.lock:
+            return len(self.locations)
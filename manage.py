@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""Maintenance commands, run them as `python manage.py <command>`"""
+import argparse
+
+import db
+import analytics
+import config
+import export
+import rollups
+import spawnpoints
+import tiles
+import utils
+
+
+def build_plan(args):
+    plan = utils.ScanPlan.build()
+    path = plan.save()
+    print('Saved {points} points of {workers} workers to {path}'.format(
+        points=sum(len(p) for p in plan.points),
+        workers=len(plan.points),
+        path=path,
+    ))
+
+
+def rebuild_fort_state(args):
+    session = db.Session()
+    count = db.rebuild_fort_state(session)
+    session.close()
+    print('Saved current state of {} forts'.format(count))
+
+
+def update_rollups(args):
+    count = rollups.RollupJob().update()
+    print('Added {} sightings to report tables'.format(count))
+
+
+def archive_sightings(args):
+    job = rollups.RollupJob(archive_after=args.days)
+    if not job.archive_after:
+        print('Set ARCHIVE_AFTER_DAYS or use --days')
+        return
+    count = job.archive()
+    print('Moved {} sightings to archive tables'.format(count))
+
+
+def update_analytics(args):
+    session = db.Session()
+    try:
+        count = analytics.Analytics().update(session)
+    finally:
+        session.close()
+    print('Added {} sightings to analytics files'.format(count))
+
+
+def update_spawnpoints(args):
+    count = spawnpoints.update_all(args.batch_size)
+    print('Added {} sightings to spawnpoints table'.format(count))
+
+
+def export_data(args):
+    if args.db:
+        session = db.Session(bind=db.get_engine(args.db))
+    else:
+        session = db.Session()
+    exporter = export.Exporter(args.directory, args.chunk_size)
+    try:
+        counts = exporter.export_all(session, args.tables)
+    finally:
+        session.close()
+    for table, count in sorted(counts.items()):
+        print('Exported {} rows of {}'.format(count, table))
+
+
+def pregenerate_tiles(args):
+    count = tiles.TileRenderer().pregenerate(
+        args.species,
+        range(args.min_zoom, args.max_zoom + 1),
+        config.MAP_START,
+        config.MAP_END,
+    )
+    print('Rendered {} tiles'.format(count))
+
+
+def species(value):
+    return value if value == 'all' else int(value)
+
+
+def get_args():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    build = subparsers.add_parser(
+        'build-plan',
+        help='Compute points of every worker together with their cell ids',
+    )
+    build.set_defaults(func=build_plan)
+    rebuild = subparsers.add_parser(
+        'rebuild-fort-state',
+        help='Fill fort_state table using gathered fort sightings',
+    )
+    rebuild.set_defaults(func=rebuild_fort_state)
+    rollup = subparsers.add_parser(
+        'update-rollups',
+        help='Count sightings not yet included in reports',
+    )
+    rollup.set_defaults(func=update_rollups)
+    archive = subparsers.add_parser(
+        'archive-sightings',
+        help='Move old sightings to monthly archive tables',
+    )
+    archive.add_argument(
+        '--days',
+        type=float,
+        help='Move sightings older than that (instead of ARCHIVE_AFTER_DAYS)',
+    )
+    archive.set_defaults(func=archive_sightings)
+    analytics_parser = subparsers.add_parser(
+        'update-analytics',
+        help='Append new sightings to files reports are computed from',
+    )
+    analytics_parser.set_defaults(func=update_analytics)
+    spawns = subparsers.add_parser(
+        'update-spawnpoints',
+        help='Compute spawn points using sightings not processed yet',
+    )
+    spawns.add_argument(
+        '--batch-size',
+        type=int,
+        help='Number of sightings processed at once',
+    )
+    spawns.set_defaults(func=update_spawnpoints)
+    exporting = subparsers.add_parser(
+        'export',
+        help='Save rows added since the previous export to .npz files',
+    )
+    exporting.add_argument(
+        '--tables',
+        nargs='+',
+        choices=sorted(export.TABLES),
+        help='Tables to export (all by default)',
+    )
+    exporting.add_argument('--directory', default='exports')
+    exporting.add_argument(
+        '--db',
+        help='Database to read from instead of DB_ENGINE, e.g. a replica',
+    )
+    exporting.add_argument(
+        '--chunk-size',
+        type=int,
+        default=1000000,
+        help='Number of rows kept in memory before writing them',
+    )
+    exporting.set_defaults(func=export_data)
+    pregen = subparsers.add_parser(
+        'pregen-tiles',
+        help='Render density tiles of the area between MAP_START and MAP_END',
+    )
+    pregen.add_argument(
+        '--species',
+        type=species,
+        default='all',
+        help='Pokemon id or "all" (default)',
+    )
+    pregen.add_argument('--min-zoom', type=int, default=10)
+    pregen.add_argument('--max-zoom', type=int, default=16)
+    pregen.set_defaults(func=pregenerate_tiles)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    args.func(args)
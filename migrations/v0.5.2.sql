@@ -0,0 +1,17 @@
+# Sightings are deduplicated by unique (encounter_id, normalized_timestamp)
+# key now. Existing duplicates have to be removed before it can be added.
+# The first sighting of every Pokemon is found in one pass and everything
+# else is deleted by primary key, instead of joining sightings with
+# themselves on columns without an index.
+CREATE TEMPORARY TABLE `sightings_to_keep` (PRIMARY KEY (`id`))
+    SELECT MIN(id) AS id FROM `sightings`
+    WHERE encounter_id IS NOT NULL
+    GROUP BY encounter_id, normalized_timestamp;
+DELETE s FROM `sightings` s
+    LEFT JOIN `sightings_to_keep` k ON k.id = s.id
+    WHERE s.encounter_id IS NOT NULL AND k.id IS NULL;
+DROP TEMPORARY TABLE `sightings_to_keep`;
+ALTER TABLE `sightings` ADD UNIQUE INDEX `timestamp_encounter_id_unique` (`encounter_id`, `normalized_timestamp`);
+# SQLite doesn't support DELETE with JOIN, use these two instead:
+# DELETE FROM sightings WHERE encounter_id IS NOT NULL AND id NOT IN (SELECT MIN(id) FROM sightings WHERE encounter_id IS NOT NULL GROUP BY encounter_id, normalized_timestamp);
+# CREATE UNIQUE INDEX timestamp_encounter_id_unique ON sightings (encounter_id, normalized_timestamp);
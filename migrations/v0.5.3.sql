@@ -0,0 +1,14 @@
+# Current state of every fort is kept in its own table. After creating it,
+# fill it using `python manage.py rebuild-fort-state`.
+CREATE TABLE `fort_state` (
+    `fort_id` INTEGER NOT NULL,
+    `fort_sighting_id` INTEGER,
+    `last_modified` INTEGER,
+    `team` INTEGER,
+    `prestige` INTEGER,
+    `guard_pokemon_id` INTEGER,
+    `lat` VARCHAR(20),
+    `lon` VARCHAR(20),
+    PRIMARY KEY (`fort_id`),
+    FOREIGN KEY (`fort_id`) REFERENCES `forts` (`id`)
+);
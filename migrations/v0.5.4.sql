@@ -0,0 +1,30 @@
+# Reports are made of counts kept in rollup tables. After creating them,
+# fill them using `python manage.py update-rollups`.
+CREATE TABLE `rollup_state` (
+    `name` VARCHAR(32) NOT NULL,
+    `last_id` INTEGER,
+    PRIMARY KEY (`name`)
+);
+CREATE TABLE `pokemon_hourly` (
+    `pokemon_id` INTEGER NOT NULL,
+    `timestamp` INTEGER NOT NULL,
+    `how_many` INTEGER,
+    PRIMARY KEY (`pokemon_id`, `timestamp`)
+);
+CREATE TABLE `sighting_buckets` (
+    `timestamp` INTEGER NOT NULL,
+    `how_many` INTEGER,
+    `min_timestamp` INTEGER,
+    `max_timestamp` INTEGER,
+    PRIMARY KEY (`timestamp`)
+);
+CREATE TABLE `pokemon_locations` (
+    `pokemon_id` INTEGER NOT NULL,
+    `lat` VARCHAR(20) NOT NULL,
+    `lon` VARCHAR(20) NOT NULL,
+    `how_many` INTEGER,
+    `first_seen` INTEGER,
+    `last_seen` INTEGER,
+    PRIMARY KEY (`pokemon_id`, `lat`, `lon`)
+);
+CREATE INDEX `ix_pokemon_locations_last_seen` ON `pokemon_locations` (`last_seen`);
@@ -0,0 +1,16 @@
+# Spawn points computed from sightings. After creating the table, fill it
+# using `python manage.py update-spawnpoints`.
+CREATE TABLE `spawnpoints` (
+    `spawn_id` VARCHAR(32) NOT NULL,
+    `lat` DOUBLE,
+    `lon` DOUBLE,
+    `spawn_offset` INTEGER,
+    `offset_sin` DOUBLE,
+    `offset_cos` DOUBLE,
+    `observations` INTEGER,
+    `first_seen` INTEGER,
+    `last_seen` INTEGER,
+    `species` TEXT,
+    PRIMARY KEY (`spawn_id`)
+);
+CREATE INDEX `ix_spawnpoints_last_seen` ON `spawnpoints` (`last_seen`);
@@ -0,0 +1,103 @@
+"""Keeping report tables up to date
+
+Reports read counts from rollup tables instead of going over all sightings
+every time. RollupJob adds sightings to them in the background, picking up
+where it stopped the last time, so the initial run on a big database may
+take a while - it can be done upfront with `python manage.py update-rollups`.
+
+It also keeps spawnpoints table up to date, and with ARCHIVE_AFTER_DAYS
+set, moves sightings older than that to monthly archive tables afterwards,
+once they're counted in both.
+"""
+import logging
+import threading
+import time
+
+import config
+import db
+import spawnpoints
+
+
+logger = logging.getLogger(__name__)
+
+
+class RollupJob(object):
+    """Processes new sightings every interval seconds"""
+    def __init__(self, interval=None, batch_size=None, archive_after=None):
+        self.interval = interval or getattr(config, 'ROLLUP_INTERVAL', 60)
+        self.batch_size = batch_size or getattr(
+            config, 'ROLLUP_BATCH_SIZE', 10000
+        )
+        self.archive_after = archive_after or getattr(
+            config, 'ARCHIVE_AFTER_DAYS', None
+        )
+        self.archive_batch_size = getattr(config, 'ARCHIVE_BATCH_SIZE', 10000)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.processed = 0
+        self.processed_spawnpoints = 0
+
+    def start(self):
+        """Starts working in the background, if it's not done already"""
+        with self.lock:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, name='rollups')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.update()
+            except Exception:
+                logger.exception('Failed to update rollup tables')
+            try:
+                self.processed_spawnpoints += spawnpoints.update_all()
+            except Exception:
+                logger.exception('Failed to update spawnpoints')
+            try:
+                self.archive()
+            except Exception:
+                logger.exception('Failed to archive sightings')
+            time.sleep(self.interval)
+
+    def update(self):
+        """Processes batches of sightings until there are no new ones
+
+        Returns number of processed sightings.
+        """
+        session = db.Session()
+        processed = 0
+        try:
+            while True:
+                count = db.update_rollups(session, self.batch_size)
+                processed += count
+                self.processed += count
+                if count < self.batch_size:
+                    break
+        finally:
+            session.close()
+        return processed
+
+    def archive(self):
+        """Moves sightings older than archive_after days to archive tables
+
+        Returns number of moved sightings.
+        """
+        if not self.archive_after:
+            return 0
+        before = int(time.time() - self.archive_after * 86400)
+        session = db.Session()
+        moved = 0
+        try:
+            while True:
+                count = db.archive_sightings(
+                    session, before, self.archive_batch_size
+                )
+                moved += count
+                if count < self.archive_batch_size:
+                    break
+        finally:
+            session.close()
+        return moved
@@ -0,0 +1,150 @@
+"""Deciding in which order workers visit their points
+
+Spawn points spawn a Pokemon at the same minute of every hour, and it
+stays on the map for 15 minutes. Knowing when that happens, it's better to
+visit points shortly after something spawned there instead of walking over
+all of them in order.
+"""
+import math
+import time
+
+import config
+
+
+SPAWN_DURATION = 15 * 60
+# Visiting a point right after the spawn is risky - server may not be aware
+# of the Pokemon yet
+VISIT_DELAY = 10
+# There's no point in visiting if Pokemon is about to disappear
+MIN_TIME_LEFT = 60
+
+
+def get_spawn_offset(expire_timestamp):
+    """Returns second of hour at which Pokemon with such expiry spawned"""
+    return int(expire_timestamp - SPAWN_DURATION) % 3600
+
+
+class PointIndex(object):
+    """Grid index for finding point closest to given coordinates"""
+    def __init__(self, points, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        for index, point in enumerate(points):
+            self.cells.setdefault(self._cell(point), []).append(
+                (index, point)
+            )
+
+    def _cell(self, point):
+        return (
+            int(math.floor(point[0] / self.cell_size)),
+            int(math.floor(point[1] / self.cell_size)),
+        )
+
+    def find(self, lat, lon):
+        """Returns index of the closest point in neighbouring cells"""
+        cell_lat, cell_lon = self._cell((lat, lon))
+        best = None
+        best_distance = None
+        for i in (cell_lat - 1, cell_lat, cell_lat + 1):
+            for j in (cell_lon - 1, cell_lon, cell_lon + 1):
+                for index, point in self.cells.get((i, j), []):
+                    distance = (
+                        (point[0] - lat) ** 2 + (point[1] - lon) ** 2
+                    )
+                    if best is None or distance < best_distance:
+                        best = index
+                        best_distance = distance
+        return best
+
+
+class SpawnScheduler(object):
+    """Picks next point to visit for one worker
+
+    Points where something spawned since the last visit go first, the one
+    with Pokemon expiring soonest at the top. When nothing is due, point
+    visited least recently is picked, so that points without known spawns
+    are explored as well.
+    """
+    def __init__(self, points):
+        self.points = points
+        self.offsets = [set() for _ in points]
+        self.last_visit = [0] * len(points)
+        self.known_spawns = set()
+        # SCAN_RADIUS expressed in degrees, roughly
+        radius = config.SCAN_RADIUS / 111320.0
+        self.index = PointIndex(points, radius * 2)
+
+    def add_spawn(self, spawn_id, lat, lon, expire_timestamp):
+        """Assigns spawn point to the closest of worker's points
+
+        Returns False if spawn point isn't in worker's area.
+        """
+        if spawn_id in self.known_spawns:
+            return True
+        index = self.index.find(float(lat), float(lon))
+        if index is None:
+            return False
+        self.known_spawns.add(spawn_id)
+        self.offsets[index].add(get_spawn_offset(expire_timestamp))
+        return True
+
+    def get_pending(self, index, now):
+        """Returns expiry of the earliest Pokemon not seen at point yet"""
+        earliest = None
+        for offset in self.offsets[index]:
+            # Most recent spawn of that spawn point
+            spawned_at = now - (now - offset) % 3600
+            expires_at = spawned_at + SPAWN_DURATION
+            pending = (
+                spawned_at > self.last_visit[index] and
+                now - spawned_at >= VISIT_DELAY and
+                expires_at - now >= MIN_TIME_LEFT
+            )
+            if pending and (earliest is None or expires_at < earliest):
+                earliest = expires_at
+        return earliest
+
+    def next_point(self, now=None):
+        """Returns next point to visit and marks it as visited"""
+        now = now or time.time()
+        best = None
+        best_expiry = None
+        for index in range(len(self.points)):
+            expires_at = self.get_pending(index, now)
+            if expires_at is None:
+                continue
+            if best is None or expires_at < best_expiry:
+                best = index
+                best_expiry = expires_at
+        if best is None:
+            best = min(
+                range(len(self.points)), key=self.last_visit.__getitem__
+            )
+        self.last_visit[best] = now
+        return self.points[best]
+
+    @property
+    def known_points(self):
+        return sum(1 for offsets in self.offsets if offsets)
+
+
+def get_schedulers(points, spawns):
+    """Returns scheduler for every worker, with known spawns assigned
+
+    Every spawn point goes to the worker owning the closest point.
+    """
+    schedulers = [SpawnScheduler(worker_points) for worker_points in points]
+    owners = []
+    flat = []
+    for worker_no, worker_points in enumerate(points):
+        owners.extend([worker_no] * len(worker_points))
+        flat.extend(worker_points)
+    index = PointIndex(flat, config.SCAN_RADIUS / 111320.0 * 2)
+    for spawn_id, lat, lon, expire_timestamp in spawns:
+        closest = index.find(float(lat), float(lon))
+        if closest is None:
+            continue
+        schedulers[owners[closest]].add_spawn(
+            spawn_id, lat, lon, expire_timestamp
+        )
+    return schedulers
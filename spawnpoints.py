@@ -0,0 +1,204 @@
+"""Computing spawnpoints table out of sightings
+
+Every spawn point spawns Pokemon at the same second of every hour, always
+at the same place. Sightings are read in big batches straight into NumPy
+arrays and grouped by spawn id there, so that even tens of millions of
+them are processed in minutes. Like rollups, it picks up where it stopped
+the last time - run it with `python manage.py update-spawnpoints`.
+"""
+import json
+import math
+
+import numpy as np
+
+import config
+import db
+from scheduler import SPAWN_DURATION
+
+
+STATE_NAME = 'spawnpoints'
+# Pokemon ids are packed together with spawn point index in one number
+MAX_POKEMON_ID = 1024
+# Rows are fetched from the cursor in parts of that size
+FETCH_SIZE = 50000
+
+
+def fetch_sightings(session, last_id, batch_size):
+    """Returns arrays with sightings following last_id
+
+    Rows are read using DB-API cursor, without creating any objects per
+    row besides tuples returned by the driver.
+    """
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute('''
+            SELECT id, pokemon_id, spawn_id, expire_timestamp, lat, lon
+            FROM sightings
+            WHERE id > {last_id} AND spawn_id IS NOT NULL
+            ORDER BY id
+            LIMIT {batch_size}
+        '''.format(last_id=int(last_id), batch_size=int(batch_size)))
+        rows = []
+        while True:
+            part = cursor.fetchmany(FETCH_SIZE)
+            if not part:
+                break
+            rows.extend(part)
+    finally:
+        cursor.close()
+    if not rows:
+        return None
+    ids, pokemon_ids, spawn_ids, expire_timestamps, lats, lons = zip(*rows)
+    return {
+        'id': np.array(ids, dtype=np.int64),
+        'pokemon_id': np.array(pokemon_ids, dtype=np.int64),
+        'spawn_id': np.array(spawn_ids),
+        'expire_timestamp': np.array(expire_timestamps, dtype=np.int64),
+        'lat': np.array(lats, dtype=np.float64),
+        'lon': np.array(lons, dtype=np.float64),
+    }
+
+
+def summarize(sightings):
+    """Groups arrays of sightings by spawn id
+
+    Returns dict of spawn id -> partial row of spawnpoints table.
+    """
+    spawn_ids, inverse = np.unique(sightings['spawn_id'], return_inverse=True)
+    size = len(spawn_ids)
+    observations = np.bincount(inverse, minlength=size)
+    lat_sum = np.bincount(inverse, sightings['lat'], size)
+    lon_sum = np.bincount(inverse, sightings['lon'], size)
+    # Offsets are angles on a one hour long circle, so that 59:50 and 00:10
+    # average to 00:00 instead of 30:00
+    offsets = (sightings['expire_timestamp'] - SPAWN_DURATION) % 3600
+    angles = offsets * (2 * math.pi / 3600)
+    offset_sin = np.bincount(inverse, np.sin(angles), size)
+    offset_cos = np.bincount(inverse, np.cos(angles), size)
+
+    order = np.argsort(inverse, kind='mergesort')
+    starts = np.concatenate(([0], np.cumsum(observations)[:-1]))
+    expire_timestamps = sightings['expire_timestamp'][order]
+    first_seen = np.minimum.reduceat(expire_timestamps, starts)
+    last_seen = np.maximum.reduceat(expire_timestamps, starts)
+
+    keys, counts = np.unique(
+        inverse * MAX_POKEMON_ID + sightings['pokemon_id'],
+        return_counts=True,
+    )
+    species = [{} for _ in range(size)]
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        index, pokemon_id = divmod(key, MAX_POKEMON_ID)
+        species[index][str(pokemon_id)] = count
+
+    columns = zip(
+        spawn_ids.tolist(),
+        observations.tolist(),
+        lat_sum.tolist(),
+        lon_sum.tolist(),
+        offset_sin.tolist(),
+        offset_cos.tolist(),
+        first_seen.tolist(),
+        last_seen.tolist(),
+        species,
+    )
+    names = (
+        'observations', 'lat_sum', 'lon_sum', 'offset_sin', 'offset_cos',
+        'first_seen', 'last_seen', 'species',
+    )
+    return {row[0]: dict(zip(names, row[1:])) for row in columns}
+
+
+def get_offset(offset_sin, offset_cos):
+    """Returns second of hour being circular mean of summed offsets"""
+    angle = math.atan2(offset_sin, offset_cos) % (2 * math.pi)
+    return int(round(angle * 3600 / (2 * math.pi))) % 3600
+
+
+def merge(point, summary):
+    """Adds summary of new sightings to existing spawnpoints row"""
+    observations = point.observations + summary['observations']
+    point.lat = (
+        point.lat * point.observations + summary['lat_sum']
+    ) / observations
+    point.lon = (
+        point.lon * point.observations + summary['lon_sum']
+    ) / observations
+    point.observations = observations
+    point.offset_sin += summary['offset_sin']
+    point.offset_cos += summary['offset_cos']
+    point.spawn_offset = get_offset(point.offset_sin, point.offset_cos)
+    point.first_seen = min(point.first_seen, summary['first_seen'])
+    point.last_seen = max(point.last_seen, summary['last_seen'])
+    species = json.loads(point.species)
+    for pokemon_id, count in summary['species'].items():
+        species[pokemon_id] = species.get(pokemon_id, 0) + count
+    point.species = json.dumps(species, sort_keys=True)
+
+
+def create(spawn_id, summary):
+    observations = summary['observations']
+    return db.SpawnPoint(
+        spawn_id=spawn_id,
+        lat=summary['lat_sum'] / observations,
+        lon=summary['lon_sum'] / observations,
+        spawn_offset=get_offset(summary['offset_sin'], summary['offset_cos']),
+        offset_sin=summary['offset_sin'],
+        offset_cos=summary['offset_cos'],
+        observations=observations,
+        first_seen=summary['first_seen'],
+        last_seen=summary['last_seen'],
+        species=json.dumps(summary['species'], sort_keys=True),
+    )
+
+
+def update_spawnpoints(session, batch_size=None):
+    """Adds sightings following the last processed one to spawnpoints
+
+    At most batch_size sightings are processed, and id of the last one is
+    stored together with the results. Returns number of processed sightings.
+    """
+    batch_size = batch_size or getattr(
+        config, 'SPAWNPOINTS_BATCH_SIZE', 1000000
+    )
+    state = session.query(db.RollupState).get(STATE_NAME)
+    if not state:
+        state = db.RollupState(name=STATE_NAME, last_id=0)
+        session.add(state)
+    sightings = fetch_sightings(session, state.last_id, batch_size)
+    if sightings is None:
+        session.rollback()
+        return 0
+    summaries = summarize(sightings)
+    existing = {}
+    for spawn_ids in db.chunks(list(summaries.keys())):
+        query = session.query(db.SpawnPoint) \
+            .filter(db.SpawnPoint.spawn_id.in_(spawn_ids))
+        for point in query:
+            existing[point.spawn_id] = point
+    for spawn_id, summary in summaries.items():
+        if spawn_id in existing:
+            merge(existing[spawn_id], summary)
+        else:
+            session.add(create(spawn_id, summary))
+    state.last_id = int(sightings['id'][-1])
+    session.commit()
+    return len(sightings['id'])
+
+
+def update_all(batch_size=None):
+    """Processes batches of sightings until there are no new ones"""
+    batch_size = batch_size or getattr(
+        config, 'SPAWNPOINTS_BATCH_SIZE', 1000000
+    )
+    session = db.Session()
+    processed = 0
+    try:
+        while True:
+            count = update_spawnpoints(session, batch_size)
+            processed += count
+            if count < batch_size:
+                break
+    finally:
+        session.close()
+    return processed
@@ -0,0 +1,38 @@
+"""Shared setup of tests
+
+Modules read their settings from config, so config.py.example is loaded
+under that name - tests don't depend on anybody's own config.py.
+"""
+import importlib.machinery
+import importlib.util
+import os
+import sys
+
+import pytest
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_loader = importlib.machinery.SourceFileLoader(
+    'config', os.path.join(ROOT, 'config.py.example')
+)
+config = importlib.util.module_from_spec(
+    importlib.util.spec_from_loader('config', _loader)
+)
+_loader.exec_module(config)
+sys.modules['config'] = config
+
+import db  # noqa: E402
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    """Binds db.Session to an empty SQLite database for the test"""
+    engine = db.get_engine('sqlite:///{}'.format(tmp_path / 'test.sqlite'))
+    db.Base.metadata.create_all(engine)
+    previous = db.Session.kw['bind']
+    db.Session.configure(bind=engine)
+    yield db.Session
+    db.Session.configure(bind=previous)
+    engine.dispose()
@@ -0,0 +1,136 @@
+import threading
+import time
+
+import cache
+
+
+class FakeTime(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def make_cache(monkeypatch, **kwargs):
+    clock = FakeTime()
+    monkeypatch.setattr(cache.time, 'time', clock)
+    return cache.ResponseCache(**kwargs), clock
+
+
+def test_value_is_computed_once_until_ttl_passes(monkeypatch):
+    response_cache, clock = make_cache(monkeypatch, ttl=60)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return len(calls)
+
+    assert response_cache.get('a', compute) == 1
+    clock.now += 59
+    assert response_cache.get('a', compute) == 1
+    clock.now += 2
+    assert response_cache.get('a', compute) == 2
+    assert (response_cache.hits, response_cache.misses) == (1, 2)
+
+
+def test_least_recently_used_entry_is_evicted(monkeypatch):
+    response_cache, _ = make_cache(monkeypatch, max_size=2)
+    response_cache.get('a', lambda: 'a')
+    response_cache.get('b', lambda: 'b')
+    response_cache.get('a', lambda: 'new a')
+    response_cache.get('c', lambda: 'c')
+    assert list(response_cache.entries) == ['a', 'c']
+    assert response_cache.get('a', lambda: 'new a') == 'a'
+    assert response_cache.get('b', lambda: 'new b') == 'new b'
+
+
+def test_entries_of_old_version_are_computed_again(monkeypatch):
+    version = [1]
+    response_cache, clock = make_cache(
+        monkeypatch, version_func=lambda: version[0], version_interval=5
+    )
+    assert response_cache.get('a', lambda: 'v1') == 'v1'
+    version[0] = 2
+    # Version isn't checked again before version_interval passes
+    assert response_cache.get('a', lambda: 'v2') == 'v1'
+    clock.now += 5
+    assert response_cache.get('a', lambda: 'v2') == 'v2'
+
+
+def test_concurrent_misses_compute_value_once():
+    response_cache = cache.ResponseCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return 'value'
+
+    def request():
+        results.append(response_cache.get('key', compute))
+
+    first = threading.Thread(target=request)
+    first.start()
+    started.wait(5)
+    others = [threading.Thread(target=request) for _ in range(5)]
+    for thread in others:
+        thread.start()
+    wait_for(lambda: response_cache.waits == 5)
+    release.set()
+    for thread in [first] + others:
+        thread.join(5)
+    assert calls == [1]
+    assert results == ['value'] * 6
+
+
+def test_failed_computation_is_retried_by_waiting_request():
+    response_cache = cache.ResponseCache()
+    started = threading.Event()
+    release = threading.Event()
+    results = []
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise ValueError('failed')
+
+    def request(compute):
+        try:
+            results.append(response_cache.get('key', compute))
+        except ValueError:
+            results.append('error')
+
+    first = threading.Thread(target=request, args=(failing,))
+    first.start()
+    started.wait(5)
+    second = threading.Thread(target=request, args=(lambda: 'value',))
+    second.start()
+    wait_for(lambda: response_cache.waits)
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert sorted(results) == ['error', 'value']
+
+
+def test_cached_decorator_uses_arguments_as_key(monkeypatch):
+    response_cache, _ = make_cache(monkeypatch)
+    calls = []
+
+    @response_cache.cached()
+    def double(number):
+        calls.append(number)
+        return number * 2
+
+    assert [double(1), double(2), double(1)] == [2, 4, 2]
+    assert calls == [1, 2]
@@ -0,0 +1,121 @@
+import time
+
+import pytest
+
+import db
+import liveindex
+import web
+
+
+@pytest.fixture
+def session(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
+
+
+def add_sighting(session, lat, lon, expires_in=600):
+    sighting = db.Sighting(
+        pokemon_id=16,
+        spawn_id='47c1c5ccf61',
+        encounter_id=str(time.time()),
+        expire_timestamp=int(time.time() + expires_in),
+        normalized_timestamp=0,
+        lat=str(lat),
+        lon=str(lon),
+    )
+    session.add(sighting)
+    session.commit()
+    return sighting.id
+
+
+def add_fort_sighting(session, external_id, lat, lon, team, modified=0):
+    fort = session.query(db.Fort) \
+        .filter(db.Fort.external_id == external_id).first()
+    if not fort:
+        fort = db.Fort(external_id=external_id, lat=lat, lon=lon)
+        session.add(fort)
+        session.flush()
+    session.add(db.FortSighting(
+        fort_id=fort.id,
+        team=team,
+        prestige=1000,
+        guard_pokemon_id=0,
+        last_modified=int(time.time()) + modified,
+    ))
+    session.commit()
+    return fort.id
+
+
+def make_index():
+    return liveindex.LiveIndex(web.pokemon_to_marker, web.fort_to_marker)
+
+
+def get_ids(markers):
+    return sorted(marker['id'] for marker in markers)
+
+
+def test_query_returns_markers_within_bounds(session):
+    inside = add_sighting(session, 51.10, 17.03)
+    add_sighting(session, 51.50, 17.03)
+    fort_id = add_fort_sighting(session, 'a', 51.11, 17.04, 1)
+    index = make_index()
+    index.refresh()
+    markers, expired, _ = index.query(bounds=(51.0, 17.0, 51.2, 17.1))
+    assert get_ids(markers) == [
+        'fort-{}'.format(fort_id), 'pokemon-{}'.format(inside)
+    ]
+    assert expired == []
+    markers, _, _ = index.query(
+        bounds=(51.0, 17.0, 51.2, 17.1), with_pokemon=False
+    )
+    assert get_ids(markers) == ['fort-{}'.format(fort_id)]
+
+
+def test_cursor_returns_only_changes(session):
+    add_sighting(session, 51.10, 17.03)
+    fort_id = add_fort_sighting(session, 'a', 51.11, 17.04, 1)
+    index = make_index()
+    index.refresh()
+    _, _, cursor = index.query()
+    since = web.parse_cursor(cursor)
+    assert index.query(since=since)[0] == []
+    new = add_sighting(session, 51.12, 17.05)
+    add_fort_sighting(session, 'a', 51.11, 17.04, 2, modified=60)
+    index.refresh()
+    markers, _, new_cursor = index.query(since=since)
+    assert get_ids(markers) == [
+        'fort-{}'.format(fort_id), 'pokemon-{}'.format(new)
+    ]
+    assert [m['team'] for m in markers if m['type'] == 'fort'] == [2]
+    assert web.parse_cursor(new_cursor)[:2] == db.get_max_ids(session)
+    # Fort changed its team, so it's still one marker
+    assert len(index) == 3
+
+
+def test_cursor_never_goes_back(session):
+    add_sighting(session, 51.10, 17.03)
+    index = make_index()
+    index.refresh()
+    _, _, cursor = index.query(since=(1000, 1000, 0))
+    assert web.parse_cursor(cursor)[:2] == (1000, 1000)
+
+
+def test_expired_pokemon_are_reported_once_gone(session, monkeypatch):
+    leaving = add_sighting(session, 51.10, 17.03, expires_in=60)
+    staying = add_sighting(session, 51.10, 17.04, expires_in=6000)
+    index = make_index()
+    index.refresh()
+    _, _, cursor = index.query()
+    since = web.parse_cursor(cursor)
+    now = time.time()
+    monkeypatch.setattr(liveindex.time, 'time', lambda: now + 300)
+    monkeypatch.setattr(db.time, 'time', lambda: now + 300)
+    index.refresh()
+    markers, expired, _ = index.query()
+    assert get_ids(markers) == ['pokemon-{}'.format(staying)]
+    assert index.query(since=since)[1] == ['pokemon-{}'.format(leaving)]
+    # Clients that never saw it aren't told to remove it
+    assert index.query(since=(0, 0, 0))[1] == []
+    # Nor those that polled after it expired
+    assert index.query(since=(staying, 0, int(now + 200)))[1] == []
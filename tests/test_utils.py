@@ -0,0 +1,70 @@
+import random
+
+import pytest
+
+import utils
+
+
+def get_grid(rows, columns):
+    return [
+        (12.35 + row * 0.0012, 34.57 + column * 0.0017 + row % 2 * 0.00085)
+        for row in range(rows)
+        for column in range(columns)
+    ]
+
+
+def get_random(count, seed):
+    generator = random.Random(seed)
+    return [
+        (12.35 + generator.random() * 0.05, 34.57 + generator.random() * 0.05)
+        for _ in range(count)
+    ]
+
+
+@pytest.mark.parametrize('points', [
+    get_grid(20, 25),
+    get_random(300, 1),
+    get_random(1500, 2),
+    [(12.35, 34.57 + i * 0.001) for i in range(50)],
+    get_grid(2, 2),
+], ids=['grid', 'random', 'random-big', 'line', 'tiny'])
+def test_tour_visits_every_point_once_and_isnt_longer(points):
+    shuffled = list(points)
+    random.Random(0).shuffle(shuffled)
+    tour = utils.sort_points_for_worker(list(shuffled), 0)
+    assert sorted(tour) == sorted(points)
+    assert utils.get_tour_length(tour) <= utils.get_tour_length(shuffled)
+
+
+def test_tour_keeps_duplicates():
+    points = get_grid(5, 5) * 2
+    tour = utils.sort_points_for_worker(list(points), 0)
+    assert sorted(tour) == sorted(points)
+
+
+def test_tour_starts_closest_to_worker_center():
+    points = get_random(200, 3)
+    center = utils.get_start_coords(0)
+    tour = utils.sort_points_for_worker(list(points), 0)
+    closest = min(points, key=lambda p: utils.get_distance(p, center))
+    assert tour[0] == closest
+
+
+def test_neighbours_are_closest_points():
+    points = get_random(400, 4)
+    neighbours = utils.get_neighbours(points, count=5)
+    for i, point in enumerate(points):
+        expected = sorted(
+            (j for j in range(len(points)) if j != i),
+            key=lambda j: utils.get_distance(point, points[j]),
+        )[:5]
+        assert neighbours[i] == expected
+
+
+def test_improve_tour_keeps_first_point():
+    points = get_random(100, 5)
+    order = list(range(len(points)))
+    neighbours = utils.get_neighbours(points)
+    improved = utils.improve_tour(points, order, neighbours)
+    assert improved[0] == 0
+    assert sorted(improved) == order
@@ -0,0 +1,152 @@
+import json
+import time
+
+import pytest
+
+import db
+import liveindex
+import web
+
+
+def decode_markers(data):
+    """Does the same as decodeMarkers in newmap.html"""
+    def decode_coords(columns, i):
+        return (
+            (data['origin'][0] + columns['lat'][i]) / float(data['scale']),
+            (data['origin'][1] + columns['lon'][i]) / float(data['scale']),
+        )
+    names = {int(k): v for k, v in data['names'].items()}
+    markers = []
+    pokemon = data['pokemon']
+    for i, marker_id in enumerate(pokemon['id']):
+        lat, lon = decode_coords(pokemon, i)
+        markers.append({
+            'id': 'pokemon-{}'.format(marker_id),
+            'type': 'pokemon',
+            'trash': pokemon['pokemon_id'][i] in data['trash'],
+            'name': names[pokemon['pokemon_id'][i]],
+            'pokemon_id': pokemon['pokemon_id'][i],
+            'lat': lat,
+            'lon': lon,
+            'expires_at': pokemon['expires_at'][i],
+        })
+    forts = data['forts']
+    for i, marker_id in enumerate(forts['id']):
+        lat, lon = decode_coords(forts, i)
+        markers.append({
+            'id': 'fort-{}'.format(marker_id),
+            'sighting_id': forts['sighting_id'][i],
+            'type': 'fort',
+            'prestige': forts['prestige'][i],
+            'pokemon_id': forts['pokemon_id'][i],
+            'pokemon_name': (
+                names[forts['pokemon_id'][i]] if forts['pokemon_id'][i]
+                else 'Empty'
+            ),
+            'team': forts['team'][i],
+            'lat': lat,
+            'lon': lon,
+        })
+    return markers
+
+
+def normalize(markers):
+    """Makes markers comparable, as coordinates are stored as strings"""
+    result = {}
+    for marker in markers:
+        marker = dict(marker)
+        marker['lat'] = float(marker['lat'])
+        marker['lon'] = float(marker['lon'])
+        if 'expires_at' in marker:
+            marker['expires_at'] = int(marker['expires_at'])
+        result[marker['id']] = marker
+    return result
+
+
+def assert_same_markers(compact, markers):
+    decoded = normalize(decode_markers(compact))
+    markers = normalize(markers)
+    assert sorted(decoded) == sorted(markers)
+    for marker_id, marker in markers.items():
+        # Coordinates are sent with precision of 1e-6 degree
+        assert decoded[marker_id].pop('lat') == \
+            pytest.approx(marker.pop('lat'), abs=1e-6)
+        assert decoded[marker_id].pop('lon') == \
+            pytest.approx(marker.pop('lon'), abs=1e-6)
+        assert decoded[marker_id] == marker
+
+
+@pytest.fixture
+def client(session_factory):
+    session = session_factory()
+    now = int(time.time())
+    for i, pokemon_id in enumerate((16, 13, 150, 16)):
+        session.add(db.Sighting(
+            pokemon_id=pokemon_id,
+            spawn_id='47c1c5ccf6{}'.format(i),
+            encounter_id=str(i),
+            expire_timestamp=now + 300 + i,
+            normalized_timestamp=0,
+            lat='12.{}'.format(345678 + i * 1111),
+            lon='34.{}'.format(567891 + i * 2222),
+        ))
+    db.add_fort_sightings(session, [
+        {
+            'external_id': 'fort{}'.format(i),
+            'lat': 12.3512345 + i * 0.01,
+            'lon': 34.5798765 - i * 0.01,
+            'team': i + 1,
+            'prestige': 1000 * i,
+            'guard_pokemon_id': guard,
+            'last_modified': now,
+        }
+        for i, guard in enumerate((0, 149))
+    ])
+    session.commit()
+    session.close()
+    yield web.create_app().test_client()
+    db.ScopedSession.remove()
+
+
+def get_json(client, url):
+    response = client.get(url)
+    assert response.status_code == 200
+    return json.loads(response.get_data(as_text=True))
+
+
+@pytest.mark.parametrize('with_index', [False, True])
+def test_compact_data_decodes_to_the_same_markers(
+        client, monkeypatch, with_index):
+    if with_index:
+        index = liveindex.LiveIndex(web.pokemon_to_marker, web.fort_to_marker)
+        index.refresh()
+        monkeypatch.setattr(index, 'start', lambda: None)
+        monkeypatch.setattr(web, 'live_index', index)
+    else:
+        monkeypatch.setattr(web, 'live_index', None)
+    markers = get_json(client, '/data')
+    assert len(markers) == 6
+    compact = get_json(client, '/data?format=compact')
+    assert_same_markers(compact, markers)
+
+    changes = get_json(client, '/data?since=0-0-0')
+    compact = get_json(client, '/data?since=0-0-0&format=compact')
+    assert_same_markers(compact, changes['markers'])
+    assert compact['cursor'] == changes['cursor']
+    assert [
+        'pokemon-{}'.format(i) for i in compact['expired']
+    ] == changes['expired']
+
+
+
+def test_heatmap_columns_have_the_same_rows_as_json(client, monkeypatch):
+    monkeypatch.setattr(web, 'COLUMNS_PART_SIZE', 3)
+    rows = get_json(client, '/report/heatmap')
+    assert len(rows) == 4
+    parts = get_json(client, '/report/heatmap?format=columns')
+    assert [len(part['lat']) for part in parts] == [3, 1]
+    assert [
+        [lat, lon, weight]
+        for part in parts
+        for lat, lon, weight in zip(part['lat'], part['lon'], part['weight'])
+    ] == rows
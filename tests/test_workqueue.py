@@ -0,0 +1,91 @@
+import workqueue
+
+
+POINTS = [
+    [(1.0, 1.0), (1.0, 2.0), (1.0, 3.0)],
+    [(2.0, 1.0), (2.0, 2.0)],
+    [(3.0, 1.0), (3.0, 2.0), (3.0, 3.0), (3.0, 4.0)],
+]
+
+
+class FakeTime(object):
+    def __init__(self):
+        self.now = 1000000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_queue(monkeypatch, max_age=600):
+    clock = FakeTime()
+    monkeypatch.setattr(workqueue.time, 'time', clock)
+    return workqueue.PointQueue(POINTS, max_age), clock
+
+
+def run_cycle(queue, worker_no):
+    """Visits points like BaseSlave.get_points, returns them"""
+    queue.start_cycle(worker_no, POINTS[worker_no])
+    visited = []
+    for point in POINTS[worker_no]:
+        if queue.is_pending(point):
+            queue.mark_visited(point)
+            visited.append(point)
+    while True:
+        point = queue.steal(worker_no)
+        if not point:
+            return visited
+        visited.append(point)
+
+
+def test_steal_takes_points_of_worker_most_behind(monkeypatch):
+    queue, _ = make_queue(monkeypatch)
+    for worker_no in range(3):
+        queue.start_cycle(worker_no, POINTS[worker_no])
+    for point in POINTS[0]:
+        queue.mark_visited(point)
+    point = queue.steal(0)
+    assert point in POINTS[2]
+    assert not queue.is_pending(point)
+    assert queue.stolen == 1
+
+
+def test_steal_returns_none_when_everything_was_visited(monkeypatch):
+    queue, _ = make_queue(monkeypatch)
+    visited = run_cycle(queue, 0)
+    assert sorted(visited) == sorted(sum(POINTS, []))
+    assert queue.steal(0) is None
+
+
+def test_dead_workers_points_are_visited_every_cycle(monkeypatch):
+    queue, clock = make_queue(monkeypatch)
+    dead = set(POINTS[1] + POINTS[2])
+    for _ in range(3):
+        # Worker 1 and 2 never start, worker 0 does all the work
+        visited = run_cycle(queue, 0)
+        assert len(visited) == len(set(visited))
+        assert dead <= set(visited)
+        clock.now += 60
+
+
+def test_live_workers_points_arent_made_pending_again(monkeypatch):
+    queue, clock = make_queue(monkeypatch)
+    run_cycle(queue, 1)
+    clock.now += 60
+    # Worker 1 finished its cycle recently, it'll start the next one soon
+    visited = run_cycle(queue, 0)
+    assert not set(POINTS[1]) & set(visited)
+
+
+def test_take_overdue(monkeypatch):
+    queue, clock = make_queue(monkeypatch, max_age=600)
+    assert queue.take_overdue() is None
+    clock.now += 300
+    for point in POINTS[0] + POINTS[1]:
+        queue.mark_visited(point)
+    clock.now += 301
+    overdue = queue.take_overdue()
+    assert overdue in POINTS[2]
+    assert queue.overdue == 1
+    # Visiting it puts it at the end of the line
+    assert queue.take_overdue() in POINTS[2]
+    assert queue.take_overdue() != overdue
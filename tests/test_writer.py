@@ -0,0 +1,126 @@
+import itertools
+import time
+
+from sqlalchemy.exc import OperationalError
+
+import db
+import writer
+
+
+_encounter_ids = itertools.count(int(time.time()) * 1000)
+
+
+def make_pokemon(**kwargs):
+    encounter_id = next(_encounter_ids)
+    pokemon = {
+        'encounter_id': encounter_id,
+        # Cache tells sightings apart by spawn point, not encounter
+        'spawn_id': '{:x}'.format(encounter_id),
+        'pokemon_id': 16,
+        'expire_timestamp': time.time() + 600,
+        'lat': 51.1,
+        'lon': 17.03,
+    }
+    pokemon.update(kwargs)
+    return pokemon
+
+
+def count_sightings(session_factory):
+    session = session_factory()
+    try:
+        return session.query(db.Sighting).count()
+    finally:
+        session.close()
+
+
+def make_writer(**kwargs):
+    options = {'batch_size': 10, 'flush_interval': 0.05, 'retry_delay': 0.01}
+    options.update(kwargs)
+    return writer.DatabaseWriter(**options)
+
+
+def test_flush_writes_batch_and_caches_it(session_factory):
+    db_writer = make_writer()
+    pokemons = [make_pokemon() for _ in range(3)]
+    db_writer.flush(pokemons, [])
+    assert count_sightings(session_factory) == 3
+    assert db_writer.rows_written == 3
+    assert all(pokemon in db.SIGHTING_CACHE for pokemon in pokemons)
+
+
+def test_stop_drains_queue(session_factory):
+    db_writer = make_writer()
+    for _ in range(25):
+        db_writer.add_sighting(make_pokemon())
+    db_writer.start()
+    db_writer.stop()
+    assert not db_writer.is_alive()
+    assert db_writer.queue.empty()
+    assert count_sightings(session_factory) == 25
+
+
+def test_transient_error_is_retried(session_factory, monkeypatch):
+    add_sightings = db.add_sightings
+    calls = []
+
+    def failing_once(session, pokemons):
+        calls.append(len(pokemons))
+        if len(calls) == 1:
+            raise OperationalError('INSERT', {}, Exception('gone away'))
+        return add_sightings(session, pokemons)
+
+    monkeypatch.setattr(db, 'add_sightings', failing_once)
+    db_writer = make_writer()
+    pokemon = make_pokemon()
+    db_writer.write([pokemon], [])
+    assert calls == [1, 1]
+    assert db_writer.failed_flushes == 1
+    assert count_sightings(session_factory) == 1
+    assert pokemon in db.SIGHTING_CACHE
+
+
+def test_bad_row_is_dropped_alone(session_factory, monkeypatch):
+    add_sightings = db.add_sightings
+    bad = make_pokemon(pokemon_id=150)
+
+    def failing_on_bad(session, pokemons):
+        if bad in pokemons:
+            raise ValueError('bad row')
+        return add_sightings(session, pokemons)
+
+    monkeypatch.setattr(db, 'add_sightings', failing_on_bad)
+    db_writer = make_writer(retries=1)
+    pokemons = [make_pokemon() for _ in range(4)]
+    pokemons.insert(2, bad)
+    db_writer.write(pokemons, [])
+    assert db_writer.dropped == 1
+    assert count_sightings(session_factory) == 4
+    assert bad not in db.SIGHTING_CACHE
+
+
+def test_bad_batch_doesnt_block_the_queue(session_factory, monkeypatch):
+    add_sightings = db.add_sightings
+    bad = make_pokemon(pokemon_id=150)
+
+    def failing_on_bad(session, pokemons):
+        if bad in pokemons:
+            raise ValueError('bad row')
+        return add_sightings(session, pokemons)
+
+    monkeypatch.setattr(db, 'add_sightings', failing_on_bad)
+    db_writer = make_writer(queue_size=5)
+    db_writer.start()
+    db_writer.add_sighting(bad)
+    for _ in range(20):
+        db_writer.add_sighting(make_pokemon())
+    db_writer.stop()
+    assert db_writer.dropped == 1
+    assert count_sightings(session_factory) == 20
+
+
+def test_split_batch():
+    assert writer.split_batch([1, 2, 3], ['a']) == (([1, 2], []), ([3], ['a']))
+    assert writer.split_batch([1], ['a', 'b', 'c']) == (
+        ([1], ['a']), ([], ['b', 'c'])
+    )
+    assert writer.split_batch([], ['a', 'b']) == (([], ['a']), ([], ['b']))
@@ -0,0 +1,259 @@
+"""Rendering spawn density as map tiles
+
+Tiles are 256x256 PNG images in the usual z/x/y scheme, so they can be laid
+over any map. They're rendered from pokemon_locations rollup table, which
+has every place Pokemon were seen at with number of sightings, and kept on
+disk until enough new sightings are counted in the rollup tables.
+"""
+import math
+import os
+import shutil
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+import config
+import db
+
+
+TILE_SIZE = 256
+MAX_ZOOM = 20
+# Every place is drawn as a blurred spot of that radius (in pixels)
+SPOT_RADIUS = 6
+
+# Transparent blue through green and yellow to opaque red
+COLOR_STOPS = np.array([
+    [0, 0, 255, 0],
+    [0, 0, 255, 120],
+    [0, 255, 0, 160],
+    [255, 255, 0, 200],
+    [255, 0, 0, 230],
+], dtype=np.float64)
+
+
+def encode_png(rgba):
+    """Returns PNG file made of (height, width, 4) array of uint8"""
+    height, width = rgba.shape[:2]
+    # Every row starts with filter type, 0 meaning no filtering
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(kind, data):
+        return (
+            struct.pack('>I', len(data)) + kind + data +
+            struct.pack('>I', zlib.crc32(kind + data) & 0xFFFFFFFF)
+        )
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        # 8 bits per channel, RGBA, no interlacing
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+        chunk(b'IEND', b''),
+    ])
+
+
+def get_world_coords(lat, lon):
+    """Returns Web Mercator coordinates in 0-1 range for arrays of lat/lon"""
+    lat = np.clip(lat, -85.0511, 85.0511)
+    x = (lon + 180.0) / 360.0
+    sin = np.sin(np.radians(lat))
+    y = 0.5 - np.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+    return x, y
+
+
+def get_tile_range(zoom, start, end):
+    """Returns x and y ranges of tiles covering area between two corners"""
+    x, y = get_world_coords(
+        np.array([start[0], end[0]]), np.array([start[1], end[1]])
+    )
+    scale = 2 ** zoom
+    x = np.clip((x * scale).astype(int), 0, scale - 1)
+    y = np.clip((y * scale).astype(int), 0, scale - 1)
+    return (
+        range(x.min(), x.max() + 1),
+        range(y.min(), y.max() + 1),
+    )
+
+
+def blur(grid, radius):
+    """Approximates gaussian blur with three passes of box blur"""
+    size = 2 * radius + 1
+    for _ in range(3):
+        # Done along one axis, then along the other one after transposing
+        for _ in range(2):
+            summed = np.cumsum(
+                np.pad(grid, ((radius + 1, radius), (0, 0)), 'constant'),
+                axis=0,
+            )
+            grid = ((summed[size:] - summed[:-size]) / size).T
+    return grid
+
+
+def colorize(intensity):
+    """Maps array of values in 0-1 range to RGBA colors"""
+    position = intensity * (len(COLOR_STOPS) - 1)
+    lower = np.clip(np.floor(position).astype(int), 0, len(COLOR_STOPS) - 2)
+    fraction = (position - lower)[..., np.newaxis]
+    rgba = (
+        COLOR_STOPS[lower] * (1 - fraction) +
+        COLOR_STOPS[lower + 1] * fraction
+    )
+    rgba[intensity <= 0] = 0
+    return rgba.astype(np.uint8)
+
+
+class DensityData(object):
+    """Places Pokemon were seen at, as arrays ready for binning"""
+    def __init__(self, rows):
+        rows = list(rows)
+        self.pokemon_ids = np.array([r[0] for r in rows], dtype=np.int32)
+        lat = np.array([float(r[1]) for r in rows], dtype=np.float64)
+        lon = np.array([float(r[2]) for r in rows], dtype=np.float64)
+        self.x, self.y = get_world_coords(lat, lon)
+        self.weights = np.array([r[3] for r in rows], dtype=np.float64)
+        self.species = {}
+
+    @classmethod
+    def load(cls, session):
+        query = session.query(
+            db.PokemonLocation.pokemon_id,
+            db.PokemonLocation.lat,
+            db.PokemonLocation.lon,
+            db.PokemonLocation.how_many,
+        )
+        query = db.filter_report_since(query, db.PokemonLocation.last_seen)
+        return cls(query.yield_per(10000))
+
+    def get(self, species):
+        """Returns x, y, weights and max weight of given species (or all)"""
+        if species not in self.species:
+            if species == 'all':
+                x, y, weights = self.x, self.y, self.weights
+            else:
+                mask = self.pokemon_ids == species
+                x, y, weights = self.x[mask], self.y[mask], self.weights[mask]
+            max_weight = weights.max() if len(weights) else 1
+            self.species[species] = (x, y, weights, max_weight)
+        return self.species[species]
+
+    def render(self, species, zoom, tile_x, tile_y):
+        """Returns RGBA array with density of given species on a tile"""
+        x, y, weights, max_weight = self.get(species)
+        # Places just outside of the tile still affect pixels at its edges
+        size = TILE_SIZE + 2 * SPOT_RADIUS
+        scale = 2 ** zoom * TILE_SIZE
+        px = np.floor(x * scale - tile_x * TILE_SIZE + SPOT_RADIUS)
+        py = np.floor(y * scale - tile_y * TILE_SIZE + SPOT_RADIUS)
+        mask = (px >= 0) & (px < size) & (py >= 0) & (py < size)
+        grid = np.bincount(
+            (py[mask] * size + px[mask]).astype(np.int64),
+            weights=weights[mask],
+            minlength=size * size,
+        ).reshape(size, size)
+        grid = blur(grid, SPOT_RADIUS)
+        grid = grid[SPOT_RADIUS:-SPOT_RADIUS, SPOT_RADIUS:-SPOT_RADIUS]
+        # Logarithmic scale, so that single sightings are still visible
+        # next to the busiest places
+        spot_area = (2 * SPOT_RADIUS + 1) ** 2
+        intensity = np.log1p(grid * spot_area) / math.log1p(max_weight)
+        return colorize(np.clip(intensity, 0, 1))
+
+
+class TileRenderer(object):
+    """Renders tiles and keeps them on disk
+
+    Tiles are stored in a directory named after number of sightings counted
+    in rollup tables divided by refresh_every, so they're rendered again
+    after that many new sightings. Older directories are removed.
+    """
+    def __init__(self, directory=None, refresh_every=None):
+        self.directory = directory or getattr(config, 'TILES_DIR', 'tiles')
+        self.refresh_every = refresh_every or getattr(
+            config, 'TILES_REFRESH_EVERY', 10000
+        )
+        self.lock = threading.Lock()
+        self.data = None
+        self.generation = None
+
+    def get_generation(self):
+        session = db.Session()
+        try:
+            return db.get_rollup_watermark(session) // self.refresh_every
+        finally:
+            session.close()
+
+    def get_data(self, generation):
+        with self.lock:
+            if self.generation != generation:
+                session = db.Session()
+                try:
+                    self.data = DensityData.load(session)
+                finally:
+                    session.close()
+                self.generation = generation
+                self.remove_old(generation)
+            return self.data
+
+    def remove_old(self, generation):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name != str(generation):
+                shutil.rmtree(
+                    os.path.join(self.directory, name), ignore_errors=True
+                )
+
+    def get_path(self, generation, species, zoom, x, y):
+        return os.path.join(
+            self.directory,
+            str(generation),
+            str(species),
+            str(zoom),
+            str(x),
+            '{}.png'.format(y),
+        )
+
+    def get_tile(self, species, zoom, x, y, generation=None):
+        """Returns PNG file with given tile, rendering it if needed
+
+        Species is either Pokemon id or 'all'.
+        """
+        if generation is None:
+            generation = self.get_generation()
+        path = self.get_path(generation, species, zoom, x, y)
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except IOError:
+            pass
+        data = self.get_data(generation)
+        png = encode_png(data.render(species, zoom, x, y))
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # created by another thread in the meantime
+                pass
+        # Written under temporary name, so nobody reads half of the file
+        temp_path = '{}.{}.tmp'.format(path, threading.current_thread().ident)
+        with open(temp_path, 'wb') as f:
+            f.write(png)
+        os.rename(temp_path, path)
+        return png
+
+    def pregenerate(self, species, zooms, start, end):
+        """Renders all tiles of the area between two corners
+
+        Returns number of rendered tiles.
+        """
+        generation = self.get_generation()
+        count = 0
+        for zoom in zooms:
+            xs, ys = get_tile_range(zoom, start, end)
+            for x in xs:
+                for y in ys:
+                    self.get_tile(species, zoom, x, y, generation)
+                    count += 1
+        return count
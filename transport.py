@@ -0,0 +1,179 @@
+"""Ways of asking the server about map objects
+
+Workers don't care who answers them, as long as response looks like the
+one returned by GET_MAP_OBJECTS. That allows running them against a local
+stand-in generating synthetic data, e.g. for benchmarking.
+"""
+import math
+import random
+import time
+
+import config
+
+
+class PGoApiTransport(object):
+    """Talks to the real server using pgoapi"""
+    def __init__(self, center):
+        # Imported here, so that fake transport works without pgoapi
+        from pgoapi import PGoApi, utilities as pgoapi_utils
+        self.utils = pgoapi_utils
+        self.api = PGoApi()
+        self.api.activate_signature(config.ENCRYPT_PATH)
+        self.api.set_position(center[0], center[1], 100)  # lat, lon, alt
+        if hasattr(config, 'PROXIES') and config.PROXIES:
+            self.api.set_proxy(config.PROXIES)
+
+    def login(self, username, password, provider):
+        return self.api.login(
+            username=username,
+            password=password,
+            provider=provider,
+        )
+
+    def get_map_objects(self, point, cell_ids=None):
+        self.api.set_position(point[0], point[1], 0)
+        if not cell_ids:
+            cell_ids = self.utils.get_cell_ids(point[0], point[1])
+        self.api.set_position(point[0], point[1], 100)
+        return self.api.get_map_objects(
+            latitude=self.utils.f2i(point[0]),
+            longitude=self.utils.f2i(point[1]),
+            cell_id=cell_ids
+        )
+
+
+class FakeTransport(object):
+    """Local stand-in for the server generating synthetic map objects
+
+    The world is split into small cells, and contents of each cell (spawn
+    points with their spawn times, gyms and pokestops) are derived from its
+    coordinates, so every visit reports the same spawn points, encounters
+    and forts - just like the real server would. Spawn points spawn a
+    Pokemon once an hour for 15 minutes; gyms change owner every 30 minutes.
+    """
+    CELL_SIZE = 0.0005  # degrees, roughly 55 metres
+    MAP_CELL_SIZE = 4  # cells grouped in one map cell of the response
+
+    requests = 0  # shared by all instances
+
+    def __init__(
+        self,
+        center=None,
+        spawn_density=300,
+        fort_density=10,
+        radius=None,
+        latency=0,
+        seed=0,
+    ):
+        """Densities are given in spawn points / gyms per square kilometre"""
+        self.radius = radius or config.SCAN_RADIUS
+        self.latency = latency
+        self.seed = seed
+        lat = center[0] if center else 0
+        cell_area = (
+            (self.CELL_SIZE * 111.32) ** 2 * math.cos(math.radians(lat))
+        )
+        self.spawns_per_cell = spawn_density * cell_area
+        self.forts_per_cell = fort_density * cell_area
+
+    def login(self, username, password, provider):
+        return True
+
+    def get_map_objects(self, point, cell_ids=None):
+        FakeTransport.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        now = time.time()
+        map_cells = {}
+        lat_range = self.radius / 111320.0
+        lon_range = lat_range / max(math.cos(math.radians(point[0])), 0.01)
+        for i in range(
+            int(math.floor((point[0] - lat_range) / self.CELL_SIZE)),
+            int(math.floor((point[0] + lat_range) / self.CELL_SIZE)) + 1,
+        ):
+            for j in range(
+                int(math.floor((point[1] - lon_range) / self.CELL_SIZE)),
+                int(math.floor((point[1] + lon_range) / self.CELL_SIZE)) + 1,
+            ):
+                key = (i // self.MAP_CELL_SIZE, j // self.MAP_CELL_SIZE)
+                map_cell = map_cells.get(key)
+                if map_cell is None:
+                    map_cell = map_cells[key] = {
+                        'current_timestamp_ms': int(now * 1000),
+                        'wild_pokemons': [],
+                        'forts': [],
+                    }
+                self.fill_cell(map_cell, i, j, point, now)
+        return {
+            'status_code': 1,
+            'responses': {
+                'GET_MAP_OBJECTS': {
+                    'status': 1,
+                    'map_cells': list(map_cells.values()),
+                },
+            },
+        }
+
+    def fill_cell(self, map_cell, i, j, point, now):
+        rng = random.Random(hash((self.seed, i, j)))
+        spawns = int(self.spawns_per_cell)
+        if rng.random() < self.spawns_per_cell - spawns:
+            spawns += 1
+        for k in range(spawns):
+            lat, lon = self.get_position(rng, i, j)
+            spawn_offset = rng.randrange(3600)
+            if not self.is_in_range(point, lat, lon):
+                continue
+            hour, elapsed = divmod(now - spawn_offset, 3600)
+            if elapsed >= 900:
+                continue
+            spawn_rng = random.Random(hash((self.seed, i, j, k, int(hour))))
+            map_cell['wild_pokemons'].append({
+                'encounter_id': spawn_rng.getrandbits(63),
+                'spawn_point_id': '{:x}'.format(
+                    hash((self.seed, i, j, k)) & 0xFFFFFFFFFFFF
+                ),
+                # Low ids are way more common, just like in the game
+                'pokemon_data': {
+                    'pokemon_id': int(151 * spawn_rng.random() ** 3) + 1,
+                },
+                'time_till_hidden_ms': int((900 - elapsed) * 1000),
+                'latitude': lat,
+                'longitude': lon,
+            })
+        # Half of forts are pokestops, which workers ignore
+        for fort_type in (None, 1):
+            if rng.random() >= self.forts_per_cell:
+                continue
+            lat, lon = self.get_position(rng, i, j)
+            if not self.is_in_range(point, lat, lon):
+                continue
+            period = int(now // 1800)
+            fort_rng = random.Random(hash((self.seed, i, j, period)))
+            fort = {
+                'id': 'fake-{}-{}-{}'.format(self.seed, i, j),
+                'enabled': True,
+                'latitude': lat,
+                'longitude': lon,
+                'last_modified_timestamp_ms': period * 1800 * 1000,
+            }
+            if fort_type:
+                fort['type'] = fort_type
+            else:
+                team = fort_rng.randint(0, 3)
+                if team:
+                    fort['owned_by_team'] = team
+                    fort['gym_points'] = fort_rng.randint(1, 50) * 1000
+                    fort['guard_pokemon_id'] = fort_rng.randint(1, 151)
+            map_cell['forts'].append(fort)
+
+    def get_position(self, rng, i, j):
+        return (
+            (i + rng.random()) * self.CELL_SIZE,
+            (j + rng.random()) * self.CELL_SIZE,
+        )
+
+    def is_in_range(self, point, lat, lon):
+        d_lat = (lat - point[0]) * 111320
+        d_lon = (lon - point[1]) * 111320 * math.cos(math.radians(point[0]))
+        return d_lat ** 2 + d_lon ** 2 <= self.radius ** 2
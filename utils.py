@@ -1,9 +1,19 @@
+import hashlib
+import json
 import math
+import os
+import time
 from geopy import distance, Point
 
 import config
 
 
+# Bump whenever the way points are computed or ordered changes
+SCAN_PLAN_VERSION = 1
+# Number of closest points considered when building and improving tours
+TOUR_NEIGHBOURS = 8
+
+
 def get_map_center():
     """Returns center of the map"""
     lat = (config.MAP_END[0] + config.MAP_START[0]) / 2
@@ -107,14 +117,283 @@ def get_points_per_worker():
 
 
 def sort_points_for_worker(points, worker_no):
+    """Orders points so that walking through them makes a short closed tour
+
+    Tour starts at the point closest to worker's center. It's built with
+    nearest neighbour heuristic, then improved with 2-opt. Both only look
+    at a few closest points of every point, so it takes about a second
+    even for thousands of points.
+    """
     center = get_start_coords(worker_no)
-    return sorted(points, key=lambda p: get_distance(p, center))
+    if len(points) < 4:
+        return sorted(points, key=lambda p: get_distance(p, center))
+    # Distances in degrees of longitude are shorter than in latitude
+    scale = math.cos(math.radians(center[0]))
+    projected = [(p[0], p[1] * scale) for p in points]
+    start = min(
+        range(len(points)), key=lambda i: get_distance(points[i], center)
+    )
+    neighbours = get_neighbours(projected)
+    order = get_nearest_neighbour_tour(projected, start, neighbours)
+    order = improve_tour(projected, order, neighbours)
+    return [points[i] for i in order]
+
+
+def get_neighbours(points, count=TOUR_NEIGHBOURS):
+    """Returns indexes of closest points of every point, closest first
+
+    Points are put into square buckets holding a few points each, so that
+    only buckets around every point have to be searched.
+    """
+    lats = [p[0] for p in points]
+    lons = [p[1] for p in points]
+    min_lat = min(lats)
+    min_lon = min(lons)
+    height = max(lats) - min_lat
+    width = max(lons) - min_lon
+    size = math.sqrt(height * width / len(points) * count)
+    if not size:
+        size = (height + width) / len(points) * count or 1
+    buckets = {}
+    keys = []
+    for i, point in enumerate(points):
+        key = (
+            int((point[0] - min_lat) // size),
+            int((point[1] - min_lon) // size),
+        )
+        buckets.setdefault(key, []).append(i)
+        keys.append(key)
+    max_radius = int(max(height, width) // size) + 1
+    neighbours = []
+    for i, (row, column) in enumerate(keys):
+        # Once enough points are found, one more ring of buckets is needed
+        # to make sure none of the closer ones is left out
+        radius = 0
+        found = 0
+        while found <= count and radius < max_radius:
+            radius += 1
+            found = sum(
+                len(buckets.get((r, c), ()))
+                for r in range(row - radius, row + radius + 1)
+                for c in range(column - radius, column + radius + 1)
+            )
+        radius += 1
+        candidates = [
+            j
+            for r in range(row - radius, row + radius + 1)
+            for c in range(column - radius, column + radius + 1)
+            for j in buckets.get((r, c), ())
+            if j != i
+        ]
+        candidates.sort(key=lambda j: get_distance(points[i], points[j]))
+        neighbours.append(candidates[:count])
+    return neighbours
+
+
+def get_nearest_neighbour_tour(points, start, neighbours):
+    """Returns indexes of points, always going to the closest unvisited
+
+    Closest points are checked first, and only when all of them were
+    visited already, all points that are left are searched.
+    """
+    left = set(range(len(points)))
+    left.remove(start)
+    order = [start]
+    while left:
+        last = order[-1]
+        for closest in neighbours[last]:
+            if closest in left:
+                break
+        else:
+            closest = min(
+                left, key=lambda i: get_distance(points[i], points[last])
+            )
+        left.remove(closest)
+        order.append(closest)
+    return order
+
+
+def improve_tour(points, order, neighbours, max_passes=50, time_limit=5):
+    """Shortens closed tour with 2-opt, keeping its first point in place
+
+    For every edge, only those to closest points of its beginning are
+    considered as replacements. Whenever swapping two edges makes tour
+    shorter, part of the tour between them is reversed. Repeats until
+    nothing can be improved, or gives up after time_limit seconds.
+    """
+    order = list(order)
+    count = len(order)
+    positions = [0] * count
+    for position, i in enumerate(order):
+        positions[i] = position
+    deadline = time.time() + time_limit
+    for _ in range(max_passes):
+        improved = False
+        for i in range(count):
+            if time.time() > deadline:
+                return order
+            a = order[i]
+            b = order[(i + 1) % count]
+            ab = get_distance(points[a], points[b])
+            for c in neighbours[a]:
+                ac = get_distance(points[a], points[c])
+                if ac >= ab:
+                    break
+                j = positions[c]
+                d = order[(j + 1) % count]
+                if c == b or d == a:
+                    continue
+                delta = (
+                    ac + get_distance(points[b], points[d]) -
+                    ab - get_distance(points[c], points[d])
+                )
+                if delta < -1e-12:
+                    start, end = (i, j) if i < j else (j, i)
+                    order[start + 1:end + 1] = reversed(
+                        order[start + 1:end + 1]
+                    )
+                    for position in range(start + 1, end + 1):
+                        positions[order[position]] = position
+                    improved = True
+                    break
+        if not improved:
+            break
+    return order
+
+
+def get_tour_length(points):
+    """Returns length of closed tour going through points, in metres"""
+    if len(points) < 2:
+        return 0
+    return sum(
+        get_distance_meters(points[i - 1], points[i])
+        for i in range(len(points))
+    )
 
 
 def get_distance(p1, p2):
     return math.sqrt(pow(p1[0] - p2[0], 2) + pow(p1[1] - p2[1], 2))
 
 
+def get_distance_meters(p1, p2):
+    """Approximate distance in metres, good enough for short distances"""
+    lat = math.radians((p1[0] + p2[0]) / 2)
+    d_lat = (p1[0] - p2[0]) * 111320
+    d_lon = (p1[1] - p2[1]) * 111320 * math.cos(lat)
+    return math.sqrt(d_lat ** 2 + d_lon ** 2)
+
+
+def cluster_locations(locations, size):
+    """Merges places of the same Pokemon lying in the same grid cell
+
+    Takes (pokemon_id, lat, lon, count) tuples and cell size in metres.
+    Cluster is placed at the average of its places weighted by counts.
+    """
+    lat_step = size / 111320.0
+    lon_step = lat_step / math.cos(math.radians(get_map_center()[0]))
+    clusters = {}
+    for pokemon_id, lat, lon, count in locations:
+        lat = float(lat)
+        lon = float(lon)
+        key = (pokemon_id, int(lat // lat_step), int(lon // lon_step))
+        cluster = clusters.get(key)
+        if cluster is None:
+            clusters[key] = [lat * count, lon * count, count]
+        else:
+            cluster[0] += lat * count
+            cluster[1] += lon * count
+            cluster[2] += count
+    return [
+        (key[0], lat_sum / count, lon_sum / count, count)
+        for key, (lat_sum, lon_sum, count) in clusters.items()
+    ]
+
+
+class ScanPlan(object):
+    """Points of every worker together with S2 cells covered by each point
+
+    Computing all of that is expensive, so it's done once with
+    `python manage.py build-plan` and saved to a file, whose name depends
+    on settings used to compute it.
+    """
+    def __init__(self, points, cell_ids=None):
+        self.points = points
+        self.cell_ids = cell_ids or {}
+
+    @classmethod
+    def build(cls):
+        # Imported here, so that web server works without pgoapi
+        from pgoapi import utilities as pgoapi_utils
+        points = get_points_per_worker()
+        cell_ids = {}
+        for worker_points in points:
+            for point in worker_points:
+                cell_ids[point] = pgoapi_utils.get_cell_ids(
+                    point[0], point[1]
+                )
+        return cls(points, cell_ids)
+
+    def save(self, path=None):
+        path = path or get_scan_plan_path()
+        with open(path, 'w') as f:
+            json.dump({
+                'points': self.points,
+                'cell_ids': [
+                    [self.cell_ids.get(point) for point in worker_points]
+                    for worker_points in self.points
+                ],
+            }, f)
+        return path
+
+    @classmethod
+    def load(cls, path=None):
+        """Returns saved plan, or None if there's no plan for this config"""
+        path = path or get_scan_plan_path()
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        points = [
+            [tuple(point) for point in worker_points]
+            for worker_points in data['points']
+        ]
+        cell_ids = {}
+        for worker_points, worker_cell_ids in zip(points, data['cell_ids']):
+            for point, point_cell_ids in zip(worker_points, worker_cell_ids):
+                if point_cell_ids:
+                    cell_ids[point] = point_cell_ids
+        return cls(points, cell_ids)
+
+
+def get_scan_plan_path():
+    key = hashlib.sha1(repr((
+        SCAN_PLAN_VERSION,
+        tuple(config.MAP_START),
+        tuple(config.MAP_END),
+        tuple(config.GRID),
+        config.SCAN_RADIUS,
+    )).encode('utf-8')).hexdigest()[:12]
+    directory = getattr(config, 'SCAN_PLAN_DIR', '.')
+    return os.path.join(directory, 'scan_plan_{}.json'.format(key))
+
+
+_scan_plan = None
+
+
+def get_scan_plan():
+    """Returns scan plan for current config
+
+    Falls back to computing points (without cell ids) if plan wasn't built.
+    Either way, it's done only once per process.
+    """
+    global _scan_plan
+    if _scan_plan is None:
+        _scan_plan = (
+            ScanPlan.load() or ScanPlan(get_points_per_worker())
+        )
+    return _scan_plan
+
+
 def get_worker_account(worker_no):
     """Returns appropriate ACCOUNT entry for worker
 
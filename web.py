@@ -1,17 +1,31 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
 import argparse
+import itertools
 import json
+import struct
+import time
+import zlib
 
 import requests
-from flask import Flask, request, render_template
+from flask import Blueprint, Flask, Response, abort, request, render_template
+from flask import stream_with_context
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 
+import analytics
+import cache
 import config
 import db
+import liveindex
+import tiles
 import utils
 from names import POKEMON_NAMES
 
+try:
+    import brotli
+except ImportError:  # it's optional, gzip is used without it
+    brotli = None
+
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 
 
@@ -49,27 +63,107 @@ def get_args():
     parser.add_argument(
         '-d', '--debug', help='Debug Mode', action='store_true'
     )
-    parser.set_defaults(DEBUG=True)
     return parser.parse_args()
 
 
-app = Flask(__name__, template_folder='templates')
+blueprint = Blueprint('web', __name__)
+
+
+def remove_session(exception=None):
+    """Ends session used by the request, returning its connection to pool"""
+    db.ScopedSession.remove()
+
+
+def create_app():
+    """Returns the application, e.g. for running it with a WSGI server:
+
+        gunicorn --workers 4 'web:create_app()'
+    """
+    app = Flask(__name__, template_folder='templates')
+    app.register_blueprint(blueprint)
+    app.teardown_appcontext(remove_session)
+    app.after_request(compress_response)
+    return app
 
 
-@app.route('/data')
+COMPRESSIBLE_TYPES = (
+    'application/json',
+    'application/javascript',
+    'text/css',
+    'text/html',
+    'text/plain',
+)
+
+
+def compress_response(response):
+    """Compresses response with brotli or gzip, if client accepts it
+
+    Streamed responses are left alone, as they'd have to be held in memory.
+    """
+    compressible = (
+        response.status_code == 200 and
+        response.mimetype in COMPRESSIBLE_TYPES and
+        not response.is_streamed and
+        'Content-Encoding' not in response.headers
+    )
+    if not compressible:
+        return response
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < 500:
+        return response
+    accepted = request.accept_encodings
+    if brotli and accepted['br']:
+        data = brotli.compress(data, quality=5)
+        encoding = 'br'
+    elif accepted['gzip']:
+        # wbits of 16 + MAX_WBITS make zlib write gzip header and trailer
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = compressor.compress(data) + compressor.flush()
+        encoding = 'gzip'
+    else:
+        return response
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def json_response(data):
+    return Response(
+        json.dumps(data, separators=(',', ':')), mimetype='application/json'
+    )
+
+
+@blueprint.route('/data')
 def pokemon_data():
-    return json.dumps(get_pokemarkers())
+    if live_index is not None:
+        data = get_live_markers(
+            since=request.args.get('since'),
+            bounds=parse_bounds(request.args.get('bounds')),
+            zoom=request.args.get('zoom', type=int),
+        )
+    elif 'since' in request.args:
+        data = get_pokemarkers_since(request.args['since'])
+    else:
+        data = get_pokemarkers()
+    if request.args.get('format') == 'compact':
+        if isinstance(data, list):
+            data = {'markers': data}
+        return json_response(get_compact_markers(**data))
+    return json.dumps(data)
 
 
-@app.route('/workers_data')
+@blueprint.route('/workers_data')
 def workers_data():
+    if request.args.get('format') == 'compact':
+        return json_response(get_compact_workers())
     return json.dumps({
         'points': get_worker_markers(),
         'scan_radius': config.SCAN_RADIUS,
     })
 
 
-@app.route('/')
+@blueprint.route('/')
 def fullmap():
     map_center = utils.get_map_center()
     return render_template(
@@ -83,45 +177,139 @@ def fullmap():
 
 def get_pokemarkers():
     markers = []
-    session = db.Session()
+    session = db.ScopedSession()
     pokemons = db.get_sightings(session)
     forts = db.get_forts(session)
-    session.close()
 
     for pokemon in pokemons:
-        markers.append({
-            'id': 'pokemon-{}'.format(pokemon.id),
-            'type': 'pokemon',
-            'trash': pokemon.pokemon_id in config.TRASH_IDS,
-            'name': POKEMON_NAMES[pokemon.pokemon_id],
-            'pokemon_id': pokemon.pokemon_id,
-            'lat': pokemon.lat,
-            'lon': pokemon.lon,
-            'expires_at': pokemon.expire_timestamp,
-        })
+        markers.append(pokemon_to_marker(pokemon))
     for fort in forts:
-        if fort['guard_pokemon_id']:
-            pokemon_name = POKEMON_NAMES[fort['guard_pokemon_id']]
-        else:
-            pokemon_name = 'Empty'
-        markers.append({
-            'id': 'fort-{}'.format(fort['fort_id']),
-            'sighting_id': fort['id'],
-            'type': 'fort',
-            'prestige': fort['prestige'],
-            'pokemon_id': fort['guard_pokemon_id'],
-            'pokemon_name': pokemon_name,
-            'team': fort['team'],
-            'lat': fort['lat'],
-            'lon': fort['lon'],
-        })
+        markers.append(fort_to_marker(fort))
 
     return markers
 
 
+def parse_cursor(cursor):
+    """Returns sighting id, fort sighting id and timestamp from cursor"""
+    try:
+        sighting_id, fort_sighting_id, timestamp = (
+            int(part) for part in cursor.split('-')
+        )
+    except ValueError:
+        return None
+    return sighting_id, fort_sighting_id, timestamp
+
+
+def parse_bounds(bounds):
+    """Returns (south, west, north, east) from comma-separated string"""
+    try:
+        south, west, north, east = (float(x) for x in bounds.split(','))
+    except (AttributeError, ValueError):
+        return None
+    return south, west, north, east
+
+
+def get_live_markers(since=None, bounds=None, zoom=None):
+    """Returns markers from in-memory index, same as get_pokemarkers(_since)
+
+    Only markers within bounds are returned. Pokemon are left out when
+    map is zoomed out too much to make any sense of them.
+    """
+    live_index.start()
+    min_zoom = getattr(config, 'MAP_MIN_POKEMON_ZOOM', None)
+    markers, expired, cursor = live_index.query(
+        bounds=bounds,
+        since=parse_cursor(since) if since else None,
+        with_pokemon=not (zoom and min_zoom and zoom < min_zoom),
+    )
+    if since is None:
+        return markers
+    return {
+        'markers': markers,
+        'expired': expired,
+        'cursor': cursor,
+    }
+
+
+def get_pokemarkers_since(cursor):
+    """Returns markers that changed since cursor and ids of expired ones
+
+    Cursor is returned with every response and should be sent back with the
+    next request. Without a valid one, all markers are returned.
+    """
+    session = db.ScopedSession()
+    # Taken first, so that nothing added in the meantime is missed
+    sighting_id, fort_sighting_id = db.get_max_ids(session)
+    now = int(time.time())
+    since = parse_cursor(cursor)
+    if not since:
+        pokemons = db.get_sightings(session)
+        forts = db.get_forts(session)
+        expired = []
+    else:
+        previous_sighting_id, previous_fort_sighting_id, previous_time = since
+        pokemons = db.get_sightings_since(
+            session, previous_sighting_id, sighting_id
+        )
+        forts = db.get_forts_since(
+            session, previous_fort_sighting_id, fort_sighting_id
+        )
+        expired = db.get_expired_sighting_ids(
+            session, previous_time, now, previous_sighting_id
+        )
+    markers = [pokemon_to_marker(pokemon) for pokemon in pokemons]
+    markers.extend(fort_to_marker(fort) for fort in forts)
+    return {
+        'markers': markers,
+        'expired': ['pokemon-{}'.format(i) for i in expired],
+        'cursor': '{}-{}-{}'.format(sighting_id, fort_sighting_id, now),
+    }
+
+
+def pokemon_to_marker(pokemon):
+    return {
+        'id': 'pokemon-{}'.format(pokemon.id),
+        'type': 'pokemon',
+        'trash': pokemon.pokemon_id in config.TRASH_IDS,
+        'name': POKEMON_NAMES[pokemon.pokemon_id],
+        'pokemon_id': pokemon.pokemon_id,
+        'lat': pokemon.lat,
+        'lon': pokemon.lon,
+        'expires_at': pokemon.expire_timestamp,
+    }
+
+
+def fort_to_marker(fort):
+    if fort['guard_pokemon_id']:
+        pokemon_name = POKEMON_NAMES[fort['guard_pokemon_id']]
+    else:
+        pokemon_name = 'Empty'
+    return {
+        'id': 'fort-{}'.format(fort['fort_id']),
+        'sighting_id': fort['id'],
+        'type': 'fort',
+        'prestige': fort['prestige'],
+        'pokemon_id': fort['guard_pokemon_id'],
+        'pokemon_name': pokemon_name,
+        'team': fort['team'],
+        'lat': fort['lat'],
+        'lon': fort['lon'],
+    }
+
+
+if getattr(config, 'LIVE_INDEX', True):
+    live_index = liveindex.LiveIndex(
+        pokemon_to_marker,
+        fort_to_marker,
+        interval=getattr(config, 'LIVE_INDEX_INTERVAL', 5),
+    )
+else:
+    live_index = None
+
+
 def get_worker_markers():
     markers = []
-    points = utils.get_points_per_worker()
+    points = utils.get_scan_plan().points
     # Worker start points
     for worker_no, worker_points in enumerate(points):
         coords = utils.get_start_coords(worker_no)
@@ -144,24 +332,164 @@ def get_worker_markers():
     return markers
 
 
-@app.route('/report')
+# Compact format has coordinates as integer offsets from map center
+COORDS_SCALE = 10 ** 6
+
+
+def get_origin():
+    return [int(round(c * COORDS_SCALE)) for c in utils.get_map_center()]
+
+
+def encode_coords(items, origin):
+    """Returns lists of lat and lon of items as offsets from origin"""
+    def encode(value, start):
+        return int(round(float(value) * COORDS_SCALE)) - start
+    return (
+        [encode(item['lat'], origin[0]) for item in items],
+        [encode(item['lon'], origin[1]) for item in items],
+    )
+
+
+def get_compact_markers(markers, expired=None, cursor=None):
+    """Returns the same markers as columns, with repeating parts left out
+
+    Ids are numbers without 'pokemon-' or 'fort-' prefix, names are given
+    once for every Pokemon id, and trash is told by list of trash ids.
+    """
+    origin = get_origin()
+    pokemons = []
+    forts = []
+    names = {}
+    for marker in markers:
+        if marker['type'] == 'pokemon':
+            pokemons.append(marker)
+            names[marker['pokemon_id']] = marker['name']
+        else:
+            forts.append(marker)
+            if marker['pokemon_id']:
+                names[marker['pokemon_id']] = marker['pokemon_name']
+    pokemon_lat, pokemon_lon = encode_coords(pokemons, origin)
+    fort_lat, fort_lon = encode_coords(forts, origin)
+    data = {
+        'origin': origin,
+        'scale': COORDS_SCALE,
+        'names': names,
+        'trash': config.TRASH_IDS,
+        'pokemon': {
+            'id': [int(m['id'].split('-')[1]) for m in pokemons],
+            'pokemon_id': [m['pokemon_id'] for m in pokemons],
+            'expires_at': [int(m['expires_at']) for m in pokemons],
+            'lat': pokemon_lat,
+            'lon': pokemon_lon,
+        },
+        'forts': {
+            'id': [int(m['id'].split('-')[1]) for m in forts],
+            'sighting_id': [m['sighting_id'] for m in forts],
+            'team': [m['team'] for m in forts],
+            'prestige': [m['prestige'] for m in forts],
+            'pokemon_id': [m['pokemon_id'] for m in forts],
+            'lat': fort_lat,
+            'lon': fort_lon,
+        },
+    }
+    if expired is not None:
+        data['expired'] = [int(i.split('-')[1]) for i in expired]
+        data['cursor'] = cursor
+    return data
+
+
+def get_compact_workers():
+    """Returns the same as /workers_data in columns
+
+    Points of every worker are given in order, so their numbers are left
+    out.
+    """
+    origin = get_origin()
+    workers = []
+    points = []
+    for marker in get_worker_markers():
+        if marker['type'] == 'worker':
+            workers.append(marker)
+        else:
+            points.append(marker)
+    worker_lat, worker_lon = encode_coords(workers, origin)
+    point_lat, point_lon = encode_coords(points, origin)
+    return {
+        'origin': origin,
+        'scale': COORDS_SCALE,
+        'scan_radius': config.SCAN_RADIUS,
+        'workers': {
+            'worker_no': [m['worker_no'] for m in workers],
+            'lat': worker_lat,
+            'lon': worker_lon,
+        },
+        'points': {
+            'worker_no': [m['worker_no'] for m in points],
+            'lat': point_lat,
+            'lon': point_lon,
+        },
+    }
+
+
+# With ANALYTICS, reports are computed from files made by
+# `manage.py update-analytics` instead of rollup tables
+analytics_engine = (
+    analytics.Analytics() if getattr(config, 'ANALYTICS', False) else None
+)
+
+
+def get_reports():
+    """Returns object with report functions of db, without session"""
+    if analytics_engine is not None:
+        analytics_engine.refresh()
+        return analytics_engine
+    return analytics.DatabaseReports(db.ScopedSession())
+
+
+def get_report_version():
+    if analytics_engine is not None:
+        analytics_engine.refresh()
+        return analytics_engine.last_id
+    return db.get_rollup_watermark(db.ScopedSession())
+
+
+def get_cache_key(*args, **kwargs):
+    return request.full_path
+
+
+# Reports change only when rollup tables (or analytics files) do
+report_cache = cache.ResponseCache(
+    ttl=getattr(config, 'REPORT_CACHE_TTL', 15 * 60),
+    max_size=getattr(config, 'REPORT_CACHE_SIZE', 256),
+    version_func=get_report_version,
+)
+
+
+@blueprint.route('/report')
+@report_cache.cached(key=get_cache_key)
 def report_main():
-    session = db.Session()
-    top_pokemon = db.get_top_pokemon(session)
-    bottom_pokemon = db.get_top_pokemon(session, order='ASC')
-    bottom_sightings = db.get_all_sightings(
-        session, [r[0] for r in bottom_pokemon]
+    session = db.ScopedSession()
+    reports = get_reports()
+    top_pokemon = reports.get_top_pokemon()
+    bottom_pokemon = reports.get_top_pokemon(order='ASC')
+    cluster_size = getattr(config, 'REPORT_CLUSTER_SIZE', 100)
+    bottom_sightings = utils.cluster_locations(
+        db.get_sighting_locations(session, [r[0] for r in bottom_pokemon]),
+        cluster_size,
     )
-    stage2_pokemon = db.get_stage2_pokemon(session)
+    stage2_pokemon = reports.get_stage2_pokemon()
     if stage2_pokemon:
-        stage2_sightings = db.get_all_sightings(
-            session, [r[0] for r in stage2_pokemon]
+        stage2_sightings = utils.cluster_locations(
+            db.get_sighting_locations(
+                session, [r[0] for r in stage2_pokemon]
+            ),
+            cluster_size,
         )
     else:
         stage2_sightings = []
     js_data = {
         'charts_data': {
-            'punchcard': db.get_punch_card(session),
+            'punchcard': reports.get_punch_card(),
             'top30': [(POKEMON_NAMES[r[0]], r[1]) for r in top_pokemon],
             'bottom30': [
                 (POKEMON_NAMES[r[0]], r[1]) for r in bottom_pokemon
@@ -183,11 +511,10 @@ def report_main():
         'stage2': [(r[0], POKEMON_NAMES[r[0]]) for r in stage2_pokemon],
         'nonexistent': [
             (r, POKEMON_NAMES[r])
-            for r in db.get_nonexistent_pokemon(session)
+            for r in reports.get_nonexistent_pokemon()
         ]
     }
-    session_stats = db.get_session_stats(session)
-    session.close()
+    session_stats = reports.get_session_stats()
 
     area = utils.get_scan_area()
 
@@ -207,19 +534,19 @@ def report_main():
     )
 
 
-@app.route('/report/<int:pokemon_id>')
+@blueprint.route('/report/<int:pokemon_id>')
+@report_cache.cached(key=get_cache_key)
 def report_single(pokemon_id):
-    session = db.Session()
-    session_stats = db.get_session_stats(session)
+    reports = get_reports()
+    session_stats = reports.get_session_stats()
     js_data = {
         'charts_data': {
-            'hours': db.get_spawns_per_hour(session, pokemon_id),
+            'hours': reports.get_spawns_per_hour(pokemon_id),
         },
         'map_center': utils.get_map_center(),
         'zoom': 13,
     }
 
-    session.close()
     return render_template(
         'report_single.html',
         current_date=datetime.now(),
@@ -227,7 +554,7 @@ def report_single(pokemon_id):
         area_size=utils.get_scan_area(),
         pokemon_id=pokemon_id,
         pokemon_name=POKEMON_NAMES[pokemon_id],
-        total_spawn_count=db.get_total_spawns_count(session, pokemon_id),
+        total_spawn_count=reports.get_total_spawns_count(pokemon_id),
         session_start=session_stats['start'],
         session_end=session_stats['end'],
         session_length_hours=int(session_stats['length_hours']),
@@ -236,33 +563,184 @@ def report_single(pokemon_id):
     )
 
 
-def sighting_to_marker(sighting):
+def sighting_to_marker(cluster):
+    """Takes (pokemon_id, lat, lon, count) of a cluster of sightings"""
+    pokemon_id, lat, lon, count = cluster
     return {
-        'icon': '/static/icons/{}.png'.format(sighting.pokemon_id),
-        'lat': sighting.lat,
-        'lon': sighting.lon,
+        'icon': '/static/icons/{}.png'.format(pokemon_id),
+        'lat': round(lat, 6),
+        'lon': round(lon, 6),
+        'count': count,
     }
 
 
-@app.route('/report/heatmap')
+@blueprint.route('/report/heatmap')
 def report_heatmap():
-    session = db.Session()
-    pokemon_id = request.args.get('id')
-    points = db.get_all_spawn_coords(session, pokemon_id=pokemon_id)
-    session.close()
-    return json.dumps(points)
+    return stream_heatmap(by_minute=False)
 
-@app.route('/report/heatmap/time_based')
-def report_time_based_heatmap():
-    session = db.Session()
-    pokemon_id = request.args.get('id')
-    time_data = db.get_spawns_per_minute(session, pokemon_id)
-    
-    session.close()
 
-    return json.dumps(time_data)
+@blueprint.route('/report/heatmap/time_based')
+def report_time_based_heatmap():
+    return stream_heatmap(by_minute=True)
+
+
+tile_renderer = tiles.TileRenderer()
+
+
+@blueprint.route('/tiles/<species>/<int:zoom>/<int:x>/<int:y>.png')
+def density_tile(species, zoom, x, y):
+    """Returns tile with spawn density of given Pokemon id or all of them"""
+    if species != 'all':
+        try:
+            species = int(species)
+        except ValueError:
+            abort(404)
+    if not 0 <= zoom <= tiles.MAX_ZOOM:
+        abort(404)
+    if not (0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+        abort(404)
+    png = tile_renderer.get_tile(species, zoom, x, y)
+    response = Response(png, mimetype='image/png')
+    response.cache_control.max_age = 60
+    return response
+
+
+HEATMAP_FORMATS = ('json', 'columns', 'binary')
+# Rows in one object of columns format
+COLUMNS_PART_SIZE = 1000
+
+
+def stream_heatmap(by_minute):
+    """Streams heatmap rows as they're read from the database
+
+    Query string takes id of Pokemon, resolution in degrees to bin
+    coordinates with, and format:
+    - json (default) - list of [lat, lon, weight] lists; list of 1440 lists
+      (one for every minute of day) of {lat, lng, weight} for time based
+    - columns - list of objects with list of values for every column, each
+      made of up to 1000 rows
+    - binary - little-endian float32 values of every row one after another
+      (minute of day, lat, lon and weight for time based)
+    With archives=1 (or 0) archived sightings are included (or not)
+    regardless of REPORT_INCLUDE_ARCHIVES. With ANALYTICS, rows are computed
+    from analytics files, which always include archived sightings.
+    """
+    fmt = request.args.get('format', 'json')
+    if fmt not in HEATMAP_FORMATS:
+        abort(400)
+    pokemon_id = request.args.get('id', type=int)
+    resolution = request.args.get('resolution', type=float)
+    with_archives = request.args.get('archives', type=int)
+
+    def generate():
+        session = db.Session()
+        try:
+            if analytics_engine is not None:
+                analytics_engine.refresh()
+                rows = analytics_engine.iter_heatmap(
+                    pokemon_id=pokemon_id,
+                    resolution=resolution,
+                    by_minute=by_minute,
+                )
+            else:
+                rows = db.iter_heatmap(
+                    session,
+                    pokemon_id=pokemon_id,
+                    resolution=resolution,
+                    by_minute=by_minute,
+                    with_archives=(
+                        None if with_archives is None
+                        else bool(with_archives)
+                    ),
+                )
+            if by_minute and fmt == 'json':
+                chunks = encode_minutes(rows)
+            else:
+                names = ['lat', 'lon', 'weight']
+                if by_minute:
+                    names.insert(0, 'minute')
+                chunks = encode_rows(rows, names, fmt)
+            for chunk in join_chunks(chunks):
+                yield chunk
+        finally:
+            session.close()
+    if fmt == 'binary':
+        mimetype = 'application/octet-stream'
+    else:
+        mimetype = 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+def encode_rows(rows, names, fmt):
+    """Yields parts of rows encoded in given format"""
+    if fmt == 'binary':
+        row_struct = struct.Struct('<{}f'.format(len(names)))
+        for row in rows:
+            yield row_struct.pack(*row)
+    elif fmt == 'columns':
+        # Columns of every part of rows on their own, so nothing but the
+        # current part is kept in memory
+        rows = iter(rows)
+        yield '['
+        first = True
+        while True:
+            part = list(itertools.islice(rows, COLUMNS_PART_SIZE))
+            if not part:
+                break
+            yield '' if first else ', '
+            yield json.dumps({
+                name: list(column)
+                for name, column in zip(names, zip(*part))
+            })
+            first = False
+        yield ']'
+    else:
+        yield '['
+        for i, row in enumerate(rows):
+            yield ', ' if i else ''
+            yield json.dumps(row)
+        yield ']'
+
+
+def encode_minutes(rows):
+    """Yields parts of list of points for every minute of day as JSON
+
+    Rows have to be ordered by minute.
+    """
+    yield '[['
+    current = 0
+    first = True
+    for minute, lat, lon, weight in rows:
+        while current < minute:
+            yield '], ['
+            current += 1
+            first = True
+        yield '' if first else ', '
+        yield json.dumps({'lat': lat, 'lng': lon, 'weight': weight})
+        first = False
+    while current < 24 * 60 - 1:
+        yield '], ['
+        current += 1
+    yield ']]'
+
+
+def join_chunks(chunks, size=64 * 1024):
+    """Joins small parts into chunks worth sending"""
+    buffered = []
+    length = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield buffered[0][:0].join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield buffered[0][:0].join(buffered)
 
 
 if __name__ == '__main__':
     args = get_args()
-    app.run(debug=True, threaded=True, host=args.host, port=args.port)
+    create_app().run(
+        debug=args.debug, threaded=True, host=args.host, port=args.port
+    )
@@ -8,15 +8,16 @@ import sys
 import threading
 import time
 
-from pgoapi import (
-    exceptions as pgoapi_exceptions,
-    PGoApi,
-    utilities as pgoapi_utils,
-)
+from pgoapi import exceptions as pgoapi_exceptions
 
 import config
 import db
+import rollups
+import scheduler
+import transport
 import utils
+import workqueue
+import writer
 
 
 # Check whether config has all necessary attributes
@@ -38,7 +39,12 @@ for setting_name in REQUIRED_SETTINGS:
 
 
 workers = {}
+schedulers = {}
+cell_ids = {}
 local_data = threading.local()
+db_writer = writer.DatabaseWriter()
+rollup_job = rollups.RollupJob()
+work_queue = None
 
 
 class MalformedResponse(Exception):
@@ -61,7 +67,195 @@ def configure_logger(filename='worker.log'):
 logger = logging.getLogger()
 
 
-class Slave(threading.Thread):
+class BaseSlave(object):
+    """Parts of a worker that don't depend on how it's run"""
+    # Called with worker's first point, returns object talking to the server
+    transport_factory = transport.PGoApiTransport
+
+    def __init__(self, worker_no, points):
+        self.worker_no = worker_no
+        self.points = points
+        self.count_points = len(self.points)
+        self.step = 0
+        self.cycle = 0
+        self.seen_per_cycle = 0
+        self.total_seen = 0
+        self.error_code = None
+        self.running = True
+        self.scheduler = schedulers.get(worker_no)
+        self.api = self.create_api()
+
+    def create_api(self):
+        return self.transport_factory(self.points[0])
+
+    def get_own_points(self):
+        if not self.scheduler:
+            for point in self.points:
+                yield point
+            return
+        for _ in range(self.count_points):
+            yield self.scheduler.next_point()
+
+    def get_points(self):
+        """Yields points to visit during one cycle
+
+        With work queue enabled, points nobody visited for too long are
+        visited on the way, points already visited by someone else are
+        skipped, and when worker is done it helps those who aren't.
+        """
+        if not work_queue:
+            for point in self.get_own_points():
+                yield point
+            return
+        work_queue.start_cycle(self.worker_no, self.points)
+        for point in self.get_own_points():
+            overdue = work_queue.take_overdue()
+            if overdue:
+                yield overdue
+            # Scheduler may want to visit the same point again
+            if not self.scheduler and not work_queue.is_pending(point):
+                continue
+            work_queue.mark_visited(point)
+            yield point
+        while True:
+            point = work_queue.steal(self.worker_no)
+            if not point:
+                return
+            yield point
+
+    def process_response(self, response_dict):
+        """Hands everything seen in the response over to the writer"""
+        pokemons, forts = self.read_response(response_dict)
+        for raw_pokemon in pokemons:
+            db_writer.add_sighting(raw_pokemon)
+        for raw_fort in forts:
+            db_writer.add_fort_sighting(raw_fort)
+        self.point_processed(pokemons, forts)
+
+    def read_response(self, response_dict):
+        """Returns normalized Pokemons and forts seen in the response"""
+        if not isinstance(response_dict, dict):
+            logger.warning('Response: %s', response_dict)
+            raise MalformedResponse
+        if response_dict['status_code'] == 3:
+            logger.warning('Account banned')
+            raise BannedAccount
+        responses = response_dict.get('responses')
+        if not responses:
+            logger.warning('Response: %s', response_dict)
+            raise MalformedResponse
+        map_objects = response_dict['responses'].get('GET_MAP_OBJECTS', {})
+        pokemons = []
+        forts = []
+        if map_objects.get('status') == 1:
+            for map_cell in map_objects['map_cells']:
+                for pokemon in map_cell.get('wild_pokemons', []):
+                    # Care only about 15 min spawns
+                    # 30 and 45 min ones (negative) will be just put after
+                    # time_till_hidden is below 15 min
+                    # As of 2016.08.14 we don't know what values over
+                    # 60 minutes are, so ignore them too
+                    invalid_time = (
+                        pokemon['time_till_hidden_ms'] < 0 or
+                        pokemon['time_till_hidden_ms'] > 900000
+                    )
+                    if invalid_time:
+                        continue
+                    pokemons.append(
+                        self.normalize_pokemon(
+                            pokemon, map_cell['current_timestamp_ms']
+                        )
+                    )
+                for fort in map_cell.get('forts', []):
+                    if not fort.get('enabled'):
+                        continue
+                    if fort.get('type') == 1:  # probably pokestops
+                        continue
+                    forts.append(self.normalize_fort(fort))
+        return pokemons, forts
+
+    def point_processed(self, pokemons, forts):
+        """Updates counters once everything was handed over to the writer"""
+        for raw_pokemon in pokemons:
+            if self.scheduler:
+                self.scheduler.add_spawn(
+                    raw_pokemon['spawn_id'],
+                    raw_pokemon['lat'],
+                    raw_pokemon['lon'],
+                    raw_pokemon['expire_timestamp'],
+                )
+            self.seen_per_cycle += 1
+            self.total_seen += 1
+        logger.info(
+            'Point processed, %d Pokemons and %d forts seen!',
+            len(pokemons),
+            len(forts),
+        )
+        # Clear error code and let know that there are Pokemon
+        if self.error_code and self.seen_per_cycle:
+            self.error_code = None
+        self.step += 1
+
+    def get_scan_delay(self):
+        """Returns number of seconds to wait before visiting next point"""
+        return random.uniform(config.SCAN_DELAY, config.SCAN_DELAY + 2)
+
+    @staticmethod
+    def normalize_pokemon(raw, now):
+        """Normalizes data coming from API into something acceptable by db"""
+        return {
+            'encounter_id': raw['encounter_id'],
+            'spawn_id': raw['spawn_point_id'],
+            'pokemon_id': raw['pokemon_data']['pokemon_id'],
+            'expire_timestamp': (now + raw['time_till_hidden_ms']) / 1000.0,
+            'lat': raw['latitude'],
+            'lon': raw['longitude'],
+        }
+
+    @staticmethod
+    def normalize_fort(raw):
+        return {
+            'external_id': raw['id'],
+            'lat': raw['latitude'],
+            'lon': raw['longitude'],
+            'team': raw.get('owned_by_team', 0),
+            'prestige': raw.get('gym_points', 0),
+            'guard_pokemon_id': raw.get('guard_pokemon_id', 0),
+            'last_modified': raw['last_modified_timestamp_ms'] / 1000.0,
+        }
+
+    @property
+    def status(self):
+        """Returns status message to be displayed in status screen"""
+        if self.error_code:
+            msg = self.error_code
+        else:
+            msg = 'C{cycle},P{seen},{progress:.0f}%'.format(
+                cycle=self.cycle,
+                seen=self.seen_per_cycle,
+                # Visits of points taken over from others count as steps
+                progress=min(self.step / float(self.count_points) * 100, 100)
+            )
+        return '[W{worker_no}: {msg}]'.format(
+            worker_no=self.worker_no,
+            msg=msg
+        )
+
+    def kill(self):
+        """Marks worker as not running
+
+        It should stop any operation as soon as possible and restart itself.
+        """
+        self.error_code = 'KILLED'
+        self.running = False
+
+    def disable(self):
+        """Marks worker as disabled"""
+        self.error_code = 'DISABLED'
+        self.running = False
+
+
+class Slave(BaseSlave, threading.Thread):
     """Single worker walking on the map"""
     def __init__(
         self,
@@ -71,23 +265,9 @@ class Slave(threading.Thread):
         worker_no=None,
         points=None,
     ):
-        super(Slave, self).__init__(group, target, name)
-        self.worker_no = worker_no
+        threading.Thread.__init__(self, group, target, name)
+        BaseSlave.__init__(self, worker_no, points)
         local_data.worker_no = worker_no
-        self.points = points
-        self.count_points = len(self.points)
-        self.step = 0
-        self.cycle = 0
-        self.seen_per_cycle = 0
-        self.total_seen = 0
-        self.error_code = None
-        self.running = True
-        center = self.points[0]
-        self.api = PGoApi()
-        self.api.activate_signature(config.ENCRYPT_PATH)
-        self.api.set_position(center[0], center[1], 100)  # lat, lon, alt
-        if hasattr(config, 'PROXIES') and config.PROXIES:
-            self.api.set_proxy(config.PROXIES)
 
     def run(self):
         """Wrapper for self.main - runs it a few times before restarting
@@ -171,141 +351,25 @@ class Slave(threading.Thread):
 
     def main(self):
         """Heart of the worker - goes over each point and reports sightings"""
-        session = db.Session()
         self.seen_per_cycle = 0
         self.step = 0
-        for i, point in enumerate(self.points):
+        for i, point in enumerate(self.get_points()):
             if not self.running:
                 return
             logger.info('Visiting point %d (%s %s)', i, point[0], point[1])
-            self.api.set_position(point[0], point[1], 0)
-            cell_ids = pgoapi_utils.get_cell_ids(point[0], point[1])
-            self.api.set_position(point[0], point[1], 100)
             response_dict = self.api.get_map_objects(
-                latitude=pgoapi_utils.f2i(point[0]),
-                longitude=pgoapi_utils.f2i(point[1]),
-                cell_id=cell_ids
-            )
-            if not isinstance(response_dict, dict):
-                logger.warning('Response: %s', response_dict)
-                raise MalformedResponse
-            if response_dict['status_code'] == 3:
-                logger.warning('Account banned')
-                raise BannedAccount
-            responses = response_dict.get('responses')
-            if not responses:
-                logger.warning('Response: %s', response_dict)
-                raise MalformedResponse
-            map_objects = response_dict['responses'].get('GET_MAP_OBJECTS', {})
-            pokemons = []
-            forts = []
-            if map_objects.get('status') == 1:
-                for map_cell in map_objects['map_cells']:
-                    for pokemon in map_cell.get('wild_pokemons', []):
-                        # Care only about 15 min spawns
-                        # 30 and 45 min ones (negative) will be just put after
-                        # time_till_hidden is below 15 min
-                        # As of 2016.08.14 we don't know what values over
-                        # 60 minutes are, so ignore them too
-                        invalid_time = (
-                            pokemon['time_till_hidden_ms'] < 0 or
-                            pokemon['time_till_hidden_ms'] > 900000
-                        )
-                        if invalid_time:
-                            continue
-                        pokemons.append(
-                            self.normalize_pokemon(
-                                pokemon, map_cell['current_timestamp_ms']
-                            )
-                        )
-                    for fort in map_cell.get('forts', []):
-                        if not fort.get('enabled'):
-                            continue
-                        if fort.get('type') == 1:  # probably pokestops
-                            continue
-                        forts.append(self.normalize_fort(fort))
-            for raw_pokemon in pokemons:
-                db.add_sighting(session, raw_pokemon)
-                self.seen_per_cycle += 1
-                self.total_seen += 1
-            session.commit()
-            for raw_fort in forts:
-                db.add_fort_sighting(session, raw_fort)
-            # Commit is not necessary here, it's done by add_fort_sighting
-            logger.info(
-                'Point processed, %d Pokemons and %d forts seen!',
-                len(pokemons),
-                len(forts),
+                point, cell_ids.get(point)
             )
-            # Clear error code and let know that there are Pokemon
-            if self.error_code and self.seen_per_cycle:
-                self.error_code = None
-            self.step += 1
-            time.sleep(
-                random.uniform(config.SCAN_DELAY, config.SCAN_DELAY + 2)
-            )
-        session.close()
+            self.process_response(response_dict)
+            time.sleep(self.get_scan_delay())
         if self.seen_per_cycle == 0:
             self.error_code = 'NO POKEMON'
 
-    @staticmethod
-    def normalize_pokemon(raw, now):
-        """Normalizes data coming from API into something acceptable by db"""
-        return {
-            'encounter_id': raw['encounter_id'],
-            'spawn_id': raw['spawn_point_id'],
-            'pokemon_id': raw['pokemon_data']['pokemon_id'],
-            'expire_timestamp': (now + raw['time_till_hidden_ms']) / 1000.0,
-            'lat': raw['latitude'],
-            'lon': raw['longitude'],
-        }
-
-    @staticmethod
-    def normalize_fort(raw):
-        return {
-            'external_id': raw['id'],
-            'lat': raw['latitude'],
-            'lon': raw['longitude'],
-            'team': raw.get('owned_by_team', 0),
-            'prestige': raw.get('gym_points', 0),
-            'guard_pokemon_id': raw.get('guard_pokemon_id', 0),
-            'last_modified': raw['last_modified_timestamp_ms'] / 1000.0,
-        }
-
-    @property
-    def status(self):
-        """Returns status message to be displayed in status screen"""
-        if self.error_code:
-            msg = self.error_code
-        else:
-            msg = 'C{cycle},P{seen},{progress:.0f}%'.format(
-                cycle=self.cycle,
-                seen=self.seen_per_cycle,
-                progress=(self.step / float(self.count_points) * 100)
-            )
-        return '[W{worker_no}: {msg}]'.format(
-            worker_no=self.worker_no,
-            msg=msg
-        )
-
     def restart(self, sleep_min=5, sleep_max=20):
         """Sleeps for a bit, then restarts"""
         time.sleep(random.randint(sleep_min, sleep_max))
         start_worker(self.worker_no, self.points)
 
-    def kill(self):
-        """Marks worker as not running
-
-        It should stop any operation as soon as possible and restart itself.
-        """
-        self.error_code = 'KILLED'
-        self.running = False
-
-    def disable(self):
-        """Marks worker as disabled"""
-        self.error_code = 'DISABLED'
-        self.running = False
-
 
 def get_status_message(workers, count, start_time, points_stats):
     messages = [workers[i].status.ljust(20) for i in range(count)]
@@ -319,10 +383,20 @@ def get_status_message(workers, count, start_time, points_stats):
             min=points_stats['min'],
             max=points_stats['max'],
         ),
+        'walking ~{avg:.0f}m per cycle '
+        '(min: {min:.0f}m, max: {max:.0f}m)'.format(
+            avg=points_stats['tour_avg'],
+            min=points_stats['tour_min'],
+            max=points_stats['tour_max'],
+        ),
         '',
         '{} threads active'.format(threading.active_count()),
+        db_writer.status,
+        db.SIGHTING_CACHE.status,
         '',
     ]
+    if work_queue:
+        output.insert(-1, work_queue.status)
     previous = 0
     for i in range(4, count + 4, 4):
         output.append('\t'.join(messages[previous:i]))
@@ -345,49 +419,106 @@ def start_worker(worker_no, points):
     workers[worker_no] = worker
 
 
-def spawn_workers(workers, status_bar=True):
-    points = utils.get_points_per_worker()
-    start_date = datetime.now()
-    count = config.GRID[0] * config.GRID[1]
-    for worker_no in range(count):
-        start_worker(worker_no, points[worker_no])
+def prepare_workers():
+    """Returns points for every worker, having warmed up caches and writer
+
+    Job updating report tables is started here too, so that it runs in one
+    process, however many web server processes there are.
+    """
+    global work_queue
+    scan_plan = utils.get_scan_plan()
+    if not scan_plan.cell_ids:
+        logger.warning('No scan plan found, run manage.py build-plan')
+    cell_ids.update(scan_plan.cell_ids)
+    points = scan_plan.points
+    if getattr(config, 'WORK_STEALING', False):
+        work_queue = workqueue.PointQueue(
+            points, getattr(config, 'MAX_POINT_AGE', 15 * 60)
+        )
+    session = db.Session()
+    logger.info('Loaded %d sightings and %d forts into cache',
+                *db.warm_caches(session))
+    if getattr(config, 'SPAWN_SCHEDULER', False):
+        # Spawn points don't change often, last week is plenty
+        spawns = db.get_spawn_times(session, since=time.time() - 7 * 86400)
+        schedulers.update(enumerate(scheduler.get_schedulers(points, spawns)))
+        logger.info('Scheduling visits using %d known spawn points',
+                    len(spawns))
+    session.close()
+    db_writer.start()
+    rollup_job.start()
+    return points
+
+
+def get_points_stats(points):
     lenghts = [len(p) for p in points]
-    points_stats = {
+    tours = [utils.get_tour_length(p) for p in points]
+    return {
         'max': max(lenghts),
         'min': min(lenghts),
         'avg': sum(lenghts) / float(len(lenghts)),
+        'tour_max': max(tours),
+        'tour_min': min(tours),
+        'tour_avg': sum(tours) / float(len(tours)),
     }
-    last_cleaned_cache = time.time()
-    last_workers_checked = time.time()
-    workers_check = [
-        (worker, worker.total_seen) for worker in workers.values()
-        if worker.running
-    ]
-    while True:
+
+
+class Supervisor(object):
+    """Cleans cache, kills workers not doing anything and shows status"""
+    def __init__(self, workers, count, points_stats, status_bar=True):
+        self.workers = workers
+        self.count = count
+        self.points_stats = points_stats
+        self.status_bar = status_bar
+        self.start_date = datetime.now()
+        self.last_cleaned_cache = time.time()
+        self.last_workers_checked = time.time()
+        self.workers_check = [
+            (worker, worker.total_seen) for worker in workers.values()
+            if worker.running
+        ]
+
+    def tick(self):
+        """Does whatever is needed at the moment - meant to be called often"""
         now = time.time()
-        # Clean cache
-        if now - last_cleaned_cache > (15 * 60):  # clean cache
+        # Clean cache - it only drops expired buckets, so it's cheap
+        if now - self.last_cleaned_cache > 120:
             db.SIGHTING_CACHE.clean_expired()
-            last_cleaned_cache = now
+            self.last_cleaned_cache = now
         # Check up on workers
-        if now - last_workers_checked > (5 * 60):
+        if now - self.last_workers_checked > (5 * 60):
             # Kill those not doing anything
-            for worker, total_seen in workers_check:
+            for worker, total_seen in self.workers_check:
                 if not worker.running:
                     continue
                 if worker.total_seen <= total_seen:
                     worker.kill()
             # Prepare new list
-            workers_check = [
-                (worker, worker.total_seen) for worker in workers.values()
+            self.workers_check = [
+                (worker, worker.total_seen)
+                for worker in self.workers.values()
             ]
-            last_workers_checked = now
-        if status_bar:
+            self.last_workers_checked = now
+        if self.status_bar:
             if sys.platform == 'win32':
                 _ = os.system('cls')
             else:
                 _ = os.system('clear')
-            print(get_status_message(workers, count, start_date, points_stats))
+            print(get_status_message(
+                self.workers, self.count, self.start_date, self.points_stats
+            ))
+
+
+def spawn_workers(workers, status_bar=True):
+    points = prepare_workers()
+    count = config.GRID[0] * config.GRID[1]
+    for worker_no in range(count):
+        start_worker(worker_no, points[worker_no])
+    supervisor = Supervisor(
+        workers, count, get_points_stats(points), status_bar
+    )
+    while True:
+        supervisor.tick()
         time.sleep(0.5)
 
 
@@ -399,6 +530,13 @@ def parse_args():
         help='Log to console instead of displaying status bar',
         action='store_false',
     )
+    parser.add_argument(
+        '--engine',
+        choices=['threads', 'asyncio'],
+        default='threads',
+        help='Run every worker in its own thread (default) or all of them '
+             'as coroutines on one event loop (Python 3.5+ only)',
+    )
     parser.add_argument(
         '--log-level',
         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
@@ -416,4 +554,13 @@ if __name__ == '__main__':
     else:
         configure_logger(filename=None)
     logger.setLevel(args.log_level)
-    spawn_workers(workers, status_bar=args.status_bar)
+    if args.engine == 'asyncio':
+        # Imported here, because it's not valid Python 2.7 code
+        import async_worker
+        async_worker.main(status_bar=args.status_bar)
+    else:
+        try:
+            spawn_workers(workers, status_bar=args.status_bar)
+        except KeyboardInterrupt:
+            logger.info('Writing what is left in the queue and exiting')
+            db_writer.stop()
@@ -0,0 +1,117 @@
+"""Sharing points between workers
+
+Every worker has its own points, but some of them are faster than others,
+and some are sleeping, restarting or banned at the moment. PointQueue lets
+workers that finished their cycle take points their colleagues haven't
+visited yet, and makes sure no point goes unvisited for too long.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+
+class PointQueue(object):
+    """Keeps track of when every point was visited and by whom it should be
+
+    Points are kept ordered by time of last visit, so finding the one that
+    waits the longest is cheap.
+    """
+    def __init__(self, points, max_age):
+        """Takes list of points for every worker, max_age is in seconds"""
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.owners = {}
+        self.points = {}
+        self.remaining = {}
+        self.cycle_started = {}
+        self.last_visit = OrderedDict()
+        now = time.time()
+        for worker_no, worker_points in enumerate(points):
+            # Points of workers that never start a cycle (disabled, or
+            # failing to log in) can be taken over right away
+            self.points[worker_no] = list(worker_points)
+            self.remaining[worker_no] = set(worker_points)
+            for point in worker_points:
+                self.owners[point] = worker_no
+                # Pretend everything was just visited, otherwise all points
+                # would be overdue at start
+                self.last_visit[point] = now
+        self.stolen = 0
+        self.overdue = 0
+
+    def start_cycle(self, worker_no, points):
+        """Makes all points of worker pending again
+
+        So are points of workers which didn't start a cycle for max_age (or
+        at all) and have none pending left, so that others take them over
+        in every cycle, not only once.
+        """
+        now = time.time()
+        with self.lock:
+            self.remaining[worker_no] = set(points)
+            self.cycle_started[worker_no] = now
+            for other, other_points in self.points.items():
+                started = self.cycle_started.get(other, 0)
+                if started < now - self.max_age and not self.remaining[other]:
+                    self.remaining[other] = set(other_points)
+
+    def is_pending(self, point):
+        """Tells if point wasn't visited since its owner started a cycle
+
+        Before the first cycle, it's any point not visited yet.
+        """
+        with self.lock:
+            return point in self.remaining[self.owners[point]]
+
+    def mark_visited(self, point):
+        with self.lock:
+            self._mark_visited(point)
+
+    def _mark_visited(self, point):
+        self.remaining[self.owners[point]].discard(point)
+        del self.last_visit[point]
+        self.last_visit[point] = time.time()
+
+    def take_overdue(self):
+        """Returns point not visited for longer than max_age, if any"""
+        with self.lock:
+            point, visited_at = next(iter(self.last_visit.items()))
+            if visited_at > time.time() - self.max_age:
+                return None
+            self._mark_visited(point)
+            self.overdue += 1
+            return point
+
+    def steal(self, worker_no):
+        """Returns point of the worker most behind, or None if all are done
+
+        Takes the point that waits the longest, as it's probably the one
+        its owner would reach last.
+        """
+        with self.lock:
+            victim = max(
+                self.remaining, key=lambda no: len(self.remaining[no])
+            )
+            if not self.remaining[victim]:
+                return None
+            point = min(
+                self.remaining[victim], key=self.last_visit.__getitem__
+            )
+            self._mark_visited(point)
+            if victim != worker_no:
+                self.stolen += 1
+            return point
+
+    @property
+    def status(self):
+        """Returns status message to be displayed in status screen"""
+        with self.lock:
+            oldest = next(iter(self.last_visit.values()))
+        return (
+            'Work queue: oldest point visited {age:.0f}s ago, '
+            '{stolen} points taken over, {overdue} overdue visits'
+        ).format(
+            age=time.time() - oldest,
+            stolen=self.stolen,
+            overdue=self.overdue,
+        )
@@ -0,0 +1,216 @@
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2.7
+    import Queue as queue
+
+from sqlalchemy.exc import DBAPIError, OperationalError
+
+import config
+import db
+
+
+logger = logging.getLogger()
+
+
+def is_transient(error):
+    """Tells if error is about the connection rather than written data"""
+    if isinstance(error, OperationalError):
+        return True
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+def split_batch(pokemons, forts):
+    """Returns two halves of a batch, each as (pokemons, forts)"""
+    half = (len(pokemons) + len(forts)) // 2
+    if half <= len(pokemons):
+        return (pokemons[:half], []), (pokemons[half:], forts)
+    half -= len(pokemons)
+    return (pokemons, forts[:half]), ([], forts[half:])
+
+
+class DatabaseWriter(threading.Thread):
+    """Single thread that puts everything workers see into the database
+
+    Workers push normalized sightings and forts into a bounded queue and go
+    on with scanning. Writer flushes them in batches, either when enough of
+    them piled up or when flush interval passed since the batch was started.
+    If the queue is full, workers have to wait - each such wait is counted,
+    so that it's visible in status screen when database can't keep up.
+    If the database is unavailable, batch is retried after retry_delay until
+    it comes back. Batch failing for any other reason is retried `retries`
+    times, then split in halves written separately, so that a single bad
+    row is all that is lost - it's logged and dropped.
+    """
+    # Once stopped, writer doesn't wait for the database forever
+    RETRIES_ON_STOP = 3
+
+    def __init__(self, batch_size=None, flush_interval=None, queue_size=None,
+                 retry_delay=None, retries=None):
+        super(DatabaseWriter, self).__init__(name='db-writer')
+        self.daemon = True
+        self.batch_size = batch_size or getattr(
+            config, 'DB_WRITER_BATCH_SIZE', 500
+        )
+        self.flush_interval = flush_interval or getattr(
+            config, 'DB_WRITER_FLUSH_INTERVAL', 2
+        )
+        self.queue = queue.Queue(maxsize=queue_size or getattr(
+            config, 'DB_WRITER_QUEUE_SIZE', 10000
+        ))
+        self.retry_delay = retry_delay or getattr(
+            config, 'DB_WRITER_RETRY_DELAY', 1
+        )
+        self.retries = retries if retries is not None else getattr(
+            config, 'DB_WRITER_RETRIES', 2
+        )
+        self.running = True
+        self.started_at = time.time()
+        self.items_received = 0
+        self.rows_written = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self.backpressure = 0
+        self.last_flush_duration = 0
+
+    def add_sighting(self, pokemon):
+        self._put(('sighting', pokemon))
+
+    def add_fort_sighting(self, raw_fort):
+        self._put(('fort', raw_fort))
+
+    def _put(self, item):
+        if not self.put_nowait(item):
+            self.backpressure += 1
+            self.queue.put(item)
+
+    def put_nowait(self, item):
+        """Queues (kind, item) tuple, returns False if the queue is full
+
+        For callers that can't block, like coroutines - they have to wait
+        in their own way and try again.
+        """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+    def run(self):
+        while self.running or not self.queue.empty():
+            pokemons, forts = self.collect()
+            if pokemons or forts:
+                self.write(pokemons, forts)
+
+    def collect(self):
+        """Takes items from the queue until batch is full or time is up"""
+        pokemons = []
+        forts = []
+        deadline = time.time() + self.flush_interval
+        while len(pokemons) + len(forts) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                kind, item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if kind == 'sighting':
+                pokemons.append(item)
+            else:
+                forts.append(item)
+        self.items_received += len(pokemons) + len(forts)
+        return pokemons, forts
+
+    def write(self, pokemons, forts):
+        """Writes a batch, retrying or splitting it as long as it fails"""
+        failures = 0
+        while True:
+            try:
+                self.flush(pokemons, forts)
+                return
+            except Exception as e:
+                failures += 1
+                logger.exception(
+                    'Failed to write %d sightings and %d forts',
+                    len(pokemons),
+                    len(forts),
+                )
+                error = e
+            if is_transient(error):
+                if self.running or failures <= self.RETRIES_ON_STOP:
+                    time.sleep(self.retry_delay)
+                    continue
+                logger.error(
+                    'Giving up on %d sightings and %d forts',
+                    len(pokemons),
+                    len(forts),
+                )
+                self.dropped += len(pokemons) + len(forts)
+                return
+            if failures > self.retries:
+                break
+        if len(pokemons) + len(forts) == 1:
+            logger.error('Dropping %r', (pokemons or forts)[0])
+            self.dropped += 1
+            return
+        for half in split_batch(pokemons, forts):
+            self.write(*half)
+
+    def flush(self, pokemons, forts):
+        """Writes a batch in a single transaction
+
+        Items are remembered in caches only after commit, so that failed
+        ones aren't skipped as duplicates when seen again.
+        """
+        started = time.time()
+        session = db.Session()
+        try:
+            written = db.add_sightings(session, pokemons)
+            written += db.add_fort_sightings(session, forts)
+            session.commit()
+        except Exception:
+            session.rollback()
+            self.failed_flushes += 1
+            raise
+        finally:
+            session.close()
+        db.cache_sightings(pokemons)
+        db.cache_fort_sightings(forts)
+        self.rows_written += written
+        self.flushes += 1
+        self.last_flush_duration = time.time() - started
+        logger.debug(
+            'Flushed %d rows in %.3fs', written, self.last_flush_duration
+        )
+
+    def stop(self):
+        """Writes whatever is left in the queue and stops"""
+        self.running = False
+        if self.is_alive():
+            self.join()
+
+    @property
+    def rows_per_second(self):
+        return self.rows_written / max(time.time() - self.started_at, 1)
+
+    @property
+    def status(self):
+        """Returns status message to be displayed in status screen"""
+        return (
+            'DB writer: {queued} queued, {rows} rows written ({speed:.1f}/s), '
+            'last flush {duration:.2f}s, {waits} waits, {failed} failed, '
+            '{dropped} dropped'
+        ).format(
+            queued=self.queue.qsize(),
+            rows=self.rows_written,
+            speed=self.rows_per_second,
+            duration=self.last_flush_duration,
+            waits=self.backpressure,
+            failed=self.failed_flushes,
+            dropped=self.dropped,
+        )